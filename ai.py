@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import os
-import smtplib
 import logging
 import configparser
 import markdown
@@ -9,70 +8,216 @@ import pytz
 import time
 import json
 import re
+import hashlib
+import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email.mime.application import MIMEApplication
-import google.generativeai as genai
 from google.api_core import exceptions as google_exceptions
 import glob
+from log_parser import aggregate_log_lines, make_syslog_time_parser
+from log_compactor import build_compacted_prompt_content, estimate_tokens
+from context_store import load_context_sections, select_relevant_sections
+from gemini_client import DEFAULT_MODEL_NAME, configure_gemini, get_gemini_client, get_response_cache
+from report_index import DEFAULT_INDEX_FILE, configure_report_index, get_report_index
+from sketches import ReportSketch, load_report_sketch, save_report_sketch
+from response_cache import ResponseCache, log_cache_stats
+from mail_outbox import cached_mime_part, configure_mail_outbox, get_mail_outbox
+from syslog_receiver import get_syslog_receiver, start_syslog_receiver
+from log_archive import (COMPRESSED_LOG_EXTENSIONS, current_log_path, describe_segments, list_log_segments,
+                         read_archived_segments, select_segments)
+from parallel_scan import (PARALLEL_SCAN_MIN_BYTES, aggregate_window_part, merge_window_parts, parallel_aggregate_file,
+                           window_part_chunks)
+from ip_enrichment import load_ip_enricher
+from metrics import (SectionTimeout, cancel_section, configure_metrics, cycle_span, instrumented_cycle, record,
+                     set_cycle_report, set_section_deadline)
+from baseline import anomalies_prompt_text, evaluate_window, load_baseline, quiet_window_report, save_baseline
 
 # --- Khai báo hằng số (Dùng làm giá trị mặc định/fallback) ---
 CONFIG_FILE = "config.ini"
 PROMPT_TEMPLATE_FILE = "prompt_template.md"
 SUMMARY_PROMPT_TEMPLATE_FILE = "summary_prompt_template.md"
+REDUCE_PROMPT_TEMPLATE_FILE = "reduce_prompt_template.md"
 EMAIL_TEMPLATE_FILE = "email_template.html"
 SUMMARY_EMAIL_TEMPLATE_FILE = "summary_email_template.html"
 LOGO_FILE = "logo_novaon.png"
+CONTEXT_CACHE_DIR = ".context_cache"
+RESPONSE_CACHE_DIR = ".llm_cache"
+LOG_CHECKPOINT_LOOKBACK = 8192
+LOG_BISECT_MIN_SPAN = 65536
+SCHEDULER_TICK_SECONDS = 1
+# Các key cấu hình chuẩn trong section firewall (các key còn lại được coi là file bối cảnh)
+STANDARD_CONFIG_KEYS = ['pfsensehostname', 'logfile', 'hourstoanalyze', 'timezone',
+                        'reportdirectory', 'recipientemails', 'summary_enabled',
+                        'reports_per_summary', 'summary_recipient_emails',
+                        'prompt_file', 'summary_prompt_file', 'logseekmode',
+                        'filterlogsamplelines', 'prompttokenbudget', 'runintervalseconds',
+                        'runjitterseconds', 'sectiontimeoutseconds', 'mapreduceminlines',
+                        'mapreducechunks', 'logsource', 'syslogsources',
+                        'baselineskipthreshold', 'baselinewarmupwindows', 'baselinealpha',
+                        'profileenabled', 'profiletopfunctions']
 
 
 LOGGING_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT)
 
-# --- Các hàm quản lý trạng thá
+# --- Các hàm quản lý trạng thái (lưu trong chỉ mục SQLite, tự chuyển từ file state cũ) ---
+def _read_legacy_state(state_file):
+    """Đọc file state dạng dotfile cũ (nếu còn) để chuyển sang chỉ mục."""
+    if not os.path.exists(state_file):
+        return None
+    with open(state_file, 'r') as f:
+        return f.read().strip()
+
+def _get_state(firewall_id, key, legacy_file):
+    """Đọc trạng thái từ chỉ mục; lần đầu sẽ chuyển giá trị từ dotfile cũ sang."""
+    index = get_report_index()
+    value = index.get_state(firewall_id, key)
+    if value is None:
+        value = _read_legacy_state(legacy_file)
+        if value is not None:
+            index.set_state(firewall_id, key, value)
+            logging.info(f"[{firewall_id}] Đã chuyển trạng thái '{legacy_file}' vào chỉ mục.")
+    return value
+
 def get_last_run_timestamp(firewall_id):
-    """Đọc timestamp từ file state dành riêng cho một firewall."""
-    state_file = f".last_run_timestamp_{firewall_id}"
-    if os.path.exists(state_file):
-        with open(state_file, 'r') as f:
-            try:
-                return datetime.fromisoformat(f.read().strip())
-            except ValueError:
-                return None
-    return None
+    """Đọc timestamp lần chạy cuối của một firewall."""
+    value = _get_state(firewall_id, 'last_run_timestamp', f".last_run_timestamp_{firewall_id}")
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
 
 def save_last_run_timestamp(timestamp, firewall_id):
-    """Lưu timestamp vào file state dành riêng cho một firewall."""
-    state_file = f".last_run_timestamp_{firewall_id}"
-    with open(state_file, 'w') as f:
-        f.write(timestamp.isoformat())
+    """Lưu timestamp lần chạy cuối của một firewall."""
+    get_report_index().set_state(firewall_id, 'last_run_timestamp', timestamp.isoformat())
 
 def get_summary_count(firewall_id):
     """Lấy số đếm báo cáo đã chạy cho một firewall."""
-    summary_count_file = f".summary_report_count_{firewall_id}"
-    if not os.path.exists(summary_count_file):
-        return 0
+    value = _get_state(firewall_id, 'summary_report_count', f".summary_report_count_{firewall_id}")
     try:
-        with open(summary_count_file, 'r') as f:
-            return int(f.read().strip())
-    except (ValueError, FileNotFoundError):
+        return int(value) if value else 0
+    except ValueError:
         return 0
 
 def save_summary_count(count, firewall_id):
     """Lưu số đếm cho một firewall."""
-    summary_count_file = f".summary_report_count_{firewall_id}"
     try:
-        with open(summary_count_file, 'w') as f:
-            f.write(str(count))
-        logging.info(f"[{firewall_id}] Đã cập nhật file đếm: {summary_count_file} = {count}")
+        get_report_index().set_state(firewall_id, 'summary_report_count', str(count))
+        logging.info(f"[{firewall_id}] Đã cập nhật số đếm báo cáo tổng hợp = {count}")
     except Exception as e:
-        logging.error(f"[{firewall_id}] Lỗi khi lưu file đếm: {e}")
+        logging.error(f"[{firewall_id}] Lỗi khi lưu số đếm: {e}")
+
+def get_log_checkpoint(firewall_id):
+    """Đọc checkpoint (inode, byte offset, hash dòng cuối) của file log cho một firewall."""
+    value = _get_state(firewall_id, 'log_checkpoint', f".log_checkpoint_{firewall_id}")
+    try:
+        return json.loads(value) if value else None
+    except ValueError:
+        return None
+
+def save_log_checkpoint(checkpoint, firewall_id):
+    """Lưu checkpoint đọc log của một firewall."""
+    get_report_index().set_state(firewall_id, 'log_checkpoint', json.dumps(checkpoint))
 
 # --- Các hàm lõi 
 
-def read_new_log_entries(file_path, hours, timezone_str, firewall_id):
-    """Đọc các dòng log mới từ một file log cụ thể."""
+def _bisect_log_offset(f, size, start_ts, parse_ts):
+    """Tìm kiếm nhị phân theo byte offset để tìm vùng bắt đầu cửa sổ thời gian (log gần như có thứ tự)."""
+    lo, hi = 0, size
+    while hi - lo > LOG_BISECT_MIN_SPAN:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        f.readline()  # Bỏ qua phần dòng bị cắt ngang
+        log_ts = None
+        while log_ts is None and f.tell() < hi:
+            raw_line = f.readline()
+            if not raw_line:
+                break
+            log_ts = parse_ts(raw_line[:15].decode('ascii', errors='ignore'))
+        if log_ts is None or log_ts > start_ts:
+            hi = mid
+        else:
+            lo = mid
+    if lo:
+        f.seek(lo)
+        f.readline()
+        lo = f.tell()
+    return lo
+
+def _line_before_offset(f, offset):
+    """Lấy dòng hoàn chỉnh kết thúc ngay tại offset (dùng để đối chiếu checkpoint)."""
+    if offset <= 0:
+        return b""
+    start = max(0, offset - LOG_CHECKPOINT_LOOKBACK)
+    f.seek(start)
+    chunk = f.read(offset - start)
+    if len(chunk) != offset - start or not chunk.endswith(b"\n"):
+        return None
+    body = chunk[:-1]
+    return body[body.rfind(b"\n") + 1:]
+
+def _checkpoint_matches(f, size, checkpoint):
+    """Kiểm tra file đang mở có chứa đúng dòng cuối đã ghi trong checkpoint hay không."""
+    offset = checkpoint.get('offset', 0)
+    if size < offset:
+        return False
+    line = _line_before_offset(f, offset)
+    return line is not None and hashlib.sha1(line).hexdigest() == checkpoint.get('line_hash')
+
+def _read_complete_lines(f, offset):
+    """Đọc từ offset đến dòng hoàn chỉnh cuối cùng; phần dòng đang ghi dở để lại cho chu kỳ sau."""
+    f.seek(offset)
+    data = f.read()
+    cut = data.rfind(b"\n") + 1
+    return data[:cut], offset + cut
+
+def _find_rotated_log(file_path, checkpoint):
+    """Tìm file log đã bị xoay vòng (vd: filter.log.0) chứa vị trí checkpoint."""
+    candidates = [p for p in glob.glob(glob.escape(file_path) + ".*")
+                  if not p.endswith(COMPRESSED_LOG_EXTENSIONS) and os.path.isfile(p)]
+    # Ưu tiên file có cùng inode (rename), sau đó đến file mới sửa gần nhất (copytruncate)
+    candidates.sort(key=lambda p: (os.stat(p).st_ino != checkpoint.get('inode'), -os.path.getmtime(p)))
+    for path in candidates:
+        with open(path, 'rb') as rf:
+            if _checkpoint_matches(rf, os.fstat(rf.fileno()).st_size, checkpoint):
+                return path
+    return None
+
+def _read_since_checkpoint(f, file_path, checkpoint, firewall_id):
+    """Đọc dữ liệu mới kể từ checkpoint. Trả về (bytes, offset mới) hoặc None nếu phải dùng timestamp."""
+    st = os.fstat(f.fileno())
+    if st.st_ino == checkpoint.get('inode') and _checkpoint_matches(f, st.st_size, checkpoint):
+        logging.info(f"[{firewall_id}] Đọc tiếp từ checkpoint tại byte {checkpoint['offset']}.")
+        return _read_complete_lines(f, checkpoint['offset'])
+
+    rotated_path = _find_rotated_log(file_path, checkpoint)
+    if rotated_path:
+        logging.info(f"[{firewall_id}] Phát hiện log đã xoay vòng, đọc phần còn lại từ '{rotated_path}'.")
+        with open(rotated_path, 'rb') as rf:
+            rf.seek(checkpoint['offset'])
+            rotated_tail = rf.read()
+        if rotated_tail and not rotated_tail.endswith(b"\n"):
+            rotated_tail += b"\n"
+        data, new_offset = _read_complete_lines(f, 0)
+        return rotated_tail + data, new_offset
+
+    if st.st_ino == checkpoint.get('inode'):
+        # Cùng inode nhưng nội dung tại checkpoint đã khác: file bị truncate (copytruncate) rồi ghi lại
+        logging.warning(f"[{firewall_id}] File log đã bị cắt ngắn (truncate), đọc lại từ đầu.")
+        return _read_complete_lines(f, 0)
+
+    logging.warning(f"[{firewall_id}] Checkpoint không còn hợp lệ, chuyển sang lọc theo timestamp.")
+    return None
+
+def read_new_log_entries(file_path, hours, timezone_str, firewall_id, seek_mode='bisect', archive_workers=2,
+                         scan_workers=1, sample_limit=50):
+    """Đọc các dòng log mới từ file log (hoặc glob/bộ file xoay vòng, kể cả bản nén).
+
+    Trả về (nội dung, start_time, end_time, window_parts). Khi quét song song, các process con chỉ gửi về kết quả
+    tổng hợp: nội dung là chuỗi rỗng và window_parts là các phần cửa sổ (parallel_scan.py); ngược lại là None.
+    """
     logging.info(f"[{firewall_id}] Bắt đầu đọc log từ '{file_path}'.")
     try:
         tz = pytz.timezone(timezone_str)
@@ -86,37 +231,123 @@ def read_new_log_entries(file_path, hours, timezone_str, firewall_id):
             start_time = end_time - timedelta(hours=hours)
             logging.info(f"[{firewall_id}] Lần chạy đầu tiên. Đọc log trong vòng {hours} giờ qua.")
 
-        new_entries = []
-        latest_log_time = start_time
-        current_year = end_time.year
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            for line in f:
-                try:
-                    log_time_str = line[:15]
-                    log_datetime_naive = datetime.strptime(f"{current_year} {log_time_str}", "%Y %b %d %H:%M:%S")
-                    log_datetime_aware = tz.localize(log_datetime_naive)
-                    if log_datetime_aware > end_time:
-                        log_datetime_aware = log_datetime_aware.replace(year=current_year - 1)
-                    if log_datetime_aware > start_time:
-                        new_entries.append(line)
-                        if log_datetime_aware > latest_log_time:
-                            latest_log_time = log_datetime_aware
-                except ValueError:
-                    continue
+        checkpoint = get_log_checkpoint(firewall_id)
+        parse_ts = make_syslog_time_parser(tz, end_time)
+        start_ts = start_time.timestamp()
+        latest_log_ts = start_ts
+        window_parts = None
+        segments = describe_segments(list_log_segments(file_path), parse_ts)
+        live_path = current_log_path(file_path, segments)
+        if live_path is None:
+            raise FileNotFoundError(file_path)
+        with open(live_path, 'rb') as f:
+            result = _read_since_checkpoint(f, live_path, checkpoint, firewall_id) if checkpoint else None
+            if result is not None:
+                data, new_offset = result
+                new_entries = data.decode('utf-8', errors='ignore').splitlines(keepends=True)
+                for line in reversed(new_entries):
+                    log_ts = parse_ts(line)
+                    if log_ts is not None:
+                        latest_log_ts = max(latest_log_ts, log_ts)
+                        break
+            else:
+                # Fallback: lọc theo timestamp. Các segment đã xoay vòng/nén nằm trong cửa sổ được đọc trước (song song)
+                new_entries = []
+                archived = select_segments([s for s in segments if s["path"] != live_path], start_ts, end_time.timestamp())
+                if archived:
+                    logging.info(f"[{firewall_id}] Đọc {len(archived)} segment đã xoay vòng trong cửa sổ "
+                                 f"(bỏ qua {len(segments) - 1 - len(archived)} segment ngoài cửa sổ).")
+                    archived_texts, archived_latest = read_archived_segments(archived, start_ts, timezone_str, end_time,
+                                                                            archive_workers, firewall_id)
+                    for text in archived_texts:
+                        new_entries.extend(text.splitlines(keepends=True))
+                    if archived_latest is not None:
+                        latest_log_ts = max(latest_log_ts, archived_latest)
 
-        if new_entries:
-            save_last_run_timestamp(latest_log_time, firewall_id)
+                # File đang ghi: nhảy thẳng đến đầu cửa sổ bằng tìm kiếm nhị phân nếu được bật
+                new_offset = 0
+                size = os.fstat(f.fileno()).st_size
+                if seek_mode in ('bisect', 'parallel'):
+                    new_offset = _bisect_log_offset(f, size, start_ts, parse_ts)
+                    logging.info(f"[{firewall_id}] Tìm kiếm nhị phân: bắt đầu quét từ byte {new_offset}.")
+                if seek_mode == 'parallel' and scan_workers > 1 and size - new_offset >= PARALLEL_SCAN_MIN_BYTES:
+                    # Phần cần quét lớn: chia đoạn byte, mmap và tổng hợp song song bằng process pool
+                    logging.info(f"[{firewall_id}] Quét song song {size - new_offset:,} bytes với {scan_workers} process.")
+                    scanned_parts, new_offset = parallel_aggregate_file(live_path, new_offset, start_ts, timezone_str,
+                                                                        end_time, scan_workers, sample_limit)
+                    # Các segment đã xoay vòng (đứng trước về thời gian) tổng hợp tại chỗ thành phần đầu tiên
+                    window_parts = [aggregate_window_part(new_entries, sample_limit)] + scanned_parts
+                    new_entries = []
+                    for part in scanned_parts:
+                        if part["latest_ts"] is not None:
+                            latest_log_ts = max(latest_log_ts, part["latest_ts"])
+                else:
+                    f.seek(new_offset)
+                    for raw_line in f:
+                        if not raw_line.endswith(b"\n"):
+                            break
+                        new_offset += len(raw_line)
+                        line = raw_line.decode('utf-8', errors='ignore')
+                        log_ts = parse_ts(line)
+                        if log_ts is not None and log_ts > start_ts:
+                            new_entries.append(line)
+                            if log_ts > latest_log_ts:
+                                latest_log_ts = log_ts
 
-        logging.info(f"[{firewall_id}] Tìm thấy {len(new_entries)} dòng log mới.")
-        return ("".join(new_entries), start_time, end_time)
+            last_line = _line_before_offset(f, new_offset)
+            save_log_checkpoint({
+                "inode": os.fstat(f.fileno()).st_ino,
+                "offset": new_offset,
+                "line_hash": hashlib.sha1(last_line or b"").hexdigest()
+            }, firewall_id)
+
+        line_count = len(new_entries) if window_parts is None else sum(p["aggregator"].total_lines for p in window_parts)
+        if line_count:
+            save_last_run_timestamp(datetime.fromtimestamp(latest_log_ts, tz), firewall_id)
+
+        logging.info(f"[{firewall_id}] Tìm thấy {line_count} dòng log mới.")
+        return ("".join(new_entries), start_time, end_time, window_parts)
 
     except FileNotFoundError:
         logging.error(f"[{firewall_id}] Lỗi: Không tìm thấy file log tại '{file_path}'.")
-        return (None, None, None)
+        return (None, None, None, None)
     except Exception as e:
         logging.error(f"[{firewall_id}] Lỗi không mong muốn khi đọc file: {e}")
+        return (None, None, None, None)
+
+def read_syslog_entries(hours, timezone_str, firewall_id):
+    """Lấy các dòng log mà bộ nhận syslog đã gom cho firewall kể từ chu kỳ trước (không cần quét file)."""
+    receiver = get_syslog_receiver()
+    if receiver is None:
+        logging.error(f"[{firewall_id}] LogSource = syslog nhưng bộ nhận syslog chưa được bật ([Syslog] Enabled) "
+                      f"hoặc không khởi động được.")
+        return (None, None, None)
+    if receiver.error is not None:
+        logging.error(f"[{firewall_id}] Bộ nhận syslog đã dừng do lỗi ({receiver.error}), không có log để phân tích.")
         return (None, None, None)
 
+    tz = pytz.timezone(timezone_str)
+    end_time = datetime.now(tz)
+    last_run_time = get_last_run_timestamp(firewall_id)
+    start_time = last_run_time.astimezone(tz) if last_run_time else end_time - timedelta(hours=hours)
+
+    lines, _, last_ts = receiver.drain(firewall_id, start_time.timestamp())
+    if lines:
+        save_last_run_timestamp(datetime.fromtimestamp(min(last_ts, end_time.timestamp()), tz), firewall_id)
+
+    stats = receiver.stats(firewall_id)
+    logging.info(f"[{firewall_id}] Tìm thấy {len(lines)} dòng log mới từ bộ nhận syslog "
+                 f"(bỏ do hàng đợi đầy: {stats['dropped_queue_full']}, do tràn buffer: {stats['dropped_buffer_overflow']}, "
+                 f"không định tuyến được: {stats['unrouted']}).")
+    return ("".join(lines), start_time, end_time)
+
+def build_prompt(prompt_file, content, bonus_context):
+    """Đọc file template và điền nội dung cần phân tích (log hoặc báo cáo) cùng bối cảnh bổ sung."""
+    with open(prompt_file, 'r', encoding='utf-8') as f:
+        prompt_template = f.read()
+    # Template phân tích dùng {logs_content}, template tổng hợp/gộp dùng {reports_content}
+    return prompt_template.format(logs_content=content, reports_content=content, bonus_context=bonus_context)
+
 def analyze_logs_with_gemini(firewall_id, content, bonus_context, api_key, prompt_file):
     """Gửi yêu cầu phân tích tới Gemini."""
     if not content or not content.strip():
@@ -124,28 +355,16 @@ def analyze_logs_with_gemini(firewall_id, content, bonus_context, api_key, promp
         return "Không có dữ liệu nào để phân tích trong khoảng thời gian được chọn."
 
     try:
-        with open(prompt_file, 'r', encoding='utf-8') as f:
-            prompt_template = f.read()
+        prompt = build_prompt(prompt_file, content, bonus_context)
     except FileNotFoundError:
         logging.error(f"[{firewall_id}] Lỗi: Không tìm thấy file template '{prompt_file}'.")
         return f"Lỗi hệ thống: Không tìm thấy file '{prompt_file}'."
 
-    genai.configure(api_key=api_key)
-    
-    # Logic để xác định cách format prompt dựa trên tên file
-    is_summary_prompt = 'summary' in os.path.basename(prompt_file).lower()
-    if is_summary_prompt:
-        prompt = prompt_template.format(reports_content=content, bonus_context=bonus_context)
-    else:
-        prompt = prompt_template.format(logs_content=content, bonus_context=bonus_context)
-
     try:
         logging.info(f"[{firewall_id}] Gửi yêu cầu đến Gemini (prompt: {prompt_file}, timeout 180 giây)...")
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        request_options = {"timeout": 180}
-        response = model.generate_content(prompt, request_options=request_options)
+        response_text = get_gemini_client(api_key).generate(prompt, firewall_id)
         logging.info(f"[{firewall_id}] Nhận phân tích từ Gemini thành công.")
-        return response.text
+        return response_text
     except google_exceptions.DeadlineExceeded:
         logging.error(f"[{firewall_id}] Lỗi: Yêu cầu đến Gemini bị hết thời gian chờ (timeout).")
         return "Không thể nhận phân tích từ Gemini do hết thời gian chờ."
@@ -153,10 +372,59 @@ def analyze_logs_with_gemini(firewall_id, content, bonus_context, api_key, promp
         logging.error(f"[{firewall_id}] Lỗi khi giao tiếp với Gemini: {e}")
         return f"Đã xảy ra lỗi khi phân tích log với Gemini: {e}"
 
+def split_log_lines_by_time(lines, chunk_count):
+    """Chia log (đã theo thứ tự thời gian) thành các đoạn thời gian liên tiếp có số dòng gần bằng nhau."""
+    chunk_size = -(-len(lines) // chunk_count)
+    return [lines[i:i + chunk_size] for i in range(0, len(lines), chunk_size)]
+
+def aggregate_log_chunks(lines, chunk_count, sample_limit):
+    """Tổng hợp từng đoạn thời gian của log cho map-reduce: danh sách (aggregator, prompt_lines, "đầu -> cuối")."""
+    chunks = []
+    for chunk in split_log_lines_by_time(lines, chunk_count):
+        chunk_aggregator, chunk_prompt_lines = aggregate_log_lines(chunk, sample_limit)
+        chunks.append((chunk_aggregator, chunk_prompt_lines, f"{chunk[0][:15]} -> {chunk[-1][:15]}"))
+    return chunks
+
+def analyze_logs_map_reduce(firewall_id, chunks, aggregator, bonus_context, api_key, prompt_file, token_budget,
+                            highlight=""):
+    """Phân tích cửa sổ log lớn theo kiểu map-reduce: phân tích song song từng đoạn thời gian rồi gộp kết quả.
+
+    `chunks` là các đoạn đã tổng hợp (aggregate_log_chunks hoặc window_part_chunks).
+    `highlight` (nếu có) được đặt đầu prompt gộp, ví dụ khối bất thường so với baseline.
+    """
+    logging.info(f"[{firewall_id}] Chế độ map-reduce: {aggregator.total_lines} dòng log chia thành {len(chunks)} đoạn.")
+    client = get_gemini_client(api_key)
+
+    def analyze_chunk(chunk_aggregator, chunk_prompt_lines):
+        chunk_aggregator.ip_enricher = aggregator.ip_enricher
+        chunk_content, _ = build_compacted_prompt_content(chunk_aggregator, chunk_prompt_lines, token_budget)
+        return client.generate(build_prompt(prompt_file, chunk_content, bonus_context), firewall_id)
+
+    partial_reports = []
+    with ThreadPoolExecutor(max_workers=len(chunks), thread_name_prefix=f'{firewall_id}-map') as executor:
+        futures = [executor.submit(analyze_chunk, chunk_aggregator, chunk_prompt_lines)
+                   for chunk_aggregator, chunk_prompt_lines, _ in chunks]
+        for index, ((_, _, period), future) in enumerate(zip(chunks, futures), start=1):
+            try:
+                partial_reports.append(f"--- BÁO CÁO ĐOẠN {index}/{len(chunks)} ({period}) ---\n\n{future.result()}")
+            except Exception as e:
+                logging.error(f"[{firewall_id}] Lỗi khi phân tích đoạn {index}/{len(chunks)}: {e}")
+                partial_reports.append(f"--- BÁO CÁO ĐOẠN {index}/{len(chunks)} ({period}) ---\n\n(Không phân tích được đoạn này: {e})")
+
+    reduce_content = f"{aggregator.to_prompt_text()}\n\n" + "\n\n".join(partial_reports)
+    if highlight:
+        reduce_content = f"{highlight}\n\n{reduce_content}"
+    try:
+        logging.info(f"[{firewall_id}] Gộp {len(partial_reports)} báo cáo đoạn (prompt: {REDUCE_PROMPT_TEMPLATE_FILE})...")
+        return client.generate(build_prompt(REDUCE_PROMPT_TEMPLATE_FILE, reduce_content, bonus_context), firewall_id)
+    except Exception as e:
+        # Không để cả chu kỳ thất bại: trả về các báo cáo đoạn nếu bước gộp lỗi
+        logging.error(f"[{firewall_id}] Lỗi ở bước gộp kết quả, dùng trực tiếp các báo cáo đoạn: {e}")
+        return "\n\n".join(partial_reports)
+
 def send_email(firewall_id, subject, body_html, config, recipient_emails_str, attachment_paths=None):
     """Gửi email báo cáo, hỗ trợ đính kèm file."""
     sender_email = config.get('Email', 'SenderEmail')
-    sender_password = config.get('Email', 'SenderPassword')
     recipient_emails_list = [email.strip() for email in recipient_emails_str.split(',')]
     
     logging.info(f"[{firewall_id}] Chuẩn bị gửi email đến {recipient_emails_str}...")
@@ -174,21 +442,15 @@ def send_email(firewall_id, subject, body_html, config, recipient_emails_str, at
     
     msg_related.attach(MIMEText(body_html, 'html'))
     
-    # Nhúng logo và sơ đồ mạng
+    # Nhúng logo và sơ đồ mạng (phần MIME đã mã hóa được cache theo nội dung file)
     try:
-        with open(LOGO_FILE, 'rb') as f:
-            img_logo = MIMEImage(f.read())
-            img_logo.add_header('Content-ID', '<logo_novaon>')
-            msg_related.attach(img_logo)
+        msg_related.attach(cached_mime_part(LOGO_FILE, content_id='logo_novaon'))
     except FileNotFoundError:
         logging.warning(f"[{firewall_id}] Không tìm thấy file logo '{LOGO_FILE}'.")
     
     if network_diagram_path and os.path.exists(network_diagram_path):
         try:
-            with open(network_diagram_path, 'rb') as f:
-                img_diagram = MIMEImage(f.read())
-                img_diagram.add_header('Content-ID', '<network_diagram>')
-                msg_related.attach(img_diagram)
+            msg_related.attach(cached_mime_part(network_diagram_path, content_id='network_diagram'))
         except Exception as e:
             logging.error(f"[{firewall_id}] Lỗi khi nhúng sơ đồ mạng: {e}")
 
@@ -198,36 +460,44 @@ def send_email(firewall_id, subject, body_html, config, recipient_emails_str, at
         for file_path in attachment_paths:
             if os.path.exists(file_path):
                 try:
-                    with open(file_path, 'rb') as attachment:
-                        part = MIMEApplication(attachment.read(), Name=os.path.basename(file_path))
-                    part['Content-Disposition'] = f'attachment; filename="{os.path.basename(file_path)}"'
-                    msg.attach(part)
+                    msg.attach(cached_mime_part(file_path, attachment=True))
                     logging.info(f"[{firewall_id}] Đã đính kèm file: '{file_path}'")
                 except Exception as e:
                     logging.error(f"[{firewall_id}] Lỗi khi đính kèm file '{file_path}': {e}")
             else:
                 logging.warning(f"[{firewall_id}] File đính kèm '{file_path}' không tồn tại.")
 
-    # Gửi email
+    # Ghi vào hàng đợi rồi gửi qua kết nối SMTP dùng chung; nếu lỗi, email nằm lại trong spool để thử lại sau
     try:
-        server = smtplib.SMTP(config.get('Email', 'SMTPServer'), config.getint('Email', 'SMTPPort'))
-        server.starttls()
-        server.login(sender_email, sender_password)
-        server.sendmail(sender_email, recipient_emails_list, msg.as_string())
-        server.quit()
-        logging.info(f"[{firewall_id}] Email đã được gửi thành công!")
+        outbox = get_mail_outbox(config)
+        outbox.enqueue(firewall_id, msg, sender_email, recipient_emails_list)
+        outbox.flush()
     except Exception as e:
         logging.error(f"[{firewall_id}] Lỗi khi gửi email: {e}")
 
-def read_bonus_context_files(config, firewall_section):
-    """Đọc tất cả các file bối cảnh được định nghĩa trong section của firewall."""
+def load_firewall_ip_enricher(config, firewall_section):
+    """Dựng bảng nhãn IP từ file config.xml của pfSense nằm trong danh sách file bối cảnh của firewall (nếu có)."""
+    for key in config.options(firewall_section):
+        if key in STANDARD_CONFIG_KEYS:
+            continue
+        file_path = config.get(firewall_section, key).strip()
+        if not file_path.lower().endswith('.xml') or not os.path.exists(file_path):
+            continue
+        try:
+            enricher = load_ip_enricher(file_path)
+        except Exception as e:
+            logging.error(f"[{firewall_section}] Lỗi khi dựng bảng nhãn IP từ '{file_path}': {e}")
+            continue
+        if enricher is not None:
+            return enricher
+    return None
+
+def read_bonus_context_files(config, firewall_section, relevant_ips=None, relevant_names=None, ip_enricher=None):
+    """Lấy bối cảnh từ các file được định nghĩa trong section của firewall, chỉ giữ phần liên quan tới cửa sổ log."""
     context_parts = []
+    cache_dir = config.get('System', 'ContextCacheDirectory', fallback=CONTEXT_CACHE_DIR)
     
-    standard_keys = ['pfsensehostname', 'logfile', 'hourstoanalyze', 'timezone', 
-                     'reportdirectory', 'recipientemails', 'summary_enabled', 
-                     'reports_per_summary', 'summary_recipient_emails',
-                     'prompt_file', 'summary_prompt_file']
-    context_keys = [key for key in config.options(firewall_section) if key not in standard_keys]
+    context_keys = [key for key in config.options(firewall_section) if key not in STANDARD_CONFIG_KEYS]
 
     if not context_keys:
         return "Không có thông tin bối cảnh bổ sung nào được cung cấp."
@@ -236,20 +506,27 @@ def read_bonus_context_files(config, firewall_section):
         file_path = config.get(firewall_section, key).strip()
         if os.path.exists(file_path):
             try:
-                logging.info(f"[{firewall_section}] Đang đọc file bối cảnh: '{file_path}'")
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    content = f.read()
-                    file_name = os.path.basename(file_path)
-                    context_parts.append(f"--- START OF FILE: {file_name} ---\n{content}\n--- END OF FILE: {file_name} ---")
+                sections = load_context_sections(file_path, cache_dir)
+                selected = select_relevant_sections(sections, relevant_ips, relevant_names)
+                if ip_enricher is not None:
+                    # Alias host/network và static map đã có trong nhãn IP của phần thống kê, không gửi lặp lại;
+                    # alias port/URL không được gắn nhãn nên vẫn giữ
+                    selected = [s for s in selected if s["title"] not in ip_enricher.labelled_sections]
+                if not selected:
+                    continue
+                file_name = os.path.basename(file_path)
+                content = "\n".join(section["text"] for section in selected)
+                context_parts.append(f"--- START OF FILE: {file_name} ---\n{content}\n--- END OF FILE: {file_name} ---")
             except Exception as e:
                 logging.error(f"[{firewall_section}] Lỗi khi đọc file bối cảnh '{file_path}': {e}")
         else:
             logging.warning(f"[{firewall_section}] File bối cảnh '{file_path}' không tồn tại. Bỏ qua.")
-            
+
+    logging.info(f"[{firewall_section}] Bối cảnh bổ sung: {len(context_parts)} file, {sum(len(p) for p in context_parts)} ký tự.")
     return "\n\n".join(context_parts) if context_parts else "Không có thông tin bối cảnh bổ sung nào được cung cấp."
 
 def save_structured_report(firewall_id, report_data, timezone_str, base_report_dir, is_summary=False):
-    """Lưu dữ liệu thô ra file JSON, có tổ chức theo thư mục."""
+    """Lưu dữ liệu thô ra file JSON, có tổ chức theo thư mục, và ghi vào chỉ mục báo cáo."""
     try:
         tz = pytz.timezone(timezone_str)
         now = datetime.now(tz)
@@ -262,25 +539,40 @@ def save_structured_report(firewall_id, report_data, timezone_str, base_report_d
         
         report_file_path = os.path.join(report_folder_path, time_filename)
 
-        with open(report_file_path, 'w', encoding='utf-8') as f:
+        temp_file_path = f"{report_file_path}.tmp"
+        with open(temp_file_path, 'w', encoding='utf-8') as f:
             json.dump(report_data, f, ensure_ascii=False, indent=4)
+        os.replace(temp_file_path, report_file_path)
+        get_report_index().add_report(firewall_id, report_file_path, report_data, is_summary)
+        set_cycle_report(firewall_id, report_file_path)
         logging.info(f"[{firewall_id}] Đã lưu báo cáo JSON vào: '{report_file_path}'")
+        return report_file_path
             
     except Exception as e:
         logging.error(f"[{firewall_id}] Lỗi khi lưu file JSON: {e}")
+        return None
 
 # --- hàm chu kỳ ---
 
+@instrumented_cycle("analysis")
 def run_analysis_cycle(config, firewall_section):
     """Chạy một chu kỳ phân tích định kỳ cho một firewall cụ thể."""
     logging.info(f"[{firewall_section}] Bắt đầu chu kỳ phân tích log.")
     
-    log_file = config.get(firewall_section, 'LogFile')
+    log_file = config.get(firewall_section, 'LogFile', fallback=None)
     hours = config.getint(firewall_section, 'HoursToAnalyze')
     hostname = config.get(firewall_section, 'PFSenseHostname')
     timezone = config.get(firewall_section, 'TimeZone')
     report_dir = config.get(firewall_section, 'ReportDirectory')
     recipient_emails = config.get(firewall_section, 'RecipientEmails')
+    seek_mode = config.get(firewall_section, 'LogSeekMode', fallback='bisect').strip().lower()
+    sample_limit = config.getint(firewall_section, 'FilterlogSampleLines', fallback=50)
+    token_budget = config.getint(firewall_section, 'PromptTokenBudget', fallback=60000)
+    map_reduce_min_lines = config.getint(firewall_section, 'MapReduceMinLines', fallback=200000)
+    map_reduce_chunks = config.getint(firewall_section, 'MapReduceChunks', fallback=4)
+    baseline_threshold = config.getfloat(firewall_section, 'BaselineSkipThreshold', fallback=3.0)
+    baseline_warmup = config.getint(firewall_section, 'BaselineWarmupWindows', fallback=24)
+    baseline_alpha = config.getfloat(firewall_section, 'BaselineAlpha', fallback=0.1)
     
     # Lấy đường dẫn prompt từ config, nếu không có thì dùng mặc định 
     prompt_file = config.get(firewall_section, 'prompt_file', fallback=PROMPT_TEMPLATE_FILE)
@@ -291,31 +583,134 @@ def run_analysis_cycle(config, firewall_section):
         logging.error(f"[{firewall_section}] Lỗi: 'APIKey' chưa được thiết lập. Bỏ qua.")
         return
     
-    logs_content, start_time, end_time = read_new_log_entries(log_file, hours, timezone, firewall_section)
+    with cycle_span(firewall_section, "read_logs") as span:
+        if config.get(firewall_section, 'LogSource', fallback='file').strip().lower() == 'syslog':
+            logs_content, start_time, end_time = read_syslog_entries(hours, timezone, firewall_section)
+            window_parts = None
+        else:
+            archive_workers = config.getint('System', 'ArchiveWorkers', fallback=2)
+            scan_workers = config.getint('System', 'ScanWorkers', fallback=os.cpu_count() or 1)
+            logs_content, start_time, end_time, window_parts = read_new_log_entries(
+                log_file, hours, timezone, firewall_section, seek_mode, archive_workers, scan_workers, sample_limit)
+        if logs_content is not None:
+            # Log syslog gần như toàn ASCII nên số ký tự xấp xỉ số byte, không cần encode lại cả cửa sổ
+            if window_parts is None:
+                log_lines = logs_content.splitlines(keepends=True)
+                log_bytes, line_count = len(logs_content), len(log_lines)
+            else:
+                # Quét song song: chỉ có kết quả tổng hợp của từng phần, không có văn bản log
+                log_lines = None
+                log_bytes = sum(part["bytes"] for part in window_parts)
+                line_count = sum(part["aggregator"].total_lines for part in window_parts)
+            span.update(bytes=log_bytes, lines=line_count)
+            record(firewall_section, log_bytes=log_bytes, log_lines=line_count)
     if logs_content is None:
         logging.error(f"[{firewall_section}] Không thể tiếp tục do lỗi đọc file log.")
         return
 
-    bonus_context = read_bonus_context_files(config, firewall_section)
-    #Truyền đường dẫn prompt đã lấy được vào hàm phân tích
-    analysis_raw = analyze_logs_with_gemini(firewall_section, logs_content, bonus_context, gemini_api_key, prompt_file)
+    # Tổng hợp thống kê chính xác tại chỗ, chỉ gửi thống kê + log tiêu biểu cho Gemini
+    with cycle_span(firewall_section, "aggregate") as span:
+        # Quét song song đã tổng hợp sẵn trong các process con, chỉ còn phải gộp
+        if window_parts is None:
+            aggregator, prompt_lines = aggregate_log_lines(log_lines, sample_limit)
+        else:
+            aggregator, prompt_lines = merge_window_parts(window_parts, sample_limit)
+        aggregator.ip_enricher = load_firewall_ip_enricher(config, firewall_section)
+        local_stats = aggregator.summary_stats()
+        span.update(lines=aggregator.total_lines, prompt_lines=len(prompt_lines))
+    logging.info(f"[{firewall_section}] Thống kê tại chỗ: {local_stats['total_blocked_events']} sự kiện bị chặn, "
+                 f"giữ lại {len(prompt_lines)}/{aggregator.total_lines} dòng log cho prompt.")
+
+    # So sánh tốc độ sự kiện với baseline của firewall: cửa sổ yên tĩnh không cần gọi Gemini
+    with cycle_span(firewall_section, "baseline") as span:
+        report_index = get_report_index()
+        baseline = load_baseline(report_index, firewall_section, baseline_alpha)
+        window_hours = (end_time - start_time).total_seconds() / 3600
+        window_vector, max_abs_z, anomalies = evaluate_window(baseline, aggregator, window_hours, baseline_threshold)
+        if baseline_threshold <= 0 or baseline.windows < baseline_warmup:
+            # Tắt so sánh baseline (ngưỡng <= 0) hoặc baseline chưa đủ dữ liệu: điểm z chưa có ý nghĩa,
+            # không đưa bất thường nào vào prompt
+            anomalies = []
+        llm_skipped = (baseline_threshold > 0 and baseline.windows >= baseline_warmup
+                       and aggregator.total_lines > 0 and not anomalies)
+        span.update(anomaly_score=round(max_abs_z, 2), anomalies=len(anomalies), llm_skipped=llm_skipped)
+    highlight = anomalies_prompt_text(anomalies, max_abs_z) if anomalies else ""
+    logging.info(f"[{firewall_section}] Baseline ({baseline.windows} cửa sổ): điểm z cao nhất {max_abs_z:.1f}, "
+                 f"{len(anomalies)} bất thường.")
+
+    if llm_skipped:
+        logging.info(f"[{firewall_section}] Cửa sổ yên tĩnh so với baseline, tạo báo cáo tại chỗ và bỏ qua Gemini.")
+        record(firewall_section, llm_skipped=1)
+        analysis_raw = quiet_window_report(aggregator, max_abs_z, baseline_threshold, baseline.windows)
+    else:
+        with cycle_span(firewall_section, "context") as span:
+            relevant_ips, relevant_names = aggregator.relevant_entities()
+            bonus_context = read_bonus_context_files(config, firewall_section, relevant_ips, relevant_names,
+                                                     ip_enricher=aggregator.ip_enricher)
+            span.update(chars=len(bonus_context))
+        if map_reduce_min_lines and aggregator.total_lines >= map_reduce_min_lines:
+            # Cửa sổ lớn: chia theo thời gian, phân tích song song rồi gộp
+            with cycle_span(firewall_section, "gemini_map_reduce") as span:
+                if window_parts is None:
+                    chunks = aggregate_log_chunks(log_lines, map_reduce_chunks, sample_limit)
+                else:
+                    chunks = window_part_chunks(window_parts, map_reduce_chunks, sample_limit)
+                analysis_raw = analyze_logs_map_reduce(firewall_section, chunks, aggregator, bonus_context, gemini_api_key,
+                                                       prompt_file, token_budget, highlight)
+                span.update(chunks=len(chunks))
+        else:
+            with cycle_span(firewall_section, "build_prompt") as span:
+                prompt_content = logs_content
+                if aggregator.total_lines and (window_parts is not None or logs_content.strip()):
+                    prompt_content, compaction_stats = build_compacted_prompt_content(aggregator, prompt_lines, token_budget)
+                    logging.info(f"[{firewall_section}] Nén log: {compaction_stats['templates']} template, "
+                                 f"{compaction_stats['rare_lines']} dòng hiếm, ~{compaction_stats['estimated_tokens']} token "
+                                 f"(ngân sách {token_budget}).")
+                    if highlight:
+                        # Đặt bất thường lên đầu để mô hình ưu tiên phân tích
+                        prompt_content = f"{highlight}\n\n{prompt_content}"
+                span.update(chars=len(prompt_content), estimated_tokens=estimate_tokens(prompt_content))
+            #Truyền đường dẫn prompt đã lấy được vào hàm phân tích
+            with cycle_span(firewall_section, "gemini"):
+                analysis_raw = analyze_logs_with_gemini(firewall_section, prompt_content, bonus_context, gemini_api_key, prompt_file)
+
+    if aggregator.total_lines > 0:
+        # Cửa sổ rỗng (thường do lỗi nguồn log) không được kéo baseline về 0
+        baseline.update(window_vector)
+        try:
+            save_baseline(report_index, firewall_section, baseline)
+        except Exception as e:
+            logging.error(f"[{firewall_section}] Lỗi khi lưu baseline: {e}")
 
     summary_data = {"total_blocked_events": "N/A", "top_blocked_source_ip": "N/A", "alerts_count": "N/A"}
     analysis_markdown = analysis_raw
-    try:
-        json_match = re.search(r'```json\n(.*?)\n```', analysis_raw, re.DOTALL)
-        if json_match:
-            summary_data = json.loads(json_match.group(1))
-            analysis_markdown = analysis_raw.replace(json_match.group(0), "").strip()
-    except Exception as e:
-        logging.warning(f"[{firewall_section}] Không thể trích xuất JSON: {e}")
+    with cycle_span(firewall_section, "json_extract") as span:
+        try:
+            json_match = re.search(r'```json\n(.*?)\n```', analysis_raw, re.DOTALL)
+            if json_match:
+                summary_data = json.loads(json_match.group(1))
+                analysis_markdown = analysis_raw.replace(json_match.group(0), "").strip()
+        except Exception as e:
+            logging.warning(f"[{firewall_section}] Không thể trích xuất JSON: {e}")
+        span.update(response_chars=len(analysis_raw))
+    # Số liệu đếm được tại chỗ luôn chính xác hơn số liệu do mô hình ước lượng
+    summary_data.update(local_stats)
+    if llm_skipped:
+        summary_data["alerts_count"] = 0
+    summary_data.update({"anomaly_score": round(max_abs_z, 2), "anomalies": anomalies, "llm_skipped": llm_skipped})
 
     report_data = {
         "hostname": hostname, "analysis_start_time": start_time.isoformat(), "analysis_end_time": end_time.isoformat(),
         "report_generated_time": datetime.now(pytz.timezone(timezone)).isoformat(),
         "summary_stats": summary_data, "analysis_details_markdown": analysis_markdown
     }
-    save_structured_report(firewall_section, report_data, timezone, report_dir)
+    with cycle_span(firewall_section, "save_report"):
+        report_path = save_structured_report(firewall_section, report_data, timezone, report_dir)
+        if report_path:
+            try:
+                save_report_sketch(report_path, ReportSketch.from_aggregator(aggregator))
+            except Exception as e:
+                logging.error(f"[{firewall_section}] Lỗi khi lưu sketch của báo cáo: {e}")
 
     email_subject = f"Báo cáo Log pfSense [{hostname}] - {datetime.now(pytz.timezone(timezone)).strftime('%Y-%m-%d %H:%M')}"
     try:
@@ -332,16 +727,17 @@ def run_analysis_cycle(config, firewall_section):
         
         attachments_to_send = []
         if config.getboolean('Attachments', 'AttachContextFiles', fallback=False):
-            standard_keys = ['pfsensehostname', 'logfile', 'hourstoanalyze', 'timezone', 'reportdirectory', 'recipientemails', 'summary_enabled', 'reports_per_summary', 'summary_recipient_emails', 'prompt_file', 'summary_prompt_file']
-            context_keys = [key for key in config.options(firewall_section) if key not in standard_keys]
+            context_keys = [key for key in config.options(firewall_section) if key not in STANDARD_CONFIG_KEYS]
             attachments_to_send = [config.get(firewall_section, key) for key in context_keys]
 
-        send_email(firewall_section, email_subject, email_body, config, recipient_emails, attachment_paths=attachments_to_send)
+        with cycle_span(firewall_section, "email"):
+            send_email(firewall_section, email_subject, email_body, config, recipient_emails, attachment_paths=attachments_to_send)
     except Exception as e:
         logging.error(f"[{firewall_section}] Lỗi khi tạo/gửi email: {e}")
 
     logging.info(f"[{firewall_section}] Hoàn tất chu kỳ phân tích.")
 
+@instrumented_cycle("summary")
 def run_summary_analysis_cycle(config, firewall_section):
     """Chạy một chu kỳ phân tích TỔNG HỢP cho một firewall."""
     logging.info(f"[{firewall_section}] Bắt đầu chu kỳ phân tích TỔNG HỢP.")
@@ -356,48 +752,83 @@ def run_summary_analysis_cycle(config, firewall_section):
     # Lấy đường dẫn summary prompt từ config
     summary_prompt_file = config.get(firewall_section, 'summary_prompt_file', fallback=SUMMARY_PROMPT_TEMPLATE_FILE)
 
-    report_files_pattern = os.path.join(report_dir, "*", "*.json")
-    all_reports = sorted(glob.glob(report_files_pattern), key=os.path.getmtime, reverse=True)
-    
-    reports_to_summarize = [r for r in all_reports if "summary" not in r][:reports_per_summary]
-    if not reports_to_summarize:
-        logging.warning(f"[{firewall_section}] Không tìm thấy file báo cáo nào để tổng hợp.")
-        return
+    with cycle_span(firewall_section, "load_reports") as span:
+        index = get_report_index()
+        reports = list(reversed(index.last_reports(firewall_section, reports_per_summary)))
+        reports_to_summarize = [r["path"] for r in reports]
+        if not reports_to_summarize:
+            logging.warning(f"[{firewall_section}] Không tìm thấy file báo cáo nào để tổng hợp.")
+            return
 
-    logging.info(f"[{firewall_section}] Sẽ tổng hợp từ {len(reports_to_summarize)} báo cáo: {reports_to_summarize}")
+        logging.info(f"[{firewall_section}] Sẽ tổng hợp từ {len(reports_to_summarize)} báo cáo: {reports_to_summarize}")
 
-    combined_analysis, start_time, end_time = [], None, None
-    for report_path in reversed(reports_to_summarize):
-        try:
-            with open(report_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                combined_analysis.append(f"--- BÁO CÁO TỪ {data['analysis_start_time']} ĐẾN {data['analysis_end_time']} ---\n\n{data['analysis_details_markdown']}")
-                
-                s_time = datetime.fromisoformat(data['analysis_start_time'])
-                e_time = datetime.fromisoformat(data['analysis_end_time'])
+        # Gộp sketch của từng báo cáo (O(số báo cáo)); chỉ báo cáo cũ chưa có sketch mới cần đọc lại nội dung
+        tz = pytz.timezone(timezone)
+        merged_sketch = ReportSketch()
+        timeline, legacy_analysis, legacy_blocked, total_alerts = [], [], 0, None
+        start_time, end_time = None, None
+        for report in reports:
+            stats = report["stats"]
+            if report["start_time"] is not None:
+                s_time = datetime.fromtimestamp(report["start_time"], tz)
                 if start_time is None or s_time < start_time: start_time = s_time
+            if report["end_time"] is not None:
+                e_time = datetime.fromtimestamp(report["end_time"], tz)
                 if end_time is None or e_time > end_time: end_time = e_time
-        except Exception as e:
-            logging.error(f"[{firewall_section}] Lỗi khi đọc file '{report_path}': {e}")
+            if isinstance(stats.get("alerts_count"), int):
+                total_alerts = (total_alerts or 0) + stats["alerts_count"]
+            period = (f"{datetime.fromtimestamp(report['start_time'], tz).strftime('%Y-%m-%d %H:%M')} -> "
+                      f"{datetime.fromtimestamp(report['end_time'], tz).strftime('%Y-%m-%d %H:%M')}") if report["start_time"] and report["end_time"] else "N/A"
+            timeline.append(f"- {period}: bị chặn {stats.get('total_blocked_events', 'N/A')}, "
+                            f"IP bị chặn nhiều nhất {stats.get('top_blocked_source_ip', 'N/A')}, cảnh báo {stats.get('alerts_count', 'N/A')}")
 
-    if not combined_analysis:
-        logging.error(f"[{firewall_section}] Không thể đọc nội dung từ bất kỳ file nào.")
-        return
+            sketch = load_report_sketch(report["path"])
+            if sketch:
+                merged_sketch.merge(sketch)
+                continue
+            if isinstance(stats.get("total_blocked_events"), int):
+                legacy_blocked += stats["total_blocked_events"]
+            try:
+                with open(report["path"], 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                legacy_analysis.append(f"--- BÁO CÁO TỪ {data['analysis_start_time']} ĐẾN {data['analysis_end_time']} ---\n\n{data['analysis_details_markdown']}")
+            except Exception as e:
+                logging.error(f"[{firewall_section}] Lỗi khi đọc file '{report['path']}': {e}")
 
-    reports_content = "\n\n".join(combined_analysis)
-    bonus_context = read_bonus_context_files(config, firewall_section)
+        content_parts = []
+        if merged_sketch.reports:
+            content_parts.append(merged_sketch.to_prompt_text())
+        content_parts.append("--- DIỄN BIẾN THEO TỪNG BÁO CÁO ---\n" + "\n".join(timeline))
+        if legacy_analysis:
+            content_parts.append("--- CÁC BÁO CÁO CŨ CHƯA CÓ SỐ LIỆU GỘP ---\n\n" + "\n\n".join(legacy_analysis))
+        reports_content = "\n\n".join(content_parts)
+        logging.info(f"[{firewall_section}] Đã gộp sketch của {merged_sketch.reports}/{len(reports)} báo cáo.")
+        span.update(reports=len(reports), sketches=merged_sketch.reports, chars=len(reports_content))
+
+    with cycle_span(firewall_section, "context") as span:
+        bonus_context = read_bonus_context_files(config, firewall_section)
+        span.update(chars=len(bonus_context))
     # đường dẫn summary prompt 
-    summary_raw = analyze_logs_with_gemini(firewall_section, reports_content, bonus_context, gemini_api_key, summary_prompt_file)
+    with cycle_span(firewall_section, "gemini"):
+        summary_raw = analyze_logs_with_gemini(firewall_section, reports_content, bonus_context, gemini_api_key, summary_prompt_file)
 
     summary_data = {"total_blocked_events_period": "N/A", "most_frequent_issue": "N/A", "total_alerts_period": "N/A"}
     analysis_markdown = summary_raw
-    try:
-        json_match = re.search(r'```json\n(.*?)\n```', summary_raw, re.DOTALL)
-        if json_match:
-            summary_data = json.loads(json_match.group(1))
-            analysis_markdown = summary_raw.replace(json_match.group(0), "").strip()
-    except Exception as e:
-        logging.warning(f"[{firewall_section}] Không thể trích xuất JSON tổng hợp: {e}")
+    with cycle_span(firewall_section, "json_extract") as span:
+        try:
+            json_match = re.search(r'```json\n(.*?)\n```', summary_raw, re.DOTALL)
+            if json_match:
+                summary_data = json.loads(json_match.group(1))
+                analysis_markdown = summary_raw.replace(json_match.group(0), "").strip()
+        except Exception as e:
+            logging.warning(f"[{firewall_section}] Không thể trích xuất JSON tổng hợp: {e}")
+        span.update(response_chars=len(summary_raw))
+    # Tổng số liệu của giai đoạn được tính chính xác tại chỗ từ sketch và chỉ mục
+    period_stats = merged_sketch.summary_stats()
+    period_stats["total_blocked_events_period"] += legacy_blocked
+    if total_alerts is not None:
+        period_stats["total_alerts_period"] = total_alerts
+    summary_data.update(period_stats)
 
     report_data = {
         "hostname": hostname, "analysis_start_time": start_time.isoformat() if start_time else "N/A",
@@ -406,7 +837,8 @@ def run_summary_analysis_cycle(config, firewall_section):
         "summary_stats": summary_data, "analysis_details_markdown": analysis_markdown,
         "summarized_files": reports_to_summarize
     }
-    save_structured_report(firewall_section, report_data, timezone, report_dir, is_summary=True)
+    with cycle_span(firewall_section, "save_report"):
+        save_structured_report(firewall_section, report_data, timezone, report_dir, is_summary=True)
 
     email_subject = f"Báo cáo TỔNG HỢP Log pfSense [{hostname}] - {datetime.now(pytz.timezone(timezone)).strftime('%Y-%m-%d')}"
     try:
@@ -420,55 +852,174 @@ def run_summary_analysis_cycle(config, firewall_section):
             start_time=start_time.strftime('%H:%M:%S %d-%m-%Y') if start_time else "N/A",
             end_time=end_time.strftime('%H:%M:%S %d-%m-%Y') if end_time else "N/A"
         )
-        send_email(firewall_section, email_subject, email_body, config, recipient_emails, attachment_paths=reports_to_summarize)
+        with cycle_span(firewall_section, "email"):
+            send_email(firewall_section, email_subject, email_body, config, recipient_emails, attachment_paths=reports_to_summarize)
     except Exception as e:
         logging.error(f"[{firewall_section}] Lỗi khi tạo/gửi email tổng hợp: {e}")
 
     logging.info(f"[{firewall_section}] Hoàn tất chu kỳ TỔNG HỢP.")
 
 
-def main():
-    while True:
-        config = configparser.ConfigParser(interpolation=None)
-        if not os.path.exists(CONFIG_FILE):
-            logging.error(f"Lỗi: File cấu hình '{CONFIG_FILE}' không tồn tại. Thoát.")
-            return
-        config.read(CONFIG_FILE)
+def get_section_timeout(config, section):
+    """Thời gian tối đa (giây) cho một lần xử lý firewall, mặc định gấp đôi chu kỳ chạy."""
+    interval, _ = get_section_schedule(config, section)
+    return config.getint(section, 'SectionTimeoutSeconds', fallback=interval * 2)
 
-        firewall_sections = [s for s in config.sections() if s.startswith('Firewall_')]
-        if not firewall_sections:
-            logging.warning("Không tìm thấy section firewall nào (ví dụ: [Firewall_...]) trong config.ini. Sẽ không có gì được thực thi.")
+def process_firewall(config, section):
+    """Chạy chu kỳ phân tích (và chu kỳ tổng hợp nếu đến hạn) cho một firewall."""
+    logging.info(f"--- BẮT ĐẦU XỬ LÝ CHO FIREWALL: {section} ---")
+    # Mỗi bước của chu kỳ và mỗi lần gọi Gemini kiểm tra hạn chót này, quá hạn thì ném SectionTimeout
+    set_section_deadline(section, get_section_timeout(config, section))
+    try:
+        # Lần đầu sau khi nâng cấp: nhập các báo cáo cũ trên đĩa vào chỉ mục trước khi thêm báo cáo mới,
+        # để chu kỳ tổng hợp đầu tiên vẫn gộp đủ reports_per_summary báo cáo
+        get_report_index().import_report_directory(section, config.get(section, 'ReportDirectory'))
+        run_analysis_cycle(config, section)
+        
+        if config.getboolean(section, 'summary_enabled', fallback=False):
+            reports_per_summary = config.getint(section, 'reports_per_summary')
+            current_count = get_summary_count(section) + 1
+            
+            logging.info(f"[{section}] Đếm báo cáo tổng hợp: {current_count}/{reports_per_summary}")
+            
+            if current_count >= reports_per_summary:
+                logging.info(f"[{section}] Đạt ngưỡng, bắt đầu tạo báo cáo tổng hợp.")
+                run_summary_analysis_cycle(config, section)
+                save_summary_count(0, section)
+            else:
+                save_summary_count(current_count, section)
         else:
-            logging.info(f"Phát hiện {len(firewall_sections)} firewall để xử lý: {firewall_sections}")
+            if get_summary_count(section):
+                save_summary_count(0, section)
 
-        for section in firewall_sections:
-            logging.info(f"--- BẮT ĐẦU XỬ LÝ CHO FIREWALL: {section} ---")
-            try:
-                run_analysis_cycle(config, section)
-                
-                if config.getboolean(section, 'summary_enabled', fallback=False):
-                    reports_per_summary = config.getint(section, 'reports_per_summary')
-                    current_count = get_summary_count(section) + 1
-                    
-                    logging.info(f"[{section}] Đếm báo cáo tổng hợp: {current_count}/{reports_per_summary}")
-                    
-                    if current_count >= reports_per_summary:
-                        logging.info(f"[{section}] Đạt ngưỡng, bắt đầu tạo báo cáo tổng hợp.")
-                        run_summary_analysis_cycle(config, section)
-                        save_summary_count(0, section)
-                    else:
-                        save_summary_count(current_count, section)
-                else:
-                    if os.path.exists(f".summary_report_count_{section}"):
-                        save_summary_count(0, section)
+    except SectionTimeout as e:
+        logging.error(f"[{section}] Hủy xử lý firewall do quá thời gian: {e}")
+    except Exception as e:
+        logging.error(f"Lỗi nghiêm trọng khi xử lý firewall '{section}': {e}", exc_info=True)
+    finally:
+        set_section_deadline(section, None)
+    if get_response_cache():
+        log_cache_stats(get_response_cache())
+    logging.info(f"--- KẾT THÚC XỬ LÝ CHO FIREWALL: {section} ---")
 
-            except Exception as e:
-                logging.error(f"Lỗi nghiêm trọng khi xử lý firewall '{section}': {e}", exc_info=True)
-            logging.info(f"--- KẾT THÚC XỬ LÝ CHO FIREWALL: {section} ---")
-        
-        interval_seconds = config.getint('System', 'RunIntervalSeconds', fallback=3600)
-        logging.info(f"Tất cả các firewall đã được xử lý. Chu kỳ tiếp theo sẽ bắt đầu sau {interval_seconds} giây.")
-        time.sleep(interval_seconds)
+def load_config():
+    """Đọc file cấu hình, trả về None nếu file không tồn tại."""
+    if not os.path.exists(CONFIG_FILE):
+        logging.error(f"Lỗi: File cấu hình '{CONFIG_FILE}' không tồn tại. Thoát.")
+        return None
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(CONFIG_FILE)
+
+    firewall_sections = [s for s in config.sections() if s.startswith('Firewall_')]
+    if not firewall_sections:
+        logging.warning("Không tìm thấy section firewall nào (ví dụ: [Firewall_...]) trong config.ini. Sẽ không có gì được thực thi.")
+    else:
+        logging.info(f"Phát hiện {len(firewall_sections)} firewall để xử lý: {firewall_sections}")
+    return config
+
+def get_section_schedule(config, section):
+    """Lấy chu kỳ chạy và độ lệch ngẫu nhiên (jitter) của một firewall, mặc định theo section [System]."""
+    interval = config.getint(section, 'RunIntervalSeconds',
+                             fallback=config.getint('System', 'RunIntervalSeconds', fallback=3600))
+    jitter = config.getint(section, 'RunJitterSeconds',
+                           fallback=config.getint('System', 'RunJitterSeconds', fallback=0))
+    return interval, jitter
+
+def create_response_cache(config):
+    """Tạo cache phản hồi LLM từ section [Gemini], trả về None nếu bị tắt."""
+    if not config.getboolean('Gemini', 'ResponseCacheEnabled', fallback=True):
+        return None
+    return ResponseCache(config.get('Gemini', 'ResponseCacheDirectory', fallback=RESPONSE_CACHE_DIR),
+                         ttl_seconds=config.getint('Gemini', 'ResponseCacheTTLSeconds', fallback=7 * 24 * 3600),
+                         max_entries=config.getint('Gemini', 'ResponseCacheMaxEntries', fallback=2000),
+                         max_bytes=config.getint('Gemini', 'ResponseCacheMaxMB', fallback=200) * 1024 * 1024,
+                         ignore_timestamps=config.getboolean('Gemini', 'ResponseCacheIgnoreTimestamps', fallback=True))
+
+def main():
+    config = load_config()
+    if config is None:
+        return
+    config_mtime = os.path.getmtime(CONFIG_FILE)
+    configure_report_index(config.get('System', 'ReportIndexFile', fallback=DEFAULT_INDEX_FILE))
+
+    max_workers = config.getint('System', 'MaxWorkers', fallback=4)
+    configure_gemini(max_concurrent_calls=config.getint('System', 'MaxConcurrentGeminiCalls', fallback=2),
+                     requests_per_minute=config.getint('Gemini', 'RequestsPerMinute', fallback=60),
+                     model_name=config.get('Gemini', 'Model', fallback=DEFAULT_MODEL_NAME),
+                     max_retries=config.getint('Gemini', 'MaxRetries', fallback=4),
+                     response_cache=create_response_cache(config))
+    outbox = configure_mail_outbox(config)
+    configure_metrics(config)
+    if config.getboolean('Syslog', 'Enabled', fallback=False):
+        start_syslog_receiver(config)
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='firewall')
+    logging.info(f"Bộ lập lịch khởi động với {max_workers} worker.")
+
+    # abandoned: lần xử lý đã bị hủy do quá hạn nhưng thread còn kẹt (vd: chờ I/O); firewall đó chỉ chạy lại khi nó kết thúc
+    next_run, running, abandoned = {}, {}, {}
+    next_mail_flush = 0
+    try:
+        while True:
+            # Tự nạp lại cấu hình khi file thay đổi; các chu kỳ đang chạy vẫn dùng cấu hình cũ
+            if os.path.exists(CONFIG_FILE) and os.path.getmtime(CONFIG_FILE) != config_mtime:
+                config_mtime = os.path.getmtime(CONFIG_FILE)
+                config = load_config() or config
+                outbox = configure_mail_outbox(config)
+                configure_metrics(config)
+                if get_syslog_receiver() is not None:
+                    get_syslog_receiver().update_routes(config)
+                elif config.getboolean('Syslog', 'Enabled', fallback=False):
+                    start_syslog_receiver(config)
+
+            now = time.monotonic()
+            # Thử gửi lại các email còn nằm trong spool (lỗi SMTP tạm thời ở chu kỳ trước)
+            if now >= next_mail_flush:
+                next_mail_flush = now + config.getint('Email', 'SpoolFlushIntervalSeconds', fallback=60)
+                if outbox.pending():
+                    executor.submit(outbox.flush)
+            firewall_sections = [s for s in config.sections() if s.startswith('Firewall_')]
+            for section in firewall_sections:
+                interval, jitter = get_section_schedule(config, section)
+                if section not in next_run:
+                    next_run[section] = now + random.uniform(0, jitter)
+
+                if section in abandoned:
+                    if not abandoned[section].done():
+                        continue
+                    del abandoned[section]
+                if section in running:
+                    future, started = running[section]
+                    if not future.done():
+                        # Chống chồng lấn: không chạy lại firewall khi chu kỳ trước chưa xong
+                        timeout = get_section_timeout(config, section)
+                        if now - started <= timeout:
+                            continue
+                        # Quá hạn: hủy chu kỳ (bước kế tiếp sẽ ném SectionTimeout), đánh dấu lỗi và giải phóng worker.
+                        # Thread Python không dừng cưỡng bức được nên pool cũ được bỏ lại cho thread đang kẹt,
+                        # các firewall khác và việc gửi lại email chạy trên pool mới
+                        logging.error(f"[{section}] Chu kỳ đã chạy quá {timeout} giây, hủy và giải phóng worker.")
+                        cancel_section(section)
+                        record(section, section_timeouts=1)
+                        abandoned[section] = future
+                        executor.shutdown(wait=False)
+                        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='firewall')
+                        for other, (other_future, _) in list(running.items()):
+                            # Chu kỳ còn xếp hàng ở pool cũ (chưa bắt đầu) chuyển sang pool mới
+                            if other_future.cancel():
+                                running[other] = (executor.submit(process_firewall, config, other), now)
+                    del running[section]
+                    if section in abandoned:
+                        continue
+
+                if now >= next_run[section]:
+                    next_run[section] = now + interval + random.uniform(0, jitter)
+                    running[section] = (executor.submit(process_firewall, config, section), now)
+                    logging.info(f"[{section}] Đã đưa vào hàng đợi. Lần chạy kế tiếp sau khoảng {interval} giây.")
+
+            time.sleep(SCHEDULER_TICK_SECONDS)
+    except KeyboardInterrupt:
+        logging.info("Nhận tín hiệu dừng, không nhận thêm chu kỳ mới.")
+        executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
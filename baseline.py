@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""Baseline thống kê theo firewall: chuỗi tốc độ sự kiện (EWMA trung bình/phương sai) và điểm bất thường z-score bằng NumPy."""
+
+import json
+
+import numpy as np
+
+BASELINE_STATE_KEY = "rate_baseline"
+MAX_BASELINE_KEYS = 5000
+MIN_WINDOW_HOURS = 1 / 60
+
+
+def _source_prefix(ip):
+    """Gom IPv4 theo /24 (IPv6 giữ nguyên 4 nhóm đầu, tương đương /64)."""
+    if '.' in ip:
+        return ip.rsplit('.', 1)[0] + ".0/24"
+    return ":".join(ip.split(':')[:4]) + "::/64"
+
+
+def window_rates(aggregator, window_hours):
+    """Vector đặc trưng của một cửa sổ: số sự kiện mỗi giờ theo (action, interface), (action, cổng), (action, nguồn /24)."""
+    hours = max(window_hours, MIN_WINDOW_HOURS)
+    counts = {}
+    for (action, interface), count in aggregator.filterlog['interface'].items():
+        counts[f"{action}|interface|{interface}"] = count
+    for (action, port), count in aggregator.filterlog['dst_port'].items():
+        counts[f"{action}|port|{port}"] = count
+    for (action, ip), count in aggregator.filterlog['src_ip'].items():
+        key = f"{action}|source|{_source_prefix(ip)}"
+        counts[key] = counts.get(key, 0) + count
+    for event, count in aggregator.openvpn_events.items():
+        counts[f"openvpn|event|{event}"] = count
+    for level, count in aggregator.unbound_levels.items():
+        counts[f"unbound|level|{level}"] = count
+    return {key: count / hours for key, count in counts.items()}
+
+
+class RateBaseline:
+    """Trung bình và phương sai EWMA cho từng chuỗi tốc độ, lưu thành mảng NumPy song song với danh sách khóa."""
+
+    def __init__(self, keys=None, mean=None, var=None, windows=0, alpha=0.1):
+        self.keys = list(keys or [])
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.mean = np.asarray(mean if mean is not None else [], dtype=np.float64)
+        self.var = np.asarray(var if var is not None else [], dtype=np.float64)
+        self.windows = windows
+        self.alpha = alpha
+
+    def _vector(self, rates):
+        """Thêm khóa mới (trung bình 0) và trả về vector tốc độ của cửa sổ theo thứ tự khóa."""
+        new_keys = [key for key in rates if key not in self.index]
+        if new_keys:
+            for key in new_keys:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+            self.mean = np.concatenate([self.mean, np.zeros(len(new_keys))])
+            self.var = np.concatenate([self.var, np.zeros(len(new_keys))])
+        vector = np.zeros(len(self.keys))
+        vector[[self.index[key] for key in rates]] = list(rates.values())
+        return vector
+
+    def score(self, rates, window_hours=1.0):
+        """Điểm z của cửa sổ so với baseline. Độ lệch chuẩn có sàn kiểu Poisson để chuỗi thưa không bị phóng đại.
+
+        Sàn Poisson áp dụng trên số sự kiện của cửa sổ (mean*hours) rồi đổi lại sang tốc độ: sqrt(mean*hours + 1)/hours.
+        """
+        x = self._vector(rates)
+        hours = max(window_hours, MIN_WINDOW_HOURS)
+        std = np.sqrt(np.maximum(self.var, (self.mean * hours + 1.0) / (hours * hours)))
+        return x, (x - self.mean) / std
+
+    def update(self, x):
+        """Cập nhật EWMA (vector hóa) với vector tốc độ của cửa sổ vừa phân tích."""
+        if self.windows == 0:
+            self.mean, self.var = x.copy(), np.zeros_like(x)
+        else:
+            delta = x - self.mean
+            self.mean = self.mean + self.alpha * delta
+            self.var = (1 - self.alpha) * (self.var + self.alpha * delta * delta)
+        self.windows += 1
+        self._prune()
+
+    def _prune(self):
+        """Giữ tối đa MAX_BASELINE_KEYS chuỗi có tốc độ trung bình lớn nhất để bộ nhớ/kích thước lưu trữ có giới hạn."""
+        if len(self.keys) <= MAX_BASELINE_KEYS:
+            return
+        keep = np.sort(np.argsort(self.mean)[-MAX_BASELINE_KEYS:])
+        self.keys = [self.keys[i] for i in keep]
+        self.index = {key: i for i, key in enumerate(self.keys)}
+        self.mean, self.var = self.mean[keep], self.var[keep]
+
+    def anomalies(self, x, z, threshold, min_rate=1.0, top_n=10):
+        """Các chuỗi có |z| >= threshold và tốc độ đáng kể, xếp theo |z| giảm dần."""
+        significant = (np.abs(z) >= threshold) & (np.maximum(x, self.mean) >= min_rate)
+        order = np.argsort(-np.abs(z))
+        return [{"series": self.keys[i], "rate_per_hour": round(float(x[i]), 2),
+                 "baseline_per_hour": round(float(self.mean[i]), 2), "z_score": round(float(z[i]), 2)}
+                for i in order[:top_n * 4] if significant[i]][:top_n]
+
+    def to_json(self):
+        return json.dumps({"keys": self.keys, "mean": self.mean.round(4).tolist(), "var": self.var.round(4).tolist(),
+                           "windows": self.windows})
+
+    @classmethod
+    def from_json(cls, value, alpha=0.1):
+        data = json.loads(value)
+        return cls(data["keys"], data["mean"], data["var"], data["windows"], alpha)
+
+
+def load_baseline(index, firewall_id, alpha=0.1):
+    """Đọc baseline của firewall từ chỉ mục báo cáo, baseline rỗng nếu chưa có hoặc hỏng."""
+    value = index.get_state(firewall_id, BASELINE_STATE_KEY)
+    if value:
+        try:
+            return RateBaseline.from_json(value, alpha)
+        except (ValueError, KeyError):
+            pass
+    return RateBaseline(alpha=alpha)
+
+
+def save_baseline(index, firewall_id, baseline):
+    index.set_state(firewall_id, BASELINE_STATE_KEY, baseline.to_json())
+
+
+def anomalies_prompt_text(anomalies, max_abs_z):
+    """Khối văn bản đặt đầu prompt để mô hình ưu tiên phân tích các bất thường."""
+    lines = [f"--- BẤT THƯỜNG SO VỚI BASELINE (ưu tiên phân tích trước; điểm z cao nhất: {max_abs_z:.1f}) ---"]
+    for anomaly in anomalies:
+        action, kind, value = anomaly["series"].split('|', 2)
+        lines.append(f"- [{action}] {kind} {value}: {anomaly['rate_per_hour']}/giờ "
+                     f"(baseline {anomaly['baseline_per_hour']}/giờ, z={anomaly['z_score']})")
+    lines.append("--- KẾT THÚC BẤT THƯỜNG ---")
+    return "\n".join(lines)
+
+
+def evaluate_window(baseline, aggregator, window_hours, threshold, min_rate=1.0):
+    """Chấm điểm một cửa sổ: trả về (vector tốc độ, |z| lớn nhất trên các chuỗi đáng kể, danh sách bất thường)."""
+    x, z = baseline.score(window_rates(aggregator, window_hours), window_hours)
+    relevant = np.maximum(x, baseline.mean) >= min_rate
+    max_abs_z = float(np.abs(z[relevant]).max()) if relevant.any() else 0.0
+    return x, max_abs_z, baseline.anomalies(x, z, threshold, min_rate)
+
+
+def quiet_window_report(aggregator, max_abs_z, threshold, baseline_windows, top_n=5):
+    """Báo cáo Markdown tạo tại chỗ cho cửa sổ yên tĩnh (không gọi Gemini), theo bố cục của prompt_template.md."""
+    def fmt(items):
+        return ", ".join(f"`{value}` ({count})" for value, count in items) if items else "không có"
+
+    stats = aggregator.summary_stats()
+    return "\n".join([
+        "**1. Tóm tắt và Đánh giá tổng quan**",
+        "",
+        f"Hệ thống ổn định: không có bất thường so với baseline của {baseline_windows} cửa sổ trước "
+        f"(điểm z cao nhất {max_abs_z:.1f} < ngưỡng {threshold}). Báo cáo được tạo tại chỗ, không gọi Gemini.",
+        "",
+        "**2. Phân tích Lưu lượng bị chặn (Blocked Traffic)**",
+        "",
+        f"*   Tổng số sự kiện bị chặn: `{stats['total_blocked_events']}`",
+        f"*   IP nguồn bị chặn nhiều nhất: {fmt(aggregator.top('src_ip', 'block', top_n))}",
+        f"*   Cổng đích bị chặn nhiều nhất: {fmt(aggregator.top('dst_port', 'block', top_n))}",
+        "",
+        "**3. Phân tích Lưu lượng được cho phép (Allowed Traffic)**",
+        "",
+        f"*   Tổng số sự kiện được cho phép: `{stats['total_passed_events']}`",
+        f"*   Cổng đích được cho phép nhiều nhất: {fmt(aggregator.top('dst_port', 'pass', top_n))}",
+        "",
+        "**4. Cảnh báo An ninh và Tình trạng Hệ thống**",
+        "",
+        f"*   OpenVPN xác thực thất bại: `{stats['openvpn_auth_failures']}`, sự kiện DHCP: `{stats['dhcp_events']}`, "
+        f"lỗi Unbound: `{stats['unbound_errors']}`",
+        "",
+        "**5. Đề xuất và Kiến nghị**",
+        "",
+        "*   Không cần hành động ngay. Tiếp tục theo dõi ở các chu kỳ sau.",
+    ])
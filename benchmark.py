@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Micro-benchmark cho các bước xử lý log của ai.py.
+
+Chạy: python benchmark.py --lines 500000
+      python benchmark.py --scan-mb 4096 --workers 16   (quét song song một filterlog tổng hợp ~4 GB)
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pytz
+
+import ai
+from parallel_scan import merge_window_parts, parallel_aggregate_file
+
+TIMEZONE = "Asia/Ho_Chi_Minh"
+SAMPLE_MESSAGE = "pfSense filterlog[4242]: 5,,,1000000103,igb1,match,block,in,4,0x0,,64,0,0,DF,6,tcp,60,203.0.113.7,192.168.1.10,51234,445,0,S,1,,64240,,mss\n"
+
+
+def generate_lines(count, end_time, span_hours=24):
+    """Sinh các dòng log syslog tăng dần theo thời gian, kết thúc tại end_time."""
+    start = end_time - timedelta(hours=span_hours)
+    step = timedelta(hours=span_hours) / max(count, 1)
+    return [f"{(start + step * i).strftime('%b %d %H:%M:%S')} {SAMPLE_MESSAGE}" for i in range(count)]
+
+
+def legacy_parse(line, tz, end_time):
+    """Cách parse cũ: strptime + tz.localize cho từng dòng."""
+    log_datetime_naive = datetime.strptime(f"{end_time.year} {line[:15]}", "%Y %b %d %H:%M:%S")
+    log_datetime_aware = tz.localize(log_datetime_naive)
+    if log_datetime_aware > end_time:
+        log_datetime_aware = log_datetime_aware.replace(year=end_time.year - 1)
+    return log_datetime_aware
+
+
+def bench_timestamp_parsing(lines, tz, end_time):
+    """So sánh tốc độ (dòng/giây) giữa parser cũ và parser có cache."""
+    started = time.perf_counter()
+    for line in lines:
+        legacy_parse(line, tz, end_time)
+    legacy_elapsed = time.perf_counter() - started
+
+    parse_ts = ai.make_syslog_time_parser(tz, end_time)
+    started = time.perf_counter()
+    for line in lines:
+        parse_ts(line)
+    cached_elapsed = time.perf_counter() - started
+
+    print(f"Parse timestamp (strptime + localize): {len(lines) / legacy_elapsed:>12,.0f} dòng/giây")
+    print(f"Parse timestamp (cache theo phút)     : {len(lines) / cached_elapsed:>12,.0f} dòng/giây")
+    print(f"  -> nhanh hơn {legacy_elapsed / cached_elapsed:.1f} lần")
+
+
+def bench_window_seek(lines, tz, end_time, hours):
+    """So sánh thời gian tìm cửa sổ lần chạy đầu tiên: quét toàn bộ file và tìm kiếm nhị phân."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        log_path = os.path.join(work_dir, "filter.log")
+        with open(log_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            for seek_mode in ("scan", "bisect"):
+                # Mỗi chế độ dùng firewall_id riêng để không dùng lại checkpoint/timestamp của lần đo trước
+                started = time.perf_counter()
+                content, _, _, _ = ai.read_new_log_entries(log_path, hours, TIMEZONE, f"benchmark-{seek_mode}", seek_mode)
+                elapsed = time.perf_counter() - started
+                print(f"Đọc cửa sổ {hours} giờ ({seek_mode:>6}): {elapsed:8.3f} giây, {content.count(chr(10)):,} dòng")
+        finally:
+            os.chdir(cwd)
+
+
+def write_synthetic_filterlog(path, size_mb, end_time, lines_per_second=2000):
+    """Ghi nhanh một filterlog tổng hợp khoảng size_mb MB, timestamp tăng dần và kết thúc tại end_time."""
+    target = size_mb * 1024 * 1024
+    templates = [SAMPLE_MESSAGE.replace("203.0.113.7", f"203.0.113.{i}").replace(",445,", f",{1000 + i},")
+                 for i in range(1, 101)]
+    block = "".join(templates[i % len(templates)] for i in range(lines_per_second))
+    seconds = max(1, target // (len(block) + 16 * lines_per_second))
+    moment = end_time - timedelta(seconds=seconds)
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < target:
+            moment += timedelta(seconds=1)
+            prefix = moment.strftime('%b %d %H:%M:%S') + " "
+            chunk = prefix + block.replace("\n", "\n" + prefix)[:-len(prefix)]
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def bench_parallel_scan(size_mb, max_workers, tz, end_time):
+    """Đo thông lượng tổng hợp một filterlog lớn theo số process (1, 2, 4, ... max_workers)."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        log_path = os.path.join(work_dir, "filter.log")
+        print(f"Đang sinh filterlog tổng hợp ~{size_mb:,} MB...")
+        size = write_synthetic_filterlog(log_path, size_mb, end_time)
+        start_ts = (end_time - timedelta(days=1)).timestamp()
+
+        worker_counts = sorted({min(2 ** i, max_workers) for i in range(max_workers.bit_length() + 1)})
+        baseline, reference = None, None
+        for workers in worker_counts:
+            started = time.perf_counter()
+            parts, _ = parallel_aggregate_file(log_path, 0, start_ts, TIMEZONE, end_time, workers)
+            aggregator, prompt_lines = merge_window_parts(parts, 50)
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            # Kết quả gộp phải giống hệt lần chạy 1 process (cùng thống kê, cùng dòng mẫu theo thứ tự thời gian)
+            result = (aggregator.summary_stats(), dict(aggregator.filterlog['dst_port']), prompt_lines)
+            reference = reference or result
+            print(f"Quét song song {workers:>3} process: {elapsed:8.2f} giây, {size / elapsed / 1024 / 1024:8.1f} MB/giây, "
+                  f"{aggregator.total_lines / elapsed:>12,.0f} dòng/giây (x{baseline / elapsed:.2f}, "
+                  f"khớp 1 process: {'có' if result == reference else 'KHÔNG'})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark các bước đọc log của pfSense Log Analyzer.")
+    parser.add_argument("--lines", type=int, default=300000, help="Số dòng log tổng hợp cần sinh.")
+    parser.add_argument("--hours", type=int, default=1, help="Số giờ của cửa sổ lần chạy đầu tiên.")
+    parser.add_argument("--scan-mb", type=int, default=0, help="Kích thước (MB) filterlog tổng hợp cho benchmark quét song song, 0 = bỏ qua.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Số process tối đa khi quét song song.")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    tz = pytz.timezone(TIMEZONE)
+    end_time = datetime.now(tz)
+    lines = generate_lines(args.lines, end_time)
+
+    bench_timestamp_parsing(lines, tz, end_time)
+    bench_window_seek(lines, tz, end_time, args.hours)
+    if args.scan_mb:
+        bench_parallel_scan(args.scan_mb, args.workers, tz, end_time)
+
+
+if __name__ == "__main__":
+    main()
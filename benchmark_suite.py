@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Benchmark đầu-cuối cho ai.py với log tổng hợp, Gemini và SMTP giả lập (không cần API key hay máy chủ mail thật).
+
+Chạy: python benchmark_suite.py --sizes 1,10,100 --output benchmark_results.json
+      python benchmark_suite.py --sizes 1024,10240 --hours 1 --gemini-latency 3 --smtp-latency 0.3
+Kết quả JSON (mỗi kích thước một mục, mỗi bước một số đo) dùng để so sánh giữa các commit.
+"""
+
+import argparse
+import configparser
+import glob
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import pytz
+
+import ai
+import context_store
+import gemini_client
+import mail_outbox
+from gemini_client import configure_gemini
+from log_compactor import build_compacted_prompt_content
+from log_generator import SyntheticLogGenerator
+from log_parser import aggregate_log_lines
+from mail_outbox import configure_mail_outbox
+from parallel_scan import merge_window_parts
+from report_index import configure_report_index
+
+TIMEZONE = "Asia/Ho_Chi_Minh"
+FIREWALL_SECTION = "Firewall_benchmark"
+DEFAULT_CONTEXT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Bonus_context")
+FAKE_RESPONSE = """```json
+{"total_blocked_events": 0, "top_blocked_source_ip": "N/A", "alerts_count": 1,
+ "total_blocked_events_period": 0, "most_frequent_issue": "N/A", "total_alerts_period": 1}
+```
+
+**1. Tóm tắt và Đánh giá tổng quan**
+
+Phản hồi giả lập cho benchmark.
+"""
+
+fake_stats = Counter()
+_fake_stats_lock = threading.Lock()
+
+
+def _record(**values):
+    with _fake_stats_lock:
+        fake_stats.update(values)
+
+
+class FakeGenerativeModel:
+    """Thay cho genai.GenerativeModel: chờ `latency` giây rồi trả về phản hồi cố định có khối JSON."""
+    latency = 0.0
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+
+    def generate_content(self, prompt, request_options=None):
+        time.sleep(self.latency)
+        _record(gemini_calls=1, gemini_prompt_chars=len(prompt), gemini_seconds=self.latency)
+        return SimpleNamespace(text=FAKE_RESPONSE)
+
+
+class FakeSMTP:
+    """Thay cho smtplib.SMTP: mỗi lần kết nối và mỗi email chờ `latency` giây, chỉ đếm số email và số byte."""
+    latency = 0.0
+
+    def __init__(self, host, port, timeout=None):
+        time.sleep(self.latency)
+        _record(smtp_connections=1)
+
+    def starttls(self):
+        return 220, b"ready"
+
+    def login(self, username, password):
+        return 235, b"ok"
+
+    def noop(self):
+        return 250, b"ok"
+
+    def sendmail(self, from_addr, to_addrs, message):
+        time.sleep(self.latency)
+        _record(emails_sent=1, email_bytes=len(message))
+        return {}
+
+    def quit(self):
+        return 221, b"bye"
+
+
+@contextmanager
+def fake_backends(gemini_latency, smtp_latency):
+    """Thay Gemini và SMTP bằng bản giả lập trong phạm vi khối with."""
+    FakeGenerativeModel.latency = gemini_latency
+    FakeSMTP.latency = smtp_latency
+    with mock.patch.object(gemini_client.genai, "configure", lambda **kwargs: None), \
+            mock.patch.object(gemini_client.genai, "GenerativeModel", FakeGenerativeModel), \
+            mock.patch.object(mail_outbox.smtplib, "SMTP", FakeSMTP):
+        yield
+
+
+def build_config(work_dir, log_path, hours, context_files, scan_workers):
+    """Cấu hình tối thiểu cho một firewall đọc log tổng hợp, mọi thư mục ghi đều nằm trong work_dir."""
+    config = configparser.ConfigParser(interpolation=None)
+    config["Gemini"] = {"APIKey": "benchmark", "ResponseCacheEnabled": "false"}
+    config["Email"] = {"SMTPServer": "localhost", "SMTPPort": "25", "SenderEmail": "benchmark@example.com",
+                       "SenderPassword": "benchmark", "SpoolDirectory": os.path.join(work_dir, "mail_spool")}
+    config["System"] = {"ContextCacheDirectory": os.path.join(work_dir, "context_cache"),
+                        "ScanWorkers": str(scan_workers)}
+    config[FIREWALL_SECTION] = {
+        "PFSenseHostname": "pfSense", "LogFile": log_path, "HoursToAnalyze": str(hours), "TimeZone": TIMEZONE,
+        "ReportDirectory": os.path.join(work_dir, "reports"), "RecipientEmails": "soc@example.com",
+        "summary_recipient_emails": "soc@example.com", "reports_per_summary": "1",
+        **{f"context_{i}": path for i, path in enumerate(context_files, start=1)},
+    }
+    return config
+
+
+@contextmanager
+def timed(results, name, **extra):
+    """Đo thời gian một bước; các số liệu thêm vào `extra` trong khối with được ghi cùng."""
+    with _fake_stats_lock:
+        before = Counter(fake_stats)
+    started = time.perf_counter()
+    yield extra
+    elapsed = time.perf_counter() - started
+    with _fake_stats_lock:
+        backend = {key: round(value, 4) for key, value in (fake_stats - before).items()}
+    results[name] = {"seconds": round(elapsed, 4), **extra, **backend}
+    print(f"  {name:<26} {elapsed:9.3f} giây  {json.dumps({**extra, **backend}, ensure_ascii=False)}")
+
+
+def _throughput(stage, size_bytes, lines):
+    seconds = max(stage["seconds"], 1e-9)
+    stage.update(mb_per_second=round(size_bytes / seconds / 1024 / 1024, 2), lines_per_second=round(lines / seconds))
+
+
+def bench_size(size_mb, args, context_files):
+    """Chạy toàn bộ các bước cho một file log khoảng size_mb MB, trả về dict kết quả."""
+    tz = pytz.timezone(TIMEZONE)
+    stages = {}
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        log_path = os.path.join(work_dir, "filter.log")
+        generator = SyntheticLogGenerator(args.rate, args.ip_cardinality, args.attack_bursts, args.burst_seconds,
+                                          args.burst_rate, seed=args.seed)
+        with timed(stages, "generate") as extra:
+            size_bytes, seconds = generator.write(log_path, int(size_mb * 1024 * 1024), datetime.now(tz))
+            extra.update(bytes=size_bytes, log_hours=round(seconds / 3600, 2))
+        hours = args.hours or (seconds // 3600 + 1)
+        config = build_config(work_dir, log_path, hours, context_files, args.scan_workers)
+        configure_report_index(os.path.join(work_dir, "report_index.sqlite3"))
+        configure_gemini(max_concurrent_calls=args.gemini_concurrency, requests_per_minute=600000,
+                         response_cache=None)
+        configure_mail_outbox(config)
+
+        # Đọc cửa sổ lần đầu bằng firewall_id riêng để chu kỳ đầu-cuối phía dưới vẫn bắt đầu từ trạng thái trống
+        with timed(stages, "read_new_log_entries", seek_mode=args.seek_mode) as extra:
+            logs_content, _, _, window_parts = ai.read_new_log_entries(log_path, hours, TIMEZONE,
+                                                                       f"{FIREWALL_SECTION}_read", args.seek_mode,
+                                                                       scan_workers=args.scan_workers,
+                                                                       sample_limit=args.sample_lines)
+            if window_parts is None:
+                log_lines = logs_content.splitlines(keepends=True)
+                window_bytes, line_count = len(logs_content), len(log_lines)
+            else:
+                # Chế độ parallel: các process con chỉ gửi về kết quả tổng hợp (giống chu kỳ thật)
+                log_lines = None
+                window_bytes = sum(part["bytes"] for part in window_parts)
+                line_count = sum(part["aggregator"].total_lines for part in window_parts)
+            extra.update(lines=line_count, bytes=window_bytes)
+        _throughput(stages["read_new_log_entries"], window_bytes, line_count)
+        del logs_content
+
+        with timed(stages, "aggregate") as extra:
+            if window_parts is None:
+                aggregator, prompt_lines = aggregate_log_lines(log_lines, args.sample_lines)
+            else:
+                aggregator, prompt_lines = merge_window_parts(window_parts, args.sample_lines)
+            aggregator.ip_enricher = ai.load_firewall_ip_enricher(config, FIREWALL_SECTION)
+            extra.update(prompt_lines=len(prompt_lines))
+        _throughput(stages["aggregate"], window_bytes, line_count)
+        del log_lines, window_parts
+
+        relevant_ips, relevant_names = aggregator.relevant_entities()
+        # Lần "cold" phải đọc và phân tích lại file bối cảnh: bỏ cache trong bộ nhớ (còn lại từ kích thước trước)
+        # và cache trên đĩa trước khi đo
+        with context_store._memory_cache_lock:
+            context_store._memory_cache.clear()
+        shutil.rmtree(config.get("System", "ContextCacheDirectory"), ignore_errors=True)
+        for name in ("read_bonus_context_cold", "read_bonus_context_warm"):
+            with timed(stages, name) as extra:
+                bonus_context = ai.read_bonus_context_files(config, FIREWALL_SECTION, relevant_ips, relevant_names,
+                                                            ip_enricher=aggregator.ip_enricher)
+                extra.update(chars=len(bonus_context))
+
+        with timed(stages, "build_prompt") as extra:
+            prompt_content, compaction = build_compacted_prompt_content(aggregator, prompt_lines, args.token_budget)
+            prompt = ai.build_prompt(ai.PROMPT_TEMPLATE_FILE, prompt_content, bonus_context)
+            extra.update(prompt_chars=len(prompt), estimated_tokens=compaction["estimated_tokens"])
+
+        with timed(stages, "run_analysis_cycle"):
+            ai.run_analysis_cycle(config, FIREWALL_SECTION)
+        with timed(stages, "run_summary_analysis_cycle"):
+            ai.run_summary_analysis_cycle(config, FIREWALL_SECTION)
+        # Bản ghi lần chạy (metrics.py) cho biết thời gian từng bước bên trong chu kỳ
+        for stage, pattern in (("run_analysis_cycle", ("reports", "2*", "*.run.json")),
+                               ("run_summary_analysis_cycle", ("reports", "summary", "*", "*.run.json"))):
+            for run_record_path in glob.glob(os.path.join(work_dir, *pattern)):
+                with open(run_record_path, 'r', encoding='utf-8') as f:
+                    run_record = json.load(f)
+                stages[stage].update(spans=run_record["spans"], counters=run_record["counters"])
+
+    return {"size_mb": size_mb, "bytes": size_bytes, "window_hours": hours, "stages": stages,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark đầu-cuối pfSense Log Analyzer với Gemini/SMTP giả lập.")
+    parser.add_argument("--sizes", default="1,10,100", help="Các kích thước log (MB), ví dụ 1,10,100,1024,10240.")
+    parser.add_argument("--hours", type=int, default=0,
+                        help="HoursToAnalyze; 0 = cả file (cửa sổ được nạp vào bộ nhớ, cần RAM cỡ kích thước log).")
+    parser.add_argument("--rate", type=int, default=500, help="Số dòng log nền mỗi giây.")
+    parser.add_argument("--ip-cardinality", type=int, default=5000, help="Số IP bên ngoài khác nhau.")
+    parser.add_argument("--attack-bursts", type=int, default=2, help="Số đợt tấn công trong mỗi file log.")
+    parser.add_argument("--burst-seconds", type=int, default=300, help="Thời lượng mỗi đợt tấn công (giây).")
+    parser.add_argument("--burst-rate", type=int, default=200, help="Số dòng mỗi giây trong đợt tấn công.")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--seek-mode", default="bisect", choices=("scan", "bisect", "parallel"))
+    parser.add_argument("--scan-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--sample-lines", type=int, default=50, help="FilterlogSampleLines.")
+    parser.add_argument("--token-budget", type=int, default=60000, help="PromptTokenBudget.")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Độ trễ giả lập mỗi lần gọi Gemini (giây).")
+    parser.add_argument("--gemini-concurrency", type=int, default=2, help="MaxConcurrentGeminiCalls.")
+    parser.add_argument("--smtp-latency", type=float, default=0.1, help="Độ trễ giả lập mỗi lệnh SMTP (giây).")
+    parser.add_argument("--context-dir", default=DEFAULT_CONTEXT_DIR, help="Thư mục file bối cảnh, rỗng = không dùng.")
+    parser.add_argument("--work-dir", default=None, help="Thư mục tạm cho log tổng hợp (cần đủ dung lượng).")
+    parser.add_argument("--output", default="benchmark_results.json", help="File JSON kết quả.")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    output_path = os.path.abspath(args.output)
+    context_files = sorted(os.path.abspath(p) for p in glob.glob(os.path.join(args.context_dir, "*"))) if args.context_dir else []
+    if args.work_dir:
+        args.work_dir = os.path.abspath(args.work_dir)
+    # Các template prompt/email và logo được đọc theo đường dẫn tương đối như khi chạy ai.py
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    results = []
+    with fake_backends(args.gemini_latency, args.smtp_latency):
+        for size_mb in (float(size) for size in args.sizes.split(",")):
+            print(f"Kích thước log {size_mb:,g} MB:")
+            results.append(bench_size(size_mb, args, context_files))
+
+    report = {
+        "generated_at": datetime.now(pytz.timezone(TIMEZONE)).isoformat(), "git_commit": _git_commit(),
+        "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "work_dir")},
+        "results": results,
+    }
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Đã ghi kết quả vào '{output_path}'.")
+
+
+if __name__ == "__main__":
+    main()
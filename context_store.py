@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Kho bối cảnh bổ sung: trích xuất nội dung file một lần, cache theo path (kiểm tra mtime+size) và lọc theo mức liên quan."""
+
+import hashlib
+import html
+import ipaddress
+import json
+import logging
+import os
+import re
+import threading
+import xml.etree.ElementTree as ET
+
+try:
+    from pypdf import PdfReader
+except ImportError:  # pypdf là phụ thuộc tùy chọn, thiếu thì bỏ qua nội dung PDF
+    PdfReader = None
+
+CONTEXT_CACHE_VERSION = 2
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+IPV4_PATTERN = re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?:/\d{1,2})?\b')
+SWITCH_IP_ADDRESS_PATTERN = re.compile(r'ip address (\d{1,3}(?:\.\d{1,3}){3}) (\d{1,3}(?:\.\d{1,3}){3})')
+SWITCH_INTERFACE_PATTERN = re.compile(r'^interface (\S+)', re.MULTILINE)
+
+# path tuyệt đối -> ([mtime_ns, size], các mục): mỗi file chỉ giữ bản ứng với mtime/size hiện tại
+_memory_cache = {}
+_memory_cache_lock = threading.Lock()
+
+
+def _text(element, tag):
+    """Lấy nội dung thẻ con (đã giải mã HTML entity), trả về chuỗi rỗng nếu không có."""
+    child = element.find(tag) if element is not None else None
+    return html.unescape(html.unescape(child.text.strip())) if child is not None and child.text else ""
+
+
+def _children(root, tag):
+    """Danh sách thẻ con của một thẻ, rỗng nếu thẻ không tồn tại."""
+    element = root.find(tag)
+    return list(element) if element is not None else []
+
+
+def _section(title, text, ips=(), names=(), always=False):
+    """Tạo một mục bối cảnh kèm các khóa (IP/CIDR, tên) dùng để lọc theo mức liên quan."""
+    return {"title": title, "text": text, "ips": sorted(set(ips)), "names": sorted({n.lower() for n in names if n}),
+            "always": always}
+
+
+# --- Trích xuất cấu hình pfSense (config.xml) ---
+
+def parse_pfsense_config(root):
+    """Chuyển config.xml của pfSense thành cấu trúc gọn: interface, VLAN, alias, rule, DHCP static map."""
+    interfaces = {}
+    for element in _children(root, 'interfaces'):
+        ipaddr, subnet = _text(element, 'ipaddr'), _text(element, 'subnet')
+        network = ""
+        if subnet and IPV4_PATTERN.fullmatch(ipaddr):
+            network = str(ipaddress.ip_network(f"{ipaddr}/{subnet}", strict=False))
+        interfaces[element.tag] = {"name": element.tag, "descr": _text(element, 'descr'), "if": _text(element, 'if'),
+                                   "ipaddr": ipaddr, "network": network}
+
+    vlans = [{"if": _text(v, 'if'), "tag": _text(v, 'tag'), "descr": _text(v, 'descr'), "vlanif": _text(v, 'vlanif')}
+             for v in root.findall('vlans/vlan')]
+
+    aliases = [{"name": _text(a, 'name'), "type": _text(a, 'type'), "address": _text(a, 'address').split(),
+                "descr": _text(a, 'descr')} for a in root.findall('aliases/alias')]
+
+    rules = []
+    for rule in root.findall('filter/rule'):
+        endpoints = {}
+        for side in ('source', 'destination'):
+            element = rule.find(side)
+            if element is None or element.find('any') is not None:
+                endpoints[side] = "any"
+            else:
+                target = _text(element, 'address') or _text(element, 'network')
+                negate = "!" if element.find('not') is not None else ""
+                port = _text(element, 'port')
+                endpoints[side] = f"{negate}{target}" + (f":{port}" if port else "")
+        rules.append({"type": _text(rule, 'type'), "interface": _text(rule, 'interface'),
+                      "protocol": _text(rule, 'protocol') or "any", "source": endpoints['source'],
+                      "destination": endpoints['destination'], "descr": _text(rule, 'descr'),
+                      "disabled": rule.find('disabled') is not None, "tracker": _text(rule, 'tracker')})
+
+    static_maps = []
+    for scope in _children(root, 'dhcpd'):
+        for mapping in scope.findall('staticmap'):
+            static_maps.append({"interface": scope.tag, "mac": _text(mapping, 'mac'), "ipaddr": _text(mapping, 'ipaddr'),
+                                "hostname": _text(mapping, 'hostname'), "descr": _text(mapping, 'descr')})
+
+    return {"interfaces": interfaces, "vlans": vlans, "aliases": aliases, "rules": rules, "static_maps": static_maps}
+
+
+def _pfsense_sections(parsed):
+    """Tạo các mục bối cảnh từ cấu hình pfSense đã parse."""
+    interfaces = parsed["interfaces"]
+    alias_addresses = {a["name"]: a["address"] for a in parsed["aliases"]}
+    sections = []
+
+    overview = [f"- {i['name']} ({i['descr']}): if={i['if']}, ip={i['ipaddr'] or 'N/A'}"
+                + (f", mạng={i['network']}" if i['network'] else "") for i in interfaces.values()]
+    overview += [f"- VLAN {v['tag']} ({v['descr']}): {v['vlanif']} trên {v['if']}" for v in parsed["vlans"]]
+    sections.append(_section("Interface và VLAN", "\n".join(overview), always=True))
+
+    for alias in parsed["aliases"]:
+        ips = [a for a in alias["address"] if IPV4_PATTERN.fullmatch(a)]
+        sections.append(_section(f"Alias {alias['name']}",
+                                 f"Alias `{alias['name']}` ({alias['type']}): {' '.join(alias['address'])} {alias['descr']}".strip(),
+                                 ips=ips, names=[alias['name']]))
+
+    for rule in parsed["rules"]:
+        interface = interfaces.get(rule["interface"], {})
+        ips, names = [], [rule["interface"], interface.get("if"), interface.get("descr")]
+        for endpoint in (rule["source"], rule["destination"]):
+            target = endpoint.lstrip("!").split(":")[0]
+            if IPV4_PATTERN.fullmatch(target):
+                ips.append(target)
+            elif target in alias_addresses:
+                names.append(target)
+                ips += [a for a in alias_addresses[target] if IPV4_PATTERN.fullmatch(a)]
+            elif target in interfaces and interfaces[target]["network"]:
+                ips.append(interfaces[target]["network"])
+        status = " (đang tắt)" if rule["disabled"] else ""
+        text = (f"Rule [{rule['interface']}] {rule['type']} {rule['protocol']} từ {rule['source']} đến "
+                f"{rule['destination']}{status}: {rule['descr']} (tracker {rule['tracker']})")
+        sections.append(_section(f"Rule {rule['tracker']}", text, ips=ips, names=names))
+
+    for mapping in parsed["static_maps"]:
+        text = (f"DHCP static map [{mapping['interface']}]: {mapping['ipaddr']} - {mapping['hostname']} "
+                f"({mapping['mac']}) {mapping['descr']}").strip()
+        sections.append(_section(f"Static map {mapping['ipaddr']}", text, ips=[mapping['ipaddr']],
+                                 names=[mapping['hostname'], mapping['mac']]))
+    return sections
+
+
+# --- Trích xuất các loại file khác ---
+
+def _pdf_sections(path):
+    """Trích xuất văn bản PDF theo từng trang (cần pypdf)."""
+    if PdfReader is None:
+        logging.warning(f"Chưa cài pypdf, bỏ qua nội dung PDF '{path}'.")
+        return []
+    reader = PdfReader(path)
+    sections = []
+    for page_number, page in enumerate(reader.pages, start=1):
+        text = re.sub(r'\s+', ' ', page.extract_text() or "").strip()
+        if not text:
+            continue
+        if page_number == 1:
+            sections.append(_section("Tài liệu", f"Tài liệu: {text[:200]}...", always=True))
+        sections.append(_section(f"Trang {page_number}", text, ips=IPV4_PATTERN.findall(text),
+                                 names=_interface_names(text)))
+    return sections
+
+
+def _interface_names(text):
+    """Lấy các tên interface/VLAN xuất hiện trong văn bản (vd: Vlan11, lagg0.11, igb1)."""
+    return set(re.findall(r'\b(?:vlan\s?\d+|lagg\d+(?:\.\d+)?|igc\d+|igb\d+|em\d+|ix\d+|ovpn[sc]\d+|pppoe\d+)\b',
+                          text, re.IGNORECASE))
+
+
+def _text_sections(path):
+    """Chia file văn bản (vd: cấu hình switch Cisco) thành các khối theo dấu '!' hoặc dòng trống."""
+    with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+        content = f.read()
+    blocks = re.split(r'\n!\s*\n|\n\s*\n', content)
+    sections, interface_lines = [], []
+    for block in blocks:
+        block = block.strip().strip('!').strip()
+        # Bỏ các khối chứng chỉ/khóa (chuỗi hex dài, không có giá trị phân tích)
+        if not block or 'certificate' in block.split('\n', 1)[0]:
+            continue
+        ips = IPV4_PATTERN.findall(block)
+        for address, mask in SWITCH_IP_ADDRESS_PATTERN.findall(block):
+            ips.append(str(ipaddress.ip_network(f"{address}/{mask}", strict=False)))
+        names = SWITCH_INTERFACE_PATTERN.findall(block) + list(_interface_names(block))
+        for interface in SWITCH_INTERFACE_PATTERN.findall(block):
+            address = SWITCH_IP_ADDRESS_PATTERN.search(block)
+            if address:
+                interface_lines.append(f"- {interface}: {address.group(1)} {address.group(2)}")
+        sections.append(_section(block.split('\n', 1)[0][:80], block, ips=ips, names=names))
+    if interface_lines:
+        sections.insert(0, _section("Tổng quan interface", "\n".join(interface_lines), always=True))
+    return sections
+
+
+def extract_context_sections(path):
+    """Trích xuất các mục bối cảnh từ một file tùy theo loại file."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension in IMAGE_EXTENSIONS:
+        return []
+    if extension == '.pdf':
+        return _pdf_sections(path)
+    if extension == '.xml':
+        root = ET.parse(path).getroot()
+        if root.tag == 'pfsense':
+            return _pfsense_sections(parse_pfsense_config(root))
+    return _text_sections(path)
+
+
+def _source_stamp(stat):
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _prune_stale_cache_entries(cache_dir):
+    """Xóa các entry cache trên đĩa mà file nguồn đã bị xóa hoặc đã đổi mtime/size (kể cả entry định dạng cũ)."""
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.json'):
+            continue
+        cache_file = os.path.join(cache_dir, name)
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            source = entry.get("source") if isinstance(entry, dict) else None
+            if source and entry.get("stamp") == _source_stamp(os.stat(source)):
+                continue
+        except (OSError, ValueError):
+            pass
+        try:
+            os.remove(cache_file)
+            logging.info(f"Đã xóa cache bối cảnh cũ '{cache_file}'.")
+        except OSError:
+            pass
+
+
+def load_context_sections(path, cache_dir):
+    """Lấy các mục bối cảnh của file: cache trong bộ nhớ, sau đó cache trên đĩa, cuối cùng mới trích xuất lại.
+
+    Mỗi file nguồn chỉ có một entry (trong bộ nhớ và trên đĩa), bị thay thế khi mtime/size của file thay đổi.
+    """
+    source = os.path.abspath(path)
+    stamp = _source_stamp(os.stat(path))
+
+    with _memory_cache_lock:
+        cached = _memory_cache.get(source)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+    cache_key = hashlib.sha1(f"{CONTEXT_CACHE_VERSION}|{source}".encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir, f"{cache_key}.json")
+    sections = None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        if entry.get("stamp") == stamp:
+            sections = entry["sections"]
+    except (FileNotFoundError, ValueError, KeyError, AttributeError):
+        pass
+    if sections is None:
+        logging.info(f"Trích xuất bối cảnh từ '{path}' (chưa có trong cache hoặc file đã thay đổi).")
+        sections = extract_context_sections(path)
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            json.dump({"source": source, "stamp": stamp, "sections": sections}, f, ensure_ascii=False)
+        os.replace(temp_file, cache_file)
+        # Chỉ dọn khi có entry mới (file nguồn vừa đổi), không quét thư mục ở mỗi lần đọc cache
+        _prune_stale_cache_entries(cache_dir)
+
+    with _memory_cache_lock:
+        _memory_cache[source] = (stamp, sections)
+    return sections
+
+
+def _section_is_relevant(section, window_ips, window_ip_strings, window_names):
+    """Kiểm tra một mục có liên quan tới các IP/interface xuất hiện trong cửa sổ log hay không."""
+    if window_names.intersection(section["names"]):
+        return True
+    for key in section["ips"]:
+        if '/' in key:
+            try:
+                network = ipaddress.ip_network(key, strict=False)
+            except ValueError:
+                continue
+            if any(ip in network for ip in window_ips):
+                return True
+        elif key in window_ip_strings:
+            return True
+    return False
+
+
+def select_relevant_sections(sections, relevant_ips=None, relevant_names=None):
+    """Chọn các mục luôn cần thiết và các mục khớp với IP/interface của cửa sổ log hiện tại."""
+    window_ips = set()
+    for ip in relevant_ips or ():
+        try:
+            window_ips.add(ipaddress.ip_address(ip))
+        except ValueError:
+            continue
+    window_ip_strings = {str(ip) for ip in window_ips}
+    window_names = {n.lower() for n in relevant_names or ()}
+
+    selected = []
+    for section in sections:
+        if section["always"]:
+            selected.append(section)
+        elif (window_ips or window_names) and _section_is_relevant(section, window_ips, window_ip_strings, window_names):
+            selected.append(section)
+    return selected
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Client Gemini dùng lâu dài: tái sử dụng model, giới hạn tốc độ (token bucket), retry với backoff lũy thừa."""
+
+import logging
+import random
+import threading
+import time
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+from log_compactor import estimate_tokens
+from metrics import SectionTimeout, record, remaining_seconds
+
+DEFAULT_MODEL_NAME = 'gemini-2.5-flash'
+REQUEST_TIMEOUT_SECONDS = 180
+MAX_BACKOFF_SECONDS = 60
+# Lỗi tạm thời nên thử lại: 429, 5xx và hết thời gian chờ
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.BadGateway,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.DeadlineExceeded,
+)
+
+_settings = {
+    "model_name": DEFAULT_MODEL_NAME,
+    "requests_per_minute": 60,
+    "max_retries": 4,
+    "backoff_base_seconds": 2.0,
+}
+_concurrency_semaphore = threading.BoundedSemaphore(2)
+_response_cache = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class TokenBucket:
+    """Bộ giới hạn tốc độ token bucket, an toàn khi dùng từ nhiều thread."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity or max(1, int(rate_per_minute // 6))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Chờ cho đến khi lấy được một token."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate_per_second
+            time.sleep(wait_seconds)
+
+
+class GeminiClient:
+    """Một client cho mỗi API key/model, dùng chung giữa các firewall và các chu kỳ."""
+
+    def __init__(self, api_key, model_name, requests_per_minute, max_retries, backoff_base_seconds):
+        genai.configure(api_key=api_key)
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name)
+        self.rate_limiter = TokenBucket(requests_per_minute)
+        self.max_retries = max_retries
+        self.backoff_base_seconds = backoff_base_seconds
+
+    def generate(self, prompt, firewall_id, timeout=REQUEST_TIMEOUT_SECONDS):
+        """Gửi prompt và trả về văn bản phản hồi; dùng cache nếu có, tự thử lại với lỗi tạm thời."""
+        cache = _response_cache
+        cache_key = cache.make_key(self.model_name, prompt) if cache else None
+        if cache:
+            cached_response = cache.get(cache_key)
+            if cached_response is not None:
+                record(firewall_id, gemini_cache_hits=1)
+                logging.info(f"[{firewall_id}] Dùng phản hồi Gemini từ cache ({cache_key[:12]}).")
+                return cached_response
+
+        response_text = self._generate_with_retry(prompt, firewall_id, timeout)
+        if cache:
+            try:
+                cache.put(cache_key, self.model_name, response_text)
+            except OSError as e:
+                logging.warning(f"[{firewall_id}] Không thể ghi cache phản hồi: {e}")
+        return response_text
+
+    def _generate_with_retry(self, prompt, firewall_id, timeout):
+        """Gọi Gemini, tự thử lại với lỗi tạm thời, ném lỗi cuối cùng nếu vẫn thất bại."""
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                # Hạn chót của firewall (SectionTimeoutSeconds) giới hạn cả thời gian chờ lượt lẫn timeout của request
+                if not _concurrency_semaphore.acquire(timeout=remaining_seconds(firewall_id, -1)):
+                    raise SectionTimeout(f"[{firewall_id}] Hết thời gian khi chờ lượt gọi Gemini.")
+                try:
+                    started = time.perf_counter()
+                    response = self.model.generate_content(
+                        prompt, request_options={"timeout": remaining_seconds(firewall_id, timeout)})
+                    latency = time.perf_counter() - started
+                finally:
+                    _concurrency_semaphore.release()
+                response_text = response.text
+                self._record_usage(firewall_id, prompt, response, response_text, latency)
+                return response_text
+            except RETRYABLE_EXCEPTIONS as e:
+                if attempt >= self.max_retries:
+                    record(firewall_id, gemini_errors=1)
+                    raise
+                record(firewall_id, gemini_retries=1)
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff_base_seconds * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                attempt += 1
+                logging.warning(f"[{firewall_id}] Gemini lỗi tạm thời ({type(e).__name__}), thử lại lần {attempt}/{self.max_retries} sau {delay:.1f} giây.")
+                if delay >= remaining_seconds(firewall_id, delay + 1):
+                    raise SectionTimeout(f"[{firewall_id}] Không đủ thời gian để thử lại Gemini.") from e
+                time.sleep(delay)
+            except SectionTimeout:
+                raise
+            except Exception:
+                record(firewall_id, gemini_errors=1)
+                raise
+
+    @staticmethod
+    def _record_usage(firewall_id, prompt, response, response_text, latency):
+        """Ghi số token (usage_metadata của Gemini, ước lượng nếu không có) và độ trễ của một lần gọi."""
+        usage = getattr(response, 'usage_metadata', None)
+        prompt_tokens = getattr(usage, 'prompt_token_count', None) or estimate_tokens(prompt)
+        response_tokens = getattr(usage, 'candidates_token_count', None) or estimate_tokens(response_text)
+        record(firewall_id, gemini_requests=1, gemini_latency_seconds=latency, prompt_chars=len(prompt),
+               prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+
+
+def configure_gemini(max_concurrent_calls=2, requests_per_minute=60, model_name=DEFAULT_MODEL_NAME,
+                     max_retries=4, backoff_base_seconds=2.0, response_cache=None):
+    """Thiết lập giới hạn và cache phản hồi dùng chung cho mọi client (gọi một lần khi khởi động)."""
+    global _concurrency_semaphore, _response_cache
+    _concurrency_semaphore = threading.BoundedSemaphore(max_concurrent_calls)
+    _response_cache = response_cache
+    _settings.update(model_name=model_name, requests_per_minute=requests_per_minute,
+                     max_retries=max_retries, backoff_base_seconds=backoff_base_seconds)
+    with _clients_lock:
+        _clients.clear()
+
+
+def get_response_cache():
+    """Cache phản hồi đang dùng (None nếu bị tắt)."""
+    return _response_cache
+
+
+def get_gemini_client(api_key):
+    """Lấy (hoặc tạo) client dùng lâu dài cho API key hiện tại."""
+    key = (api_key, _settings["model_name"])
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = GeminiClient(api_key, **_settings)
+        return client
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Gắn nhãn IP tại chỗ từ config.xml của pfSense: interface/VLAN, alias, hostname DHCP static map, nội bộ/bên ngoài."""
+
+import ipaddress
+import logging
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import Counter
+from functools import lru_cache
+
+from context_store import parse_pfsense_config
+
+LABEL_CACHE_SIZE = 65536
+MAX_ALIAS_DEPTH = 8
+CLASS_NAMES = {"internal": "nội bộ", "external": "bên ngoài", "unknown": "không rõ"}
+# Dải địa chỉ nội bộ (RFC 1918, CGNAT, loopback, link-local, ULA); không dùng is_private vì nó gồm cả dải tài liệu
+PRIVATE_NETWORKS = ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '100.64.0.0/10', '127.0.0.0/8',
+                    '169.254.0.0/16', '::1/128', 'fc00::/7', 'fe80::/10')
+
+_enricher_cache = {}
+_enricher_cache_lock = threading.Lock()
+
+
+class PrefixTrie:
+    """Trie nhị phân theo bit địa chỉ; tra cứu trả về mọi giá trị trên đường đi, từ prefix ngắn đến prefix dài nhất."""
+
+    def __init__(self):
+        # Mỗi nút: [con bit 0, con bit 1, danh sách giá trị hoặc None]
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.max_depth = {4: 0, 6: 0}
+
+    def insert(self, network, value):
+        bits = network.max_prefixlen
+        address = int(network.network_address)
+        node = self.roots[network.version]
+        for i in range(network.prefixlen):
+            bit = (address >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            node[2] = []
+        node[2].append(value)
+        self.max_depth[network.version] = max(self.max_depth[network.version], network.prefixlen)
+
+    def lookup(self, version, address):
+        bits = 32 if version == 4 else 128
+        node = self.roots[version]
+        matches = list(node[2] or ())
+        for i in range(self.max_depth[version]):
+            node = node[(address >> (bits - 1 - i)) & 1]
+            if node is None:
+                break
+            if node[2]:
+                matches.extend(node[2])
+        return matches
+
+
+def _parse_address(value):
+    """Chuyển chuỗi IP thành (version, số nguyên); nhánh IPv4 tự tách để tránh chi phí của ipaddress."""
+    parts = value.split('.')
+    if len(parts) == 4:
+        try:
+            a, b, c, d = (int(p) for p in parts)
+        except ValueError:
+            return None
+        if 0 <= a <= 255 and 0 <= b <= 255 and 0 <= c <= 255 and 0 <= d <= 255:
+            return 4, (a << 24) | (b << 16) | (c << 8) | d
+        return None
+    try:
+        return 6, int(ipaddress.IPv6Address(value))
+    except ValueError:
+        return None
+
+
+class IPEnricher:
+    """Tra nhãn cho IP: trie cho subnet (interface, alias dạng network), bảng băm cho host, kết quả cache LRU."""
+
+    def __init__(self, parsed_config, cache_size=LABEL_CACHE_SIZE):
+        self.trie = PrefixTrie()
+        self.hosts = {}
+        self.hostnames = {}
+        # Tiêu đề các mục bối cảnh (context_store) đã được thay hoàn toàn bằng nhãn IP, không cần gửi kèm prompt nữa
+        self.labelled_sections = set()
+        self._build(parsed_config)
+        self.label = lru_cache(maxsize=cache_size)(self._label)
+
+    def _build(self, parsed):
+        for network in PRIVATE_NETWORKS:
+            self.trie.insert(ipaddress.ip_network(network), ("private", None))
+        vlan_tags = {v["vlanif"]: v for v in parsed["vlans"] if v["vlanif"]}
+        for interface in parsed["interfaces"].values():
+            name = interface["descr"] or interface["name"].upper()
+            vlan = vlan_tags.get(interface["if"])
+            if vlan and vlan['tag'] not in name:
+                name = f"{name} (VLAN {vlan['tag']})"
+            if interface["network"]:
+                self.trie.insert(ipaddress.ip_network(interface["network"]), ("interface", name))
+            if interface["ipaddr"]:
+                self.hostnames[interface["ipaddr"]] = "pfSense"
+
+        aliases = {a["name"]: a for a in parsed["aliases"]}
+        for alias in parsed["aliases"]:
+            if alias["type"] not in ("host", "network"):
+                continue
+            labelled = False
+            for entry in self._resolve_alias(alias["name"], aliases, set()):
+                if '/' in entry:
+                    try:
+                        self.trie.insert(ipaddress.ip_network(entry, strict=False), ("alias", alias["name"]))
+                    except ValueError:
+                        continue
+                elif _parse_address(entry):
+                    self.hosts.setdefault(entry, []).append(("alias", alias["name"]))
+                else:
+                    continue
+                labelled = True
+            if labelled:
+                self.labelled_sections.add(f"Alias {alias['name']}")
+
+        for mapping in parsed["static_maps"]:
+            if mapping["ipaddr"] and mapping["hostname"]:
+                self.hostnames[mapping["ipaddr"]] = mapping["hostname"]
+                self.labelled_sections.add(f"Static map {mapping['ipaddr']}")
+
+    def _resolve_alias(self, name, aliases, visited, depth=0):
+        """Mở rộng alias lồng nhau thành danh sách IP/CIDR (bỏ qua FQDN, khoảng IP và vòng lặp)."""
+        if name in visited or depth > MAX_ALIAS_DEPTH:
+            return []
+        visited.add(name)
+        entries = []
+        for entry in aliases[name]["address"]:
+            if entry in aliases:
+                entries.extend(self._resolve_alias(entry, aliases, visited, depth + 1))
+            else:
+                entries.append(entry)
+        return entries
+
+    def _label(self, ip):
+        parsed = _parse_address(ip)
+        if parsed is None:
+            return {"class": "unknown", "interface": None, "aliases": (), "hostname": None}
+        version, address = parsed
+        interface, aliases, internal = None, [], False
+        for kind, value in self.trie.lookup(version, address) + self.hosts.get(ip, []):
+            if kind == "interface":
+                interface = value  # Prefix dài nhất thắng
+                internal = True
+            elif kind == "private":
+                internal = True
+            elif value not in aliases:
+                aliases.append(value)
+        return {"class": "internal" if internal else "external", "interface": interface,
+                "aliases": tuple(aliases), "hostname": self.hostnames.get(ip)}
+
+    def short_label(self, ip):
+        """Nhãn ngắn dạng 'LAN/VLAN 10, alias Web, host nas01, nội bộ' để chèn cạnh IP trong prompt."""
+        label = self.label(ip)
+        parts = [label["interface"]] if label["interface"] else []
+        if label["aliases"]:
+            parts.append("alias " + "|".join(label["aliases"]))
+        if label["hostname"]:
+            parts.append(f"host {label['hostname']}")
+        parts.append(CLASS_NAMES[label["class"]])
+        return ", ".join(parts)
+
+    def group_counts(self, ip_counts, field):
+        """Cộng số sự kiện theo một trường nhãn (class, interface, aliases, hostname)."""
+        groups = Counter()
+        for ip, count in ip_counts:
+            value = self.label(ip)[field]
+            for key in (value if isinstance(value, tuple) else (value,)):
+                if key:
+                    groups[key] += count
+        return groups
+
+    def summary_stats(self, aggregator, top_n=10):
+        """Số liệu theo nhãn để thêm vào summary_stats của báo cáo."""
+        blocked_src = aggregator.top('src_ip', 'block', n=None)
+        blocked_dst = aggregator.top('dst_ip', 'block', n=None)
+
+        def labelled(items):
+            return [{"ip": ip, "count": count, **{k: (list(v) if isinstance(v, tuple) else v)
+                                                  for k, v in self.label(ip).items()}} for ip, count in items[:top_n]]
+
+        return {
+            "blocked_events_by_source_class": dict(self.group_counts(blocked_src, "class")),
+            "blocked_events_by_source_interface": dict(self.group_counts(blocked_src, "interface").most_common(top_n)),
+            "blocked_events_by_destination_interface": dict(self.group_counts(blocked_dst, "interface").most_common(top_n)),
+            "blocked_events_by_source_alias": dict(self.group_counts(blocked_src, "aliases").most_common(top_n)),
+            "blocked_events_by_destination_host": dict(self.group_counts(blocked_dst, "hostname").most_common(top_n)),
+            "top_blocked_sources_labeled": labelled(blocked_src),
+            "top_blocked_destinations_labeled": labelled(blocked_dst),
+        }
+
+    def prompt_lines(self, aggregator, top_n=10):
+        """Các dòng thống kê theo nhãn để thêm vào phần THỐNG KÊ TỔNG HỢP của prompt."""
+        lines = []
+        for action in ('block', 'pass'):
+            if not aggregator.actions.get(action):
+                continue
+            src = aggregator.top('src_ip', action, n=None)
+            dst = aggregator.top('dst_ip', action, n=None)
+            for title, items, field in (("IP nguồn theo phân loại", src, "class"),
+                                        ("IP nguồn theo interface/VLAN", src, "interface"),
+                                        ("IP đích theo interface/VLAN", dst, "interface"),
+                                        ("Theo alias (nguồn)", src, "aliases"),
+                                        ("Theo alias (đích)", dst, "aliases"),
+                                        ("Theo hostname (đích)", dst, "hostname")):
+                groups = self.group_counts(items, field).most_common(top_n)
+                if groups:
+                    # Dòng trống bị bỏ để prompt gọn
+                    lines.append(f"[{action}] {title}: " + ", ".join(f"{CLASS_NAMES.get(k, k)} ({c})" for k, c in groups))
+        return lines
+
+
+def load_ip_enricher(path):
+    """Tạo IPEnricher từ config.xml của pfSense, cache theo path+mtime+size. Trả về None nếu không phải config pfSense."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _enricher_cache_lock:
+        if key in _enricher_cache:
+            return _enricher_cache[key]
+
+    root = ET.parse(path).getroot()
+    enricher = IPEnricher(parse_pfsense_config(root)) if root.tag == 'pfsense' else None
+    if enricher is not None:
+        logging.info(f"Đã dựng bảng nhãn IP từ '{path}': {len(enricher.hosts)} host trong alias, {len(enricher.hostnames)} hostname.")
+    with _enricher_cache_lock:
+        _enricher_cache[key] = enricher
+    return enricher
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Đọc bộ log đã xoay vòng/nén (filter.log.0, .1.gz, .bz2, .xz, .zst) dạng streaming, bỏ qua segment nằm ngoài cửa sổ."""
+
+import bz2
+import glob
+import gzip
+import io
+import logging
+import lzma
+import os
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import pytz
+
+from log_parser import make_syslog_time_parser
+from process_pool import submit_to_pool
+
+try:
+    import zstandard
+except ImportError:  # zstandard là phụ thuộc tùy chọn, thiếu thì bỏ qua segment .zst
+    zstandard = None
+
+COMPRESSED_LOG_EXTENSIONS = ('.gz', '.bz2', '.xz', '.zst')
+GLOB_CHARACTERS = ('*', '?', '[')
+# Hậu tố của bản xoay vòng: .0, .1.gz, .bz2, ...
+ROTATED_SUFFIX_PATTERN = re.compile(r'^(?:\.\d+)?(?:\.(?:gz|bz2|xz|zst))?$')
+STREAM_BUFFER_SIZE = 1024 * 1024
+FIRST_LINE_PROBE = 100
+# Số segment tối đa giữ timestamp dòng đầu (bản xoay vòng theo ngày sinh tên file mới liên tục)
+FIRST_LINE_CACHE_SIZE = 1024
+
+# path -> (mtime, size, timestamp dòng đầu): mỗi path chỉ giữ bản mới nhất, bỏ path ít dùng nhất khi đầy
+_first_line_cache = OrderedDict()
+_first_line_cache_lock = threading.Lock()
+
+
+def is_glob_pattern(path):
+    return any(char in path for char in GLOB_CHARACTERS)
+
+
+def open_log_segment(path):
+    """Mở một segment ở chế độ nhị phân, giải nén streaming theo phần mở rộng (không nạp cả file vào bộ nhớ)."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"Chưa cài zstandard, không đọc được '{path}'.")
+        f = open(path, 'rb')
+        try:
+            raw = zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+        except Exception:
+            f.close()
+            raise
+        return io.BufferedReader(raw, STREAM_BUFFER_SIZE)
+    return open(path, 'rb', buffering=STREAM_BUFFER_SIZE)
+
+
+def list_log_segments(log_file):
+    """Các segment của LogFile: kết quả glob nếu có ký tự đại diện, ngược lại là file chính cùng các bản xoay vòng."""
+    if is_glob_pattern(log_file):
+        paths = glob.glob(log_file)
+    else:
+        paths = [log_file] + [p for p in glob.glob(glob.escape(log_file) + ".*")
+                              if ROTATED_SUFFIX_PATTERN.match(p[len(log_file):])]
+    return [p for p in paths if os.path.isfile(p)]
+
+
+def _first_line_prefix(path, stat):
+    """Timestamp (15 ký tự đầu) của dòng đầu tiên có timestamp, cache theo path+mtime+size."""
+    with _first_line_cache_lock:
+        cached = _first_line_cache.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            _first_line_cache.move_to_end(path)
+            return cached[2]
+    prefix = None
+    with open_log_segment(path) as f:
+        for _ in range(FIRST_LINE_PROBE):
+            raw_line = f.readline()
+            if not raw_line:
+                break
+            if raw_line[:3].isalpha():
+                prefix = raw_line[:15].decode('ascii', errors='ignore')
+                break
+    with _first_line_cache_lock:
+        _first_line_cache[path] = (stat.st_mtime_ns, stat.st_size, prefix)
+        _first_line_cache.move_to_end(path)
+        while len(_first_line_cache) > FIRST_LINE_CACHE_SIZE:
+            _first_line_cache.popitem(last=False)
+    return prefix
+
+
+def describe_segments(paths, parse_ts):
+    """Gắn khoảng thời gian [first_ts, last_ts] cho từng segment (dòng đầu tiên và mtime) rồi sắp xếp theo thời gian."""
+    segments = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            prefix = _first_line_prefix(path, stat)
+        except Exception as e:
+            logging.warning(f"Bỏ qua segment log '{path}': {e}")
+            continue
+        segments.append({"path": path, "first_ts": parse_ts(prefix) if prefix else None,
+                         "last_ts": stat.st_mtime, "size": stat.st_size,
+                         "compressed": path.endswith(COMPRESSED_LOG_EXTENSIONS)})
+    segments.sort(key=lambda s: (s["first_ts"] if s["first_ts"] is not None else s["last_ts"], s["last_ts"]))
+    return segments
+
+
+def current_log_path(log_file, segments):
+    """File đang được ghi: chính LogFile, hoặc segment không nén mới nhất nếu LogFile là glob."""
+    if not is_glob_pattern(log_file):
+        return log_file
+    plain = [s for s in segments if not s["compressed"]]
+    return max(plain, key=lambda s: s["last_ts"])["path"] if plain else None
+
+
+def select_segments(segments, start_ts, end_ts):
+    """Chỉ giữ segment giao với cửa sổ: bỏ segment kết thúc trước start_ts hoặc bắt đầu sau end_ts."""
+    return [s for s in segments
+            if s["last_ts"] >= start_ts and (s["first_ts"] is None or s["first_ts"] <= end_ts)]
+
+
+def scan_segment(path, start_ts, timezone_str, end_time_iso):
+    """Đọc một segment (chạy được trong process con). Trả về (văn bản các dòng mới hơn start_ts, số dòng, timestamp mới nhất)."""
+    parse_ts = make_syslog_time_parser(pytz.timezone(timezone_str), datetime.fromisoformat(end_time_iso))
+    lines, latest_ts = [], None
+    with open_log_segment(path) as f:
+        for raw_line in f:
+            log_ts = parse_ts(raw_line[:15].decode('ascii', errors='ignore'))
+            if log_ts is None or log_ts <= start_ts:
+                continue
+            lines.append(raw_line.decode('utf-8', errors='ignore'))
+            if latest_ts is None or log_ts > latest_ts:
+                latest_ts = log_ts
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    return "".join(lines), len(lines), latest_ts
+
+
+def read_archived_segments(segments, start_ts, timezone_str, end_time, workers, firewall_id):
+    """Đọc các segment đã xoay vòng theo thứ tự thời gian; các segment độc lập được giải nén song song bằng process."""
+    args = [(s["path"], start_ts, timezone_str, end_time.isoformat()) for s in segments]
+    if workers > 1 and len(segments) > 1:
+        futures = [submit_to_pool(workers, scan_segment, *arg) for arg in args]
+        outcomes = []
+        for segment, future in zip(segments, futures):
+            try:
+                outcomes.append((segment, future.result()))
+            except Exception as e:
+                outcomes.append((segment, e))
+    else:
+        outcomes = []
+        for segment, arg in zip(segments, args):
+            try:
+                outcomes.append((segment, scan_segment(*arg)))
+            except Exception as e:
+                outcomes.append((segment, e))
+
+    texts, latest_ts = [], None
+    for segment, outcome in outcomes:
+        if isinstance(outcome, Exception):
+            logging.error(f"[{firewall_id}] Lỗi khi đọc segment log '{segment['path']}': {outcome}")
+            continue
+        text, count, segment_latest = outcome
+        logging.info(f"[{firewall_id}] Segment '{segment['path']}': {count} dòng trong cửa sổ.")
+        if text:
+            texts.append(text)
+        if segment_latest is not None and (latest_ts is None or segment_latest > latest_ts):
+            latest_ts = segment_latest
+    return texts, latest_ts
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Nén log theo template (kiểu Drain) và giới hạn theo ngân sách token trước khi đưa vào prompt."""
+
+import ipaddress
+import re
+
+from log_parser import split_syslog_line
+
+CHARS_PER_TOKEN = 4
+WILDCARD = '<*>'
+# Số token đầu (sau số token của dòng) dùng làm khóa nhóm trong cây tiền tố, như tham số depth của Drain
+PREFIX_DEPTH = 2
+IPV6_CANDIDATE = re.compile(r'(?<![\w:])(?:[0-9a-fA-F]{0,4}:){2,7}[0-9a-fA-F]{1,4}(?![\w:])')
+# Thứ tự thay thế quan trọng: MAC và IP phải được che trước số
+MASK_PATTERNS = [
+    (re.compile(r'\b(?:[0-9a-fA-F]{2}[:-]){5}[0-9a-fA-F]{2}\b'), '<MAC>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}(?::\d+)?\b'), '<IP>'),
+    (IPV6_CANDIDATE, None),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b'), '<HEX>'),
+    (re.compile(r'\b\d+\b'), '<NUM>'),
+]
+
+
+def estimate_tokens(text):
+    """Ước lượng số token của một đoạn văn bản (xấp xỉ theo số ký tự)."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _mask_ipv6(match):
+    """Chỉ che chuỗi là địa chỉ IPv6 hợp lệ: giờ dạng 09:00:01 cũng khớp mẫu ứng viên nhưng không phải IP."""
+    text = match.group(0)
+    try:
+        ipaddress.IPv6Address(text)
+    except ValueError:
+        return text
+    return '<IP6>'
+
+
+def mask_message(message):
+    """Che các trường biến đổi (IP, MAC, số, hex) để các dòng cùng dạng có chung template."""
+    for pattern, placeholder in MASK_PATTERNS:
+        message = pattern.sub(placeholder or _mask_ipv6, message)
+    return message
+
+
+def _prefix_key(tokens):
+    """Khóa nhóm: số token và PREFIX_DEPTH token đầu; token chứa chữ số được coi là biến đổi (<*>) như trong Drain."""
+    prefix = tuple(WILDCARD if any(ch.isdigit() for ch in token) else token for token in tokens[:PREFIX_DEPTH])
+    return (len(tokens),) + prefix
+
+
+class LogCluster:
+    """Một nhóm dòng log có chung template."""
+    __slots__ = ('tokens', 'count', 'examples', 'first_seen', 'last_seen')
+
+    def __init__(self, tokens, line, timestamp):
+        self.tokens = tokens
+        self.count = 1
+        self.examples = [line]
+        self.first_seen = timestamp
+        self.last_seen = timestamp
+
+    @property
+    def template(self):
+        return " ".join(self.tokens)
+
+
+class TemplateMiner:
+    """Phân cụm dòng log theo thuật toán Drain đơn giản: nhóm theo số token và các token đầu, so khớp độ tương đồng.
+
+    Dòng có cùng dãy token với một dòng đã gặp được gán thẳng vào cluster cũ, không cần so khớp lại.
+    """
+
+    def __init__(self, similarity_threshold=0.5, max_examples=2):
+        self.similarity_threshold = similarity_threshold
+        self.max_examples = max_examples
+        self.groups = {}
+        self.clusters = []
+        self._seen = {}
+
+    def add_line(self, line):
+        """Đưa một dòng log vào cây phân cụm và trả về cluster tương ứng."""
+        parsed = split_syslog_line(line)
+        if parsed:
+            timestamp, _, program, message = parsed
+            text = f"{program}: {mask_message(message)}"
+        else:
+            timestamp, text = None, mask_message(line.rstrip('\n'))
+        tokens = text.split()
+        if not tokens:
+            return None
+
+        key = tuple(tokens)
+        cluster = self._seen.get(key)
+        if cluster is None:
+            group = self.groups.setdefault(_prefix_key(tokens), [])
+            cluster = self._best_match(group, tokens)
+            if cluster is None:
+                cluster = LogCluster(tokens, line, timestamp)
+                group.append(cluster)
+                self.clusters.append(cluster)
+                self._seen[key] = cluster
+                return cluster
+            self._seen[key] = cluster
+            cluster.tokens = [t if t == c else WILDCARD for t, c in zip(tokens, cluster.tokens)]
+
+        cluster.count += 1
+        if len(cluster.examples) < self.max_examples:
+            cluster.examples.append(line)
+        if timestamp:
+            cluster.first_seen = cluster.first_seen or timestamp
+            cluster.last_seen = timestamp
+        return cluster
+
+    def _best_match(self, group, tokens):
+        """Tìm cluster giống nhất trong nhóm, trả về None nếu dưới ngưỡng tương đồng."""
+        best, best_score = None, -1.0
+        for cluster in group:
+            matched = sum(1 for t, c in zip(tokens, cluster.tokens) if t == c or c == WILDCARD)
+            score = matched / len(tokens)
+            if score > best_score:
+                best, best_score = cluster, score
+        return best if best_score >= self.similarity_threshold else None
+
+
+def compact_log_lines(lines, token_budget, rare_threshold=2):
+    """Nén log: template lặp lại -> 'template × số lần + ví dụ', dòng hiếm giữ nguyên; dừng khi hết ngân sách token.
+
+    Trả về (văn bản đã nén, dict thống kê quá trình nén).
+    """
+    miner = TemplateMiner()
+    for line in lines:
+        miner.add_line(line)
+
+    frequent = sorted((c for c in miner.clusters if c.count > rare_threshold), key=lambda c: c.count, reverse=True)
+    rare = [c for c in miner.clusters if c.count <= rare_threshold]
+
+    parts, used_tokens = [], 0
+    kept_templates, kept_rare_lines = set(), 0
+
+    def try_add(text):
+        nonlocal used_tokens
+        cost = estimate_tokens(text)
+        if used_tokens + cost > token_budget:
+            return False
+        parts.append(text)
+        used_tokens += cost
+        return True
+
+    def add_templates(limit):
+        for cluster in frequent:
+            if id(cluster) in kept_templates:
+                continue
+            if used_tokens >= limit:
+                return
+            seen = f", {cluster.first_seen} -> {cluster.last_seen}" if cluster.first_seen else ""
+            text = f"[x{cluster.count}{seen}] {cluster.template}\n    vd: {cluster.examples[0].rstrip()}"
+            if not try_add(text):
+                return
+            kept_templates.add(id(cluster))
+
+    # Ưu tiên template phổ biến (tối đa nửa ngân sách), sau đó đến các dòng hiếm/mới, rồi phần template còn lại
+    add_templates(token_budget // 2)
+    for cluster in rare:
+        for example in cluster.examples:
+            if not try_add(example.rstrip()):
+                break
+            kept_rare_lines += 1
+    add_templates(token_budget)
+
+    omitted_templates = len(frequent) - len(kept_templates)
+    omitted_rare = sum(len(c.examples) for c in rare) - kept_rare_lines
+    if omitted_templates or omitted_rare:
+        parts.append(f"... (đã lược bỏ {omitted_templates} template và {omitted_rare} dòng hiếm do vượt ngân sách token)")
+
+    stats = {
+        "input_lines": len(lines), "templates": len(frequent), "rare_lines": kept_rare_lines,
+        "omitted_templates": omitted_templates, "omitted_rare_lines": omitted_rare, "estimated_tokens": used_tokens
+    }
+    return "\n".join(parts), stats
+
+
+def build_compacted_prompt_content(aggregator, prompt_lines, token_budget):
+    """Ghép thống kê tổng hợp với phần log đã nén theo template, trong giới hạn ngân sách token."""
+    stats_text = aggregator.to_prompt_text()
+    remaining_budget = max(token_budget - estimate_tokens(stats_text), 0)
+    compacted_text, compaction_stats = compact_log_lines(prompt_lines, remaining_budget)
+    content = (f"{stats_text}\n\n--- LOG ĐÃ NÉN THEO TEMPLATE ([xN] = số lần lặp lại, <IP>/<NUM>/<*> = trường thay đổi; "
+               f"các dòng không có [xN] là log hiếm được giữ nguyên) ---\n{compacted_text}")
+    return content, compaction_stats
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""Sinh log pfSense tổng hợp (filterlog, dhcpd, openvpn, unbound) cho benchmark: tốc độ, số IP và các đợt tấn công tùy chỉnh.
+
+Chạy: python log_generator.py filter.log --size-mb 100 --rate 500 --ip-cardinality 20000 --attack-bursts 3
+"""
+
+import argparse
+import random
+from datetime import datetime, timedelta
+
+import pytz
+
+DEFAULT_MIX = {"filterlog": 0.85, "dhcpd": 0.05, "openvpn": 0.05, "unbound": 0.05}
+# Số bản tin dựng sẵn cho mỗi loại; mỗi giây chỉ cần chọn ngẫu nhiên từ pool thay vì định dạng lại từng dòng
+MESSAGE_POOL_SIZE = 16384
+MAX_MESSAGE_POOL_SIZE = 262144
+INTERFACES = (("igb0", 0.6), ("igb1", 0.2), ("igb1.10", 0.1), ("igb1.16", 0.05), ("ovpns1", 0.05))
+BLOCKED_PORTS = (22, 23, 445, 3389, 1433, 3306, 5900, 8080, 8443, 25, 53, 123)
+ALLOWED_PORTS = (443, 80, 53, 123, 993, 587, 1194, 22)
+DHCP_MESSAGES = ("DHCPDISCOVER from {mac} via {iface}", "DHCPOFFER on {ip} to {mac} via {iface}",
+                 "DHCPREQUEST for {ip} from {mac} via {iface}", "DHCPACK on {ip} to {mac} via {iface}")
+OPENVPN_MESSAGES = ("user_{n}/{ip}:{port} peer info: IV_VER=2.6.8",
+                    "{ip}:{port} [user_{n}] Peer Connection Initiated with [AF_INET]{ip}:{port}",
+                    "user_{n}/{ip}:{port} Connection reset, restarting [0]",
+                    "{ip}:{port} TLS Error: TLS handshake failed",
+                    "user_{n}/{ip}:{port} [user_{n}] Inactivity timeout (--ping-restart), restarting")
+UNBOUND_MESSAGES = ("[{pid}:0] info: generate keytag query _ta-4f66. NULL IN",
+                    "[{pid}:0] notice: sendto failed: Permission denied",
+                    "[{pid}:1] warning: did not exit gracefully last time ({n})",
+                    "[{pid}:0] error: SERVFAIL <example{n}.com. A IN>: exceeded the maximum nameserver nxdomains",
+                    "[{pid}:0] info: service stopped (unbound 1.19.3).")
+
+
+def _random_public_ip(rng):
+    """IP công cộng ngẫu nhiên (tránh các dải nội bộ để nhãn IP và baseline phân loại đúng)."""
+    while True:
+        first = rng.randint(1, 223)
+        if first not in (10, 100, 127, 169, 172, 192):
+            return f"{first}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+
+
+def _filterlog_message(action, interface, src_ip, dst_ip, dst_port, rng, tracker=1000000103):
+    protocol, proto_id = ("udp", 17) if dst_port in (53, 123, 1194) else ("tcp", 6)
+    src_port = rng.randint(1024, 65535)
+    tail = f"{src_port},{dst_port},40" if protocol == "udp" else f"{src_port},{dst_port},0,S,{rng.randint(1, 2 ** 31)},,64240,,mss"
+    return (f"filterlog[4242]: 5,,,{tracker},{interface},match,{action},in,4,0x0,,64,{rng.randint(1, 65535)},0,DF,"
+            f"{proto_id},{protocol},60,{src_ip},{dst_ip},{tail}")
+
+
+class SyntheticLogGenerator:
+    """Dòng log syslog BSD theo thứ tự thời gian với tốc độ nền cố định và các đợt tấn công chèn thêm."""
+
+    def __init__(self, lines_per_second=500, ip_cardinality=5000, attack_bursts=0, burst_seconds=300,
+                 burst_lines_per_second=200, mix=None, hostname="pfSense", seed=42):
+        self.lines_per_second = lines_per_second
+        self.attack_bursts = attack_bursts
+        self.burst_seconds = burst_seconds
+        self.burst_lines_per_second = burst_lines_per_second
+        self.hostname = hostname
+        self.rng = random.Random(seed)
+        mix = mix or DEFAULT_MIX
+        self.programs = list(mix)
+        self.weights = [mix[p] for p in self.programs]
+
+        rng = self.rng
+        pool_size = max(MESSAGE_POOL_SIZE, min(ip_cardinality * 2, MAX_MESSAGE_POOL_SIZE))
+        external = [_random_public_ip(rng) for _ in range(ip_cardinality)]
+        internal = [f"192.168.{rng.choice((1, 10, 16))}.{rng.randint(2, 254)}" for _ in range(max(16, ip_cardinality // 20))]
+        interfaces, interface_weights = zip(*INTERFACES)
+
+        filterlog = []
+        for _ in range(pool_size):
+            if rng.random() < 0.7:
+                filterlog.append(_filterlog_message("block", rng.choices(interfaces, interface_weights)[0],
+                                                    rng.choice(external), rng.choice(internal),
+                                                    rng.choice(BLOCKED_PORTS), rng))
+            else:
+                filterlog.append(_filterlog_message("pass", rng.choice(interfaces[1:]), rng.choice(internal),
+                                                    rng.choice(external), rng.choice(ALLOWED_PORTS), rng))
+        self.pools = {
+            "filterlog": filterlog,
+            "dhcpd": ["dhcpd[3012]: " + rng.choice(DHCP_MESSAGES).format(
+                ip=rng.choice(internal), iface=rng.choice(("igb1", "igb1.10", "igb1.16")),
+                mac=":".join(f"{rng.randint(0, 255):02x}" for _ in range(6))) for _ in range(MESSAGE_POOL_SIZE // 4)],
+            "openvpn": ["openvpn[5511]: " + rng.choice(OPENVPN_MESSAGES).format(
+                ip=rng.choice(external), port=rng.randint(1024, 65535), n=rng.randint(1, 200))
+                for _ in range(MESSAGE_POOL_SIZE // 4)],
+            "unbound": [f"unbound[{pid}]: " + rng.choice(UNBOUND_MESSAGES).format(pid=pid, n=rng.randint(1, 9999))
+                        for pid in [rng.randint(10000, 99999) for _ in range(MESSAGE_POOL_SIZE // 4)]],
+        }
+        self.average_line_bytes = 16 + len(hostname) + 2 + sum(
+            weight * sum(map(len, self.pools[program][:256])) / 256
+            for program, weight in zip(self.programs, self.weights))
+
+    def _burst_pool(self):
+        """Một đợt tấn công: một IP quét cổng, dò mật khẩu SSH hoặc dò mật khẩu OpenVPN."""
+        rng = self.rng
+        attacker = _random_public_ip(rng)
+        kind = rng.choice(("portscan", "ssh_bruteforce", "openvpn_bruteforce"))
+        if kind == "portscan":
+            return [_filterlog_message("block", "igb0", attacker, "203.0.113.2", port, rng)
+                    for port in rng.sample(range(1, 65536), 4096)]
+        if kind == "ssh_bruteforce":
+            return [_filterlog_message("block", "igb0", attacker, "203.0.113.2", 22, rng) for _ in range(256)]
+        return [f"openvpn[5511]: {attacker}:{rng.randint(1024, 65535)} TLS Auth Error: Auth Username/Password "
+                f"verification failed for peer (AUTH_FAILED)" for _ in range(256)]
+
+    def iter_seconds(self, start, seconds):
+        """Sinh từng khối văn bản (một giây log) từ thời điểm start trong `seconds` giây."""
+        rng = self.rng
+        bursts = {}
+        for _ in range(self.attack_bursts):
+            begin = rng.randrange(max(1, seconds - self.burst_seconds))
+            bursts.setdefault(begin, []).append((begin + self.burst_seconds, self._burst_pool()))
+        active = []
+        moment = start
+        for second in range(seconds):
+            if second in bursts:
+                active.extend(bursts.pop(second))
+            active = [burst for burst in active if burst[0] > second]
+            prefix = f"{moment.strftime('%b %d %H:%M:%S')} {self.hostname} "
+            messages = []
+            for program, count in zip(self.programs, self._split_rate(self.lines_per_second)):
+                if count:
+                    messages.extend(rng.choices(self.pools[program], k=count))
+            for _, pool in active:
+                messages.extend(rng.choices(pool, k=self.burst_lines_per_second))
+            if messages:
+                yield prefix + ("\n" + prefix).join(messages) + "\n"
+            moment += timedelta(seconds=1)
+
+    def _split_rate(self, total):
+        counts = [int(total * weight) for weight in self.weights]
+        counts[0] += total - sum(counts)
+        return counts
+
+    def write(self, path, size_bytes, end_time):
+        """Ghi file log khoảng size_bytes byte, kết thúc tại end_time. Trả về (số byte, số giây log)."""
+        burst_bytes = self.attack_bursts * self.burst_seconds * self.burst_lines_per_second * self.average_line_bytes
+        # Đợt tấn công chiếm tối đa một nửa kích thước, phần còn lại là lưu lượng nền
+        burst_bytes = min(burst_bytes, size_bytes / 2)
+        seconds = max(1, int((size_bytes - burst_bytes) / (self.lines_per_second * self.average_line_bytes)))
+        written = 0
+        with open(path, 'w', encoding='utf-8') as f:
+            for chunk in self.iter_seconds(end_time - timedelta(seconds=seconds), seconds):
+                f.write(chunk)
+                written += len(chunk)
+        return written, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sinh log pfSense tổng hợp cho benchmark.")
+    parser.add_argument("path", help="File log cần ghi.")
+    parser.add_argument("--size-mb", type=float, default=10, help="Kích thước xấp xỉ (MB).")
+    parser.add_argument("--rate", type=int, default=500, help="Số dòng log nền mỗi giây.")
+    parser.add_argument("--ip-cardinality", type=int, default=5000, help="Số IP bên ngoài khác nhau.")
+    parser.add_argument("--attack-bursts", type=int, default=0, help="Số đợt tấn công chèn vào.")
+    parser.add_argument("--burst-seconds", type=int, default=300, help="Thời lượng mỗi đợt tấn công (giây).")
+    parser.add_argument("--burst-rate", type=int, default=200, help="Số dòng mỗi giây trong đợt tấn công.")
+    parser.add_argument("--timezone", default="Asia/Ho_Chi_Minh")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    generator = SyntheticLogGenerator(args.rate, args.ip_cardinality, args.attack_bursts, args.burst_seconds,
+                                      args.burst_rate, seed=args.seed)
+    written, seconds = generator.write(args.path, int(args.size_mb * 1024 * 1024),
+                                       datetime.now(pytz.timezone(args.timezone)))
+    print(f"Đã ghi {written / 1024 / 1024:,.1f} MB log ({seconds / 3600:.1f} giờ) vào '{args.path}'.")
+
+
+if __name__ == "__main__":
+    main()
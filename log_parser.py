@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Parser dạng streaming cho log pfSense (filterlog, dhcpd, openvpn, unbound) và bộ tổng hợp thống kê."""
+
+import re
+from collections import Counter
+from datetime import datetime
+
+OPENVPN_PEER_PATTERN = re.compile(r'(\d{1,3}(?:\.\d{1,3}){3}):\d+')
+DHCP_PATTERN = re.compile(r'^(DHCP[A-Z]+) (?:on|for|from) (\S+)(?: (?:to|from) (\S+))?.*? via (\S+)')
+UNBOUND_LEVEL_PATTERN = re.compile(r'\b(info|notice|warning|error|debug):')
+# Các chiều thống kê cho filterlog, khóa của Counter là (action, giá trị)
+FILTERLOG_DIMENSIONS = ('interface', 'src_ip', 'dst_ip', 'dst_port', 'protocol')
+SYSLOG_TIME_CACHE_SIZE = 100000
+SYSLOG_MONTHS = {m: i for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                             'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], start=1)}
+
+
+def split_syslog_line(line):
+    """Tách một dòng syslog BSD thành (timestamp, hostname, program, message). Trả về None nếu sai định dạng."""
+    if len(line) < 17 or line[15:16] != ' ':
+        return None
+    parts = line[16:].rstrip('\n').split(' ', 1)
+    if len(parts) != 2:
+        return None
+    hostname, rest = parts
+    tag, sep, message = rest.partition(': ')
+    if not sep:
+        return None
+    return line[:15], hostname, tag.split('[', 1)[0], message
+
+
+def _syslog_minute_epoch(prefix, tz, end_ts, year):
+    """Chuyển prefix 'Mmm dd HH:MM' thành epoch (giây) của phút đó, xử lý chuyển năm."""
+    month = SYSLOG_MONTHS.get(prefix[:3])
+    if month is None or prefix[3:4] != ' ' or prefix[6:7] != ' ' or prefix[9:10] != ':':
+        return None
+    try:
+        day, hour, minute = int(prefix[4:6]), int(prefix[7:9]), int(prefix[10:12])
+        minute_epoch = tz.localize(datetime(year, month, day, hour, minute)).timestamp()
+        if minute_epoch > end_ts:
+            minute_epoch = tz.localize(datetime(year - 1, month, day, hour, minute)).timestamp()
+    except ValueError:
+        return None
+    return minute_epoch
+
+
+def make_syslog_time_parser(tz, end_time):
+    """Tạo hàm parse timestamp syslog (trả về epoch giây) có cache theo prefix 'Mmm dd HH:MM'."""
+    cache = {}
+    end_ts = end_time.timestamp()
+    year = end_time.year
+
+    def parse(line):
+        prefix = line[:12]
+        minute_epoch = cache.get(prefix, False)
+        if minute_epoch is False:
+            if len(cache) >= SYSLOG_TIME_CACHE_SIZE:
+                cache.clear()
+            minute_epoch = cache[prefix] = _syslog_minute_epoch(prefix, tz, end_ts, year)
+        if minute_epoch is None or line[12:13] != ':':
+            return None
+        seconds = line[13:15]
+        if not seconds.isdigit():
+            return None
+        return minute_epoch + int(seconds)
+
+    return parse
+
+
+def parse_filterlog(message):
+    """Parse phần CSV của filterlog (IPv4/IPv6), chỉ lấy các trường cần đếm.
+
+    Trả về (action, interface, protocol, src_ip, dst_ip, dst_port) hoặc None; dst_port là None nếu không phải TCP/UDP.
+    """
+    fields = message.split(',')
+    if len(fields) < 9:
+        return None
+    ip_version = fields[8]
+    if ip_version == '4' and len(fields) >= 20:
+        protocol, src_ip, dst_ip, port_index = fields[16], fields[18], fields[19], 20
+    elif ip_version == '6' and len(fields) >= 17:
+        protocol, src_ip, dst_ip, port_index = fields[12], fields[15], fields[16], 17
+    else:
+        return None
+    dst_port = None
+    if protocol in ('tcp', 'udp') and len(fields) > port_index + 1:
+        dst_port = fields[port_index + 1]
+    return fields[6], fields[4], protocol, src_ip, dst_ip, dst_port
+
+
+class LogAggregator:
+    """Tổng hợp số đếm chính xác trong một lượt duyệt log; có thể gộp (merge) nhiều bộ tổng hợp."""
+
+    def __init__(self):
+        self.total_lines = 0
+        self.actions = Counter()
+        self.filterlog = {dimension: Counter() for dimension in FILTERLOG_DIMENSIONS}
+        self.dhcp_messages = Counter()
+        self.dhcp_interfaces = Counter()
+        self.openvpn_events = Counter()
+        self.openvpn_peers = Counter()
+        self.unbound_levels = Counter()
+        self.programs = Counter()
+        # IPEnricher (ip_enrichment.py) dùng để gắn nhãn IP trong thống kê, None nếu không có config pfSense
+        self.ip_enricher = None
+
+    def add_line(self, line):
+        """Đưa một dòng log vào bộ tổng hợp. Trả về tên chương trình đã nhận diện (hoặc None)."""
+        self.total_lines += 1
+        parsed = split_syslog_line(line)
+        if parsed is None:
+            return None
+        _, _, program, message = parsed
+        self.programs[program] += 1
+
+        if program == 'filterlog':
+            fields = parse_filterlog(message)
+            if fields is not None:
+                self.add_filterlog(*fields)
+        elif program == 'dhcpd':
+            match = DHCP_PATTERN.match(message)
+            if match:
+                self.dhcp_messages[match.group(1)] += 1
+                self.dhcp_interfaces[match.group(4)] += 1
+            else:
+                self.dhcp_messages['other'] += 1
+        elif program == 'openvpn':
+            self.openvpn_events[_classify_openvpn(message)] += 1
+            peer = OPENVPN_PEER_PATTERN.search(message)
+            if peer:
+                self.openvpn_peers[peer.group(1)] += 1
+        elif program == 'unbound':
+            level = UNBOUND_LEVEL_PATTERN.search(message)
+            self.unbound_levels[level.group(1) if level else 'other'] += 1
+        return program
+
+    def add_filterlog(self, action, interface, protocol, src_ip, dst_ip, dst_port):
+        """Cộng dồn các trường của một dòng filterlog vào các bộ đếm."""
+        self.actions[action] += 1
+        counters = self.filterlog
+        counters['interface'][(action, interface)] += 1
+        counters['src_ip'][(action, src_ip)] += 1
+        counters['dst_ip'][(action, dst_ip)] += 1
+        counters['protocol'][(action, protocol)] += 1
+        if dst_port:
+            counters['dst_port'][(action, f"{protocol}/{dst_port}")] += 1
+
+    def merge(self, other):
+        """Gộp kết quả của một bộ tổng hợp khác vào bộ này."""
+        self.total_lines += other.total_lines
+        self.actions.update(other.actions)
+        for dimension in FILTERLOG_DIMENSIONS:
+            self.filterlog[dimension].update(other.filterlog[dimension])
+        self.dhcp_messages.update(other.dhcp_messages)
+        self.dhcp_interfaces.update(other.dhcp_interfaces)
+        self.openvpn_events.update(other.openvpn_events)
+        self.openvpn_peers.update(other.openvpn_peers)
+        self.unbound_levels.update(other.unbound_levels)
+        self.programs.update(other.programs)
+        return self
+
+    def top(self, dimension, action=None, n=10):
+        """Lấy n giá trị phổ biến nhất của một chiều, có thể lọc theo action (block/pass)."""
+        counts = Counter()
+        for (record_action, value), count in self.filterlog[dimension].items():
+            if action is None or record_action == action:
+                counts[value] += count
+        return counts.most_common(n)
+
+    def relevant_entities(self, top_n=50):
+        """Các IP và tên interface nổi bật trong cửa sổ log, dùng để lọc bối cảnh bổ sung."""
+        ips = {ip for dimension in ('src_ip', 'dst_ip') for ip, _ in self.top(dimension, n=top_n)}
+        ips.update(ip for ip, _ in self.openvpn_peers.most_common(top_n))
+        names = {interface for interface, _ in self.top('interface', n=top_n)}
+        names.update(interface for interface, _ in self.dhcp_interfaces.most_common(top_n))
+        return ips, names
+
+    def summary_stats(self):
+        """Các chỉ số chính xác dùng để điền vào summary_stats của báo cáo."""
+        top_blocked_src = self.top('src_ip', 'block', 1)
+        top_blocked_port = self.top('dst_port', 'block', 1)
+        stats = {
+            "total_log_lines": self.total_lines,
+            "total_filterlog_events": sum(self.actions.values()),
+            "total_blocked_events": self.actions.get('block', 0),
+            "total_passed_events": self.actions.get('pass', 0),
+            "top_blocked_source_ip": top_blocked_src[0][0] if top_blocked_src else "N/A",
+            "top_blocked_destination_port": top_blocked_port[0][0] if top_blocked_port else "N/A",
+            "unique_blocked_source_ips": sum(1 for action, _ in self.filterlog['src_ip'] if action == 'block'),
+            "dhcp_events": sum(self.dhcp_messages.values()),
+            "openvpn_auth_failures": self.openvpn_events.get('auth_failed', 0),
+            "unbound_errors": self.unbound_levels.get('error', 0)
+        }
+        if self.ip_enricher is not None:
+            stats.update(self.ip_enricher.summary_stats(self))
+        return stats
+
+    def to_prompt_text(self, top_n=10):
+        """Trình bày thống kê dạng văn bản gọn để đưa vào prompt thay cho phần lớn log thô."""
+        lines = ["--- THỐNG KÊ TỔNG HỢP (tính chính xác từ toàn bộ log trong kỳ) ---",
+                 f"Tổng số dòng log: {self.total_lines}",
+                 f"Số dòng theo chương trình: {_format_counts(self.programs.most_common(top_n))}",
+                 f"Filterlog theo action: {_format_counts(self.actions.most_common())}"]
+        for action in ('block', 'pass'):
+            if not self.actions.get(action):
+                continue
+            lines.append(f"[{action}] Theo interface: {_format_counts(self.top('interface', action, top_n))}")
+            lines.append(f"[{action}] IP nguồn nhiều nhất: {self._format_ips(self.top('src_ip', action, top_n))}")
+            lines.append(f"[{action}] IP đích nhiều nhất: {self._format_ips(self.top('dst_ip', action, top_n))}")
+            lines.append(f"[{action}] Cổng đích nhiều nhất: {_format_counts(self.top('dst_port', action, top_n))}")
+            lines.append(f"[{action}] Giao thức: {_format_counts(self.top('protocol', action, top_n))}")
+        if self.dhcp_messages:
+            lines.append(f"DHCP theo loại bản tin: {_format_counts(self.dhcp_messages.most_common(top_n))}")
+            lines.append(f"DHCP theo interface: {_format_counts(self.dhcp_interfaces.most_common(top_n))}")
+        if self.openvpn_events:
+            lines.append(f"OpenVPN theo sự kiện: {_format_counts(self.openvpn_events.most_common(top_n))}")
+            lines.append(f"OpenVPN IP peer: {self._format_ips(self.openvpn_peers.most_common(top_n))}")
+        if self.unbound_levels:
+            lines.append(f"Unbound theo mức độ: {_format_counts(self.unbound_levels.most_common(top_n))}")
+        if self.ip_enricher is not None:
+            lines.extend(self.ip_enricher.prompt_lines(self, top_n))
+        lines.append("--- KẾT THÚC THỐNG KÊ TỔNG HỢP ---")
+        return "\n".join(lines)
+
+    def _format_ips(self, items):
+        """Như _format_counts, kèm nhãn [interface/VLAN, alias, host, nội bộ/bên ngoài] nếu có IPEnricher."""
+        if self.ip_enricher is None or not items:
+            return _format_counts(items)
+        return ", ".join(f"{ip} [{self.ip_enricher.short_label(ip)}] ({count})" for ip, count in items)
+
+
+def _classify_openvpn(message):
+    """Phân loại sự kiện OpenVPN theo nội dung bản tin."""
+    lowered = message.lower()
+    if 'auth_failed' in lowered or 'authentication failed' in lowered or 'auth-failure' in lowered:
+        return 'auth_failed'
+    if 'peer connection initiated' in lowered:
+        return 'connected'
+    if 'tls error' in lowered or 'tls handshake failed' in lowered:
+        return 'tls_error'
+    if 'connection reset' in lowered or 'inactivity timeout' in lowered or 'client-instance exiting' in lowered:
+        return 'disconnected'
+    return 'other'
+
+
+def _format_counts(items):
+    """Định dạng danh sách (giá trị, số đếm) thành chuỗi ngắn."""
+    return ", ".join(f"{value} ({count})" for value, count in items) if items else "không có"
+
+
+def aggregate_log_lines(lines, filterlog_sample_limit=50):
+    """Duyệt log một lần: tính thống kê, giữ log không phải filterlog và một số dòng filterlog mẫu."""
+    aggregator = LogAggregator()
+    prompt_lines = []
+    filterlog_samples = 0
+    for line in lines:
+        program = aggregator.add_line(line)
+        if program == 'filterlog':
+            if filterlog_samples >= filterlog_sample_limit:
+                continue
+            filterlog_samples += 1
+        prompt_lines.append(line)
+    return aggregator, prompt_lines
+
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""Hàng đợi email gửi đi: spool ra đĩa, gửi qua kết nối SMTP dùng lại, thử lại với backoff, cache phần MIME đã mã hóa."""
+
+import base64
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import smtplib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from email.mime.base import MIMEBase
+
+from metrics import record
+
+MAX_BACKOFF_SECONDS = 3600
+# Giới hạn cache phần MIME: số bản mã hóa và tổng dung lượng base64 giữ trong bộ nhớ
+PART_CACHE_MAX_ENTRIES = 64
+PART_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# sha256 -> base64 (LRU); (path, mtime, size) -> sha256 (LRU) để không phải đọc lại file chưa đổi
+_part_cache = OrderedDict()
+_part_cache_bytes = 0
+_part_digests = OrderedDict()
+_part_cache_lock = threading.Lock()
+
+
+# --- Cache phần MIME theo hash nội dung file ---
+
+def _encoded_file(path):
+    """Trả về (sha256, base64) của file; chỉ đọc và mã hóa lại khi path/mtime/size thay đổi.
+
+    Cache giới hạn theo PART_CACHE_MAX_ENTRIES/PART_CACHE_MAX_BYTES, bỏ bản ít dùng nhất trước (LRU).
+    """
+    global _part_cache_bytes
+    stat = os.stat(path)
+    stat_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    with _part_cache_lock:
+        digest = _part_digests.get(stat_key)
+        encoded = _part_cache.get(digest) if digest else None
+        if encoded is not None:
+            _part_digests.move_to_end(stat_key)
+            _part_cache.move_to_end(digest)
+            return digest, encoded
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    with _part_cache_lock:
+        # Hai đường dẫn khác nhau cùng nội dung dùng chung bản mã hóa
+        encoded = _part_cache.get(digest)
+        if encoded is None:
+            encoded = base64.encodebytes(data).decode('ascii')
+            if len(encoded) > PART_CACHE_MAX_BYTES:
+                return digest, encoded
+            _part_cache[digest] = encoded
+            _part_cache_bytes += len(encoded)
+        _part_cache.move_to_end(digest)
+        _part_digests[stat_key] = digest
+        _part_digests.move_to_end(stat_key)
+        while len(_part_cache) > PART_CACHE_MAX_ENTRIES or _part_cache_bytes > PART_CACHE_MAX_BYTES:
+            _, evicted = _part_cache.popitem(last=False)
+            _part_cache_bytes -= len(evicted)
+        while len(_part_digests) > PART_CACHE_MAX_ENTRIES:
+            _part_digests.popitem(last=False)
+    return digest, encoded
+
+
+def cached_mime_part(path, content_id=None, attachment=False):
+    """Tạo phần MIME từ file với payload base64 đã cache (ảnh nhúng theo Content-ID hoặc file đính kèm)."""
+    _, encoded = _encoded_file(path)
+    mime_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    maintype, subtype = mime_type.split('/', 1)
+    file_name = os.path.basename(path)
+    part = MIMEBase(maintype, subtype, name=file_name)
+    part.set_payload(encoded)
+    part['Content-Transfer-Encoding'] = 'base64'
+    if content_id:
+        part.add_header('Content-ID', f'<{content_id}>')
+    if attachment:
+        part.add_header('Content-Disposition', 'attachment', filename=file_name)
+    return part
+
+
+# --- Kết nối SMTP dùng lại ---
+
+class SMTPConnectionPool:
+    """Giữ một kết nối SMTP đã xác thực và dùng lại giữa các email; tự kết nối lại khi hết hạn hoặc bị ngắt."""
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True, idle_timeout=60, timeout=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.connection = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            server.starttls()
+        if self.username and self.password:
+            server.login(self.username, self.password)
+        return server
+
+    def _usable(self):
+        if self.connection is None or time.monotonic() - self.last_used > self.idle_timeout:
+            return False
+        try:
+            return self.connection.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def send(self, from_addr, to_addrs, message_bytes):
+        """Gửi một email qua kết nối đang giữ (hoặc kết nối mới nếu cần)."""
+        with self.lock:
+            if not self._usable():
+                self.close_locked()
+                self.connection = self._connect()
+            try:
+                self.connection.sendmail(from_addr, to_addrs, message_bytes)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                self.close_locked()
+                raise
+            self.last_used = time.monotonic()
+
+    def close_locked(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def close(self):
+        with self.lock:
+            self.close_locked()
+
+
+# --- Hàng đợi spool trên đĩa ---
+
+class MailOutbox:
+    """Email được ghi ra thư mục spool trước, sau đó mới gửi; lỗi tạm thời sẽ được thử lại ở các lần flush sau."""
+
+    def __init__(self, spool_dir, pool, max_attempts=8, backoff_base_seconds=30):
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, "failed")
+        self.pool = pool
+        self.max_attempts = max_attempts
+        self.backoff_base_seconds = backoff_base_seconds
+        self.flush_lock = threading.Lock()
+        self.flush_requested = threading.Event()
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def enqueue(self, firewall_id, message, from_addr, to_addrs):
+        """Ghi email đã render vào spool, trả về mã email."""
+        message_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        eml_path = os.path.join(self.spool_dir, f"{message_id}.eml")
+        with open(f"{eml_path}.tmp", 'wb') as f:
+            f.write(message.as_bytes())
+        os.replace(f"{eml_path}.tmp", eml_path)
+        self._write_meta(message_id, {"firewall_id": firewall_id, "from": from_addr, "to": to_addrs,
+                                      "subject": message['Subject'], "attempts": 0, "next_attempt": 0,
+                                      "last_error": None})
+        logging.info(f"[{firewall_id}] Đã đưa email vào hàng đợi: {message_id} ({os.path.getsize(eml_path)} bytes)")
+        return message_id
+
+    def _meta_path(self, message_id):
+        return os.path.join(self.spool_dir, f"{message_id}.json")
+
+    def _write_meta(self, message_id, meta):
+        meta_path = self._meta_path(message_id)
+        with open(f"{meta_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(f"{meta_path}.tmp", meta_path)
+
+    def pending(self):
+        """Danh sách mã email đang chờ gửi (cũ nhất trước)."""
+        return sorted(name[:-5] for name in os.listdir(self.spool_dir) if name.endswith('.json'))
+
+    def flush(self):
+        """Gửi các email đến hạn. Trả về số email đã gửi.
+
+        Nếu đang có lần flush khác chạy thì chỉ đánh dấu yêu cầu và trả về ngay: lần flush đang chạy sẽ quét lại spool
+        trước khi kết thúc nên email vừa đưa vào hàng đợi không phải chờ đến chu kỳ flush sau.
+        """
+        sent = 0
+        self.flush_requested.set()
+        while self.flush_requested.is_set():
+            if not self.flush_lock.acquire(blocking=False):
+                return sent
+            try:
+                while self.flush_requested.is_set():
+                    self.flush_requested.clear()
+                    sent += self._flush_due()
+            finally:
+                self.flush_lock.release()
+            # Yêu cầu đến sau lần kiểm tra cuối nhưng trước khi nhả khóa: vòng ngoài sẽ tự flush tiếp
+        return sent
+
+    def _flush_due(self):
+        sent = 0
+        now = time.time()
+        for message_id in self.pending():
+            try:
+                with open(self._meta_path(message_id), 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if meta["next_attempt"] > now:
+                continue
+            if self._deliver(message_id, meta):
+                sent += 1
+        return sent
+
+    def _deliver(self, message_id, meta):
+        firewall_id = meta["firewall_id"]
+        eml_path = os.path.join(self.spool_dir, f"{message_id}.eml")
+        try:
+            with open(eml_path, 'rb') as f:
+                message_bytes = f.read()
+            started = time.perf_counter()
+            self.pool.send(meta["from"], meta["to"], message_bytes)
+            record(firewall_id, emails_sent=1, email_bytes=len(message_bytes),
+                   email_send_seconds=time.perf_counter() - started)
+        except Exception as e:
+            record(firewall_id, emails_failed=1)
+            meta["attempts"] += 1
+            meta["last_error"] = str(e)
+            permanent = isinstance(e, smtplib.SMTPResponseException) and e.smtp_code >= 500
+            if permanent or meta["attempts"] >= self.max_attempts:
+                logging.error(f"[{firewall_id}] Gửi email {message_id} thất bại hẳn sau {meta['attempts']} lần: {e}")
+                self._write_meta(message_id, meta)
+                for path in (eml_path, self._meta_path(message_id)):
+                    if os.path.exists(path):
+                        os.replace(path, os.path.join(self.failed_dir, os.path.basename(path)))
+                return False
+            delay = min(MAX_BACKOFF_SECONDS, self.backoff_base_seconds * (2 ** (meta["attempts"] - 1)))
+            meta["next_attempt"] = time.time() + delay
+            self._write_meta(message_id, meta)
+            logging.warning(f"[{firewall_id}] Lỗi khi gửi email {message_id} (lần {meta['attempts']}), thử lại sau {delay} giây: {e}")
+            return False
+
+        os.remove(self._meta_path(message_id))
+        os.remove(eml_path)
+        logging.info(f"[{firewall_id}] Email {message_id} đã được gửi thành công!")
+        return True
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def create_mail_outbox(config):
+    """Tạo hàng đợi email từ section [Email] của config."""
+    pool = SMTPConnectionPool(config.get('Email', 'SMTPServer'), config.getint('Email', 'SMTPPort'),
+                              username=config.get('Email', 'SenderEmail', fallback=None),
+                              password=config.get('Email', 'SenderPassword', fallback=None),
+                              use_tls=config.getboolean('Email', 'SMTPUseTLS', fallback=True),
+                              idle_timeout=config.getint('Email', 'SMTPIdleTimeoutSeconds', fallback=60))
+    return MailOutbox(config.get('Email', 'SpoolDirectory', fallback='.mail_spool'), pool,
+                      max_attempts=config.getint('Email', 'MaxSendAttempts', fallback=8),
+                      backoff_base_seconds=config.getint('Email', 'RetryBackoffSeconds', fallback=30))
+
+
+def configure_mail_outbox(config):
+    """Thiết lập hàng đợi email dùng chung (gọi khi khởi động hoặc khi nạp lại config)."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is not None:
+            _outbox.pool.close()
+        _outbox = create_mail_outbox(config)
+    return _outbox
+
+
+def get_mail_outbox(config):
+    """Lấy hàng đợi email dùng chung, tự tạo từ config nếu chưa được thiết lập."""
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = create_mail_outbox(config)
+        return _outbox
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""Đo từng bước của chu kỳ phân tích (span, bộ đếm), xuất metrics Prometheus (textfile/HTTP) và bản ghi JSON cho mỗi lần chạy."""
+
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRIC_PREFIX = "pfsense_analyzer_"
+RUN_RECORD_SUFFIX = ".run.json"
+PROFILE_SUFFIX = ".prof"
+# Bộ đếm được ghi qua record(): tên -> mô tả (xuất thành <tên>_total theo firewall)
+COUNTER_HELP = {
+    "log_bytes": "Số byte log đã đọc.",
+    "log_lines": "Số dòng log đã đọc.",
+    "prompt_chars": "Số ký tự prompt gửi tới Gemini.",
+    "prompt_tokens": "Số token prompt (theo usage_metadata, hoặc ước lượng).",
+    "response_tokens": "Số token phản hồi của Gemini (theo usage_metadata, hoặc ước lượng).",
+    "gemini_requests": "Số lần gọi Gemini thành công.",
+    "gemini_retries": "Số lần thử lại Gemini do lỗi tạm thời.",
+    "gemini_errors": "Số lần gọi Gemini thất bại hẳn.",
+    "gemini_cache_hits": "Số phản hồi lấy từ cache thay vì gọi Gemini.",
+    "gemini_latency_seconds": "Tổng thời gian chờ Gemini (giây).",
+    "llm_skipped": "Số cửa sổ yên tĩnh không cần gọi Gemini.",
+    "emails_sent": "Số email gửi thành công.",
+    "emails_failed": "Số lần gửi email thất bại.",
+    "email_bytes": "Tổng kích thước email đã gửi (byte).",
+    "email_send_seconds": "Tổng thời gian gửi email qua SMTP (giây).",
+    "section_timeouts": "Số lần xử lý firewall vượt SectionTimeoutSeconds và bị hủy.",
+}
+METRIC_HELP = {
+    "stage_seconds_total": ("counter", "Tổng thời gian của từng bước trong chu kỳ (giây)."),
+    "stage_runs_total": ("counter", "Số lần chạy của từng bước."),
+    "stage_last_seconds": ("gauge", "Thời gian của lần chạy gần nhất của từng bước (giây)."),
+    "stage_lines_per_second": ("gauge", "Số dòng/giây của lần chạy gần nhất của bước có đếm dòng."),
+    "cycles_total": ("counter", "Số chu kỳ theo trạng thái."),
+    "cycle_last_seconds": ("gauge", "Thời gian của chu kỳ gần nhất (giây)."),
+    "cycle_last_success_timestamp_seconds": ("gauge", "Thời điểm (epoch) chu kỳ gần nhất tạo được báo cáo."),
+    **{f"{name}_total": ("counter", help_text) for name, help_text in COUNTER_HELP.items()},
+}
+
+_active_cycles = {}
+_active_cycles_lock = threading.Lock()
+# firewall_id -> thời điểm (time.monotonic) phải dừng xử lý firewall đó
+_deadlines = {}
+_deadlines_lock = threading.Lock()
+_settings = {"textfile_path": None, "run_records": True, "listen": None}
+_server = None
+_server_lock = threading.Lock()
+
+
+class MetricsRegistry:
+    """Các giá trị metric theo (tên, nhãn), an toàn khi dùng từ nhiều thread; render theo định dạng text của Prometheus."""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        lines, current = [], None
+        for (name, labels), value in items:
+            if name != current:
+                metric_type, help_text = METRIC_HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+                lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+                current = name
+            label_text = ",".join(f'{k}="{_escape_label(v)}"' for k, v in labels)
+            lines.append(f"{METRIC_PREFIX}{name}{{{label_text}}} {_format_value(value)}" if label_text
+                         else f"{METRIC_PREFIX}{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_value(value):
+    """Số nguyên giữ nguyên (byte, timestamp), số thực giữ đủ chữ số thay vì dạng %g làm tròn."""
+    if isinstance(value, bool) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_registry = MetricsRegistry()
+
+
+def get_metrics_registry():
+    return _registry
+
+
+class CycleRecorder:
+    """Số liệu của một chu kỳ (phân tích hoặc tổng hợp) của một firewall: các span theo thứ tự và bộ đếm."""
+
+    def __init__(self, firewall_id, kind):
+        self.firewall_id = firewall_id
+        self.kind = kind
+        self.started_at = datetime.now().astimezone()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters = Counter()
+        self.status = "ok"
+        self.error = None
+        self.report_path = None
+        self.lock = threading.Lock()
+
+    def to_dict(self):
+        with self.lock:
+            return {"firewall_id": self.firewall_id, "cycle": self.kind, "status": self.status, "error": self.error,
+                    "started_at": self.started_at.isoformat(),
+                    "duration_seconds": round(time.perf_counter() - self.started, 4),
+                    "report_path": self.report_path, "spans": list(self.spans),
+                    "counters": {key: round(value, 4) for key, value in self.counters.items()}}
+
+
+class SectionTimeout(Exception):
+    """Xử lý firewall đã vượt SectionTimeoutSeconds (hoặc bị bộ lập lịch hủy)."""
+
+
+def set_section_deadline(firewall_id, timeout_seconds):
+    """Đặt hạn chót cho lần xử lý firewall hiện tại; None để bỏ hạn chót."""
+    with _deadlines_lock:
+        if timeout_seconds is None:
+            _deadlines.pop(firewall_id, None)
+        else:
+            _deadlines[firewall_id] = time.monotonic() + timeout_seconds
+
+
+def cancel_section(firewall_id):
+    """Hủy lần xử lý đang chạy: bước kế tiếp (span, lần gọi Gemini) sẽ ném SectionTimeout."""
+    with _deadlines_lock:
+        _deadlines[firewall_id] = 0
+
+
+def remaining_seconds(firewall_id, default=None):
+    """Số giây còn lại trước hạn chót (default nếu không có hạn chót). Ném SectionTimeout nếu đã hết hạn."""
+    with _deadlines_lock:
+        deadline = _deadlines.get(firewall_id)
+    if deadline is None:
+        return default
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise SectionTimeout(f"[{firewall_id}] Đã vượt thời gian xử lý cho phép.")
+    return remaining if default is None else min(default, remaining)
+
+
+def get_cycle(firewall_id):
+    """Chu kỳ đang chạy của firewall (None nếu không có), dùng được từ mọi thread của chu kỳ đó."""
+    with _active_cycles_lock:
+        stack = _active_cycles.get(firewall_id)
+        return stack[-1] if stack else None
+
+
+def set_cycle_report(firewall_id, report_path):
+    """Gắn đường dẫn báo cáo vừa lưu vào chu kỳ đang chạy (bản ghi JSON và profile được ghi cạnh báo cáo)."""
+    cycle = get_cycle(firewall_id)
+    if cycle is not None:
+        cycle.report_path = report_path
+
+
+def record(firewall_id, **values):
+    """Cộng các bộ đếm (tên trong COUNTER_HELP) vào metrics toàn cục và vào chu kỳ đang chạy của firewall."""
+    for name, value in values.items():
+        _registry.inc(f"{name}_total", value, firewall=firewall_id)
+    cycle = get_cycle(firewall_id)
+    if cycle is not None:
+        with cycle.lock:
+            cycle.counters.update(values)
+
+
+@contextmanager
+def cycle_span(firewall_id, name):
+    """Đo một bước của chu kỳ. Khối with nhận dict thuộc tính để ghi thêm (bytes, lines, prompt_chars, ...)."""
+    remaining_seconds(firewall_id)
+    attributes = {}
+    cycle = get_cycle(firewall_id)
+    kind = cycle.kind if cycle else "standalone"
+    started = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        elapsed = time.perf_counter() - started
+        labels = {"firewall": firewall_id, "cycle": kind, "stage": name}
+        if attributes.get("lines") and elapsed > 0:
+            attributes["lines_per_second"] = round(attributes["lines"] / elapsed)
+            _registry.set("stage_lines_per_second", attributes["lines_per_second"], **labels)
+        _registry.inc("stage_seconds_total", elapsed, **labels)
+        _registry.inc("stage_runs_total", 1, **labels)
+        _registry.set("stage_last_seconds", round(elapsed, 4), **labels)
+        if cycle is not None:
+            with cycle.lock:
+                cycle.spans.append({"name": name, "offset_seconds": round(started - cycle.started, 4),
+                                    "seconds": round(elapsed, 4), **attributes})
+
+
+def _profile_summary(profiler, top_n):
+    """Các hàm tốn thời gian nhất (cumulative) dưới dạng văn bản của pstats."""
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top_n)
+    return output.getvalue()
+
+
+def _finish_cycle(cycle, profiler, top_n):
+    """Cập nhật metrics của chu kỳ, ghi bản ghi JSON và file profile cạnh báo cáo, ghi textfile Prometheus."""
+    data = cycle.to_dict()
+    labels = {"firewall": cycle.firewall_id, "cycle": cycle.kind}
+    _registry.inc("cycles_total", 1, status=cycle.status, **labels)
+    _registry.set("cycle_last_seconds", data["duration_seconds"], **labels)
+    if cycle.report_path:
+        _registry.set("cycle_last_success_timestamp_seconds", round(time.time()), **labels)
+
+    base_path = os.path.splitext(cycle.report_path)[0] if cycle.report_path else None
+    if profiler is not None:
+        summary = _profile_summary(profiler, top_n)
+        data["profile_top_functions"] = summary.splitlines()
+        if base_path:
+            profiler.dump_stats(base_path + PROFILE_SUFFIX)
+            data["profile_path"] = base_path + PROFILE_SUFFIX
+        else:
+            logging.info(f"[{cycle.firewall_id}] Profile chu kỳ {cycle.kind}:\n{summary}")
+
+    if base_path and _settings["run_records"]:
+        try:
+            with open(base_path + RUN_RECORD_SUFFIX + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(base_path + RUN_RECORD_SUFFIX + ".tmp", base_path + RUN_RECORD_SUFFIX)
+        except OSError as e:
+            logging.error(f"[{cycle.firewall_id}] Lỗi khi ghi bản ghi lần chạy: {e}")
+    stages = ", ".join(f"{span['name']} {span['seconds']:.2f}s" for span in data["spans"])
+    logging.info(f"[{cycle.firewall_id}] Chu kỳ {cycle.kind}: {data['duration_seconds']:.2f} giây ({stages}).")
+    write_textfile()
+
+
+def instrumented_cycle(kind):
+    """Decorator cho hàm chu kỳ (config, firewall_section): mở CycleRecorder, bật cProfile nếu ProfileEnabled."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(config, firewall_section, *args, **kwargs):
+            cycle = CycleRecorder(firewall_section, kind)
+            profiler = cProfile.Profile() if config.getboolean(firewall_section, 'ProfileEnabled', fallback=False) else None
+            with _active_cycles_lock:
+                _active_cycles.setdefault(firewall_section, []).append(cycle)
+            if profiler is not None:
+                try:
+                    profiler.enable()
+                except ValueError as e:
+                    # Mỗi lúc chỉ một profiler được bật (các firewall chạy song song)
+                    logging.warning(f"[{firewall_section}] Không bật được cProfile cho chu kỳ {kind}: {e}")
+                    profiler = None
+            try:
+                return func(config, firewall_section, *args, **kwargs)
+            except SectionTimeout as e:
+                cycle.status, cycle.error = "timeout", str(e)
+                raise
+            except Exception as e:
+                cycle.status, cycle.error = "error", str(e)
+                raise
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                with _active_cycles_lock:
+                    _active_cycles[firewall_section].remove(cycle)
+                if cycle.status == "ok" and not cycle.report_path:
+                    cycle.status = "no_report"
+                _finish_cycle(cycle, profiler, config.getint(firewall_section, 'ProfileTopFunctions', fallback=25))
+        return wrapper
+    return decorator
+
+
+def write_textfile():
+    """Ghi toàn bộ metrics ra file textfile (cho textfile collector của node_exporter), ghi nguyên tử."""
+    path = _settings["textfile_path"]
+    if not path:
+        return
+    try:
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            f.write(_registry.render())
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logging.error(f"Lỗi khi ghi file metrics '{path}': {e}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = _registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def configure_metrics(config):
+    """Thiết lập xuất metrics từ section [Metrics] (gọi khi khởi động hoặc khi nạp lại config)."""
+    global _server
+    _settings.update(textfile_path=config.get('Metrics', 'TextfilePath', fallback=None) or None,
+                     run_records=config.getboolean('Metrics', 'RunRecords', fallback=True))
+    address = config.get('Metrics', 'ListenAddress', fallback='127.0.0.1')
+    port = config.getint('Metrics', 'HTTPPort', fallback=0)
+    with _server_lock:
+        if _settings["listen"] == (address, port):
+            return
+        if _server is not None:
+            _server.shutdown()
+            _server.server_close()
+            _server = None
+        _settings["listen"] = (address, port)
+        if port:
+            try:
+                _server = ThreadingHTTPServer((address, port), MetricsHandler)
+            except OSError as e:
+                logging.error(f"Không thể mở endpoint metrics {address}:{port}: {e}")
+                return
+            threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+            logging.info(f"Endpoint metrics Prometheus: http://{address}:{port}/metrics")
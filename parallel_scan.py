@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Quét song song file log lớn: chia thành các đoạn byte căn theo dòng, mmap và tổng hợp từng đoạn trong process pool."""
+
+import mmap
+import os
+from datetime import datetime
+
+import pytz
+
+from log_parser import LogAggregator, make_syslog_time_parser, split_syslog_line
+from process_pool import submit_to_pool
+
+PARALLEL_SCAN_MIN_BYTES = 32 * 1024 * 1024
+RANGES_PER_WORKER = 4
+SCAN_BLOCK_BYTES = 8 * 1024 * 1024
+
+
+def split_byte_ranges(path, start, end, parts):
+    """Chia [start, end) thành tối đa `parts` đoạn, mỗi ranh giới nằm ngay sau một ký tự xuống dòng."""
+    if end <= start:
+        return []
+    boundaries = [start]
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for i in range(1, parts):
+            newline = mm.find(b'\n', start + (end - start) * i // parts, end)
+            if newline < 0:
+                break
+            if newline + 1 > boundaries[-1]:
+                boundaries.append(newline + 1)
+    if boundaries[-1] < end:
+        boundaries.append(end)
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _iter_range_lines(mm, range_start, range_end):
+    """Duyệt các dòng (bytes, giữ '\\n') trong một đoạn mmap theo từng khối để bộ nhớ không phụ thuộc kích thước đoạn."""
+    position = range_start
+    while position < range_end:
+        block_end = min(range_end, position + SCAN_BLOCK_BYTES)
+        if block_end < range_end:
+            newline = mm.find(b'\n', block_end, range_end)
+            block_end = range_end if newline < 0 else newline + 1
+        yield from mm[position:block_end].splitlines(keepends=True)
+        position = block_end
+
+
+def _new_window_part():
+    return {"aggregator": LogAggregator(), "samples": [], "latest_ts": None, "bytes": 0, "first": None, "last": None}
+
+
+def _add_to_part(part, line, sample_limit, filterlog_samples):
+    """Giống aggregate_log_lines: giữ log không phải filterlog và tối đa sample_limit dòng filterlog."""
+    if part["first"] is None:
+        part["first"] = line[:15]
+    part["last"] = line[:15]
+    part["bytes"] += len(line)
+    if part["aggregator"].add_line(line) == 'filterlog':
+        if filterlog_samples >= sample_limit:
+            return filterlog_samples
+        filterlog_samples += 1
+    part["samples"].append(line)
+    return filterlog_samples
+
+
+def aggregate_window_part(lines, sample_limit=50):
+    """Tổng hợp các dòng đã có trong bộ nhớ (vd: segment đã xoay vòng) thành một phần cửa sổ như scan_byte_range."""
+    part, filterlog_samples = _new_window_part(), 0
+    for line in lines:
+        filterlog_samples = _add_to_part(part, line, sample_limit, filterlog_samples)
+    return part
+
+
+def scan_byte_range(path, range_start, range_end, start_ts, timezone_str, end_time_iso, sample_limit=50):
+    """Tổng hợp một đoạn byte (chạy trong process con), chỉ tính dòng mới hơn start_ts.
+
+    Trả về một phần cửa sổ: dict gồm LogAggregator, các dòng mẫu cho prompt, timestamp mới nhất, số byte và
+    timestamp (chuỗi) của dòng đầu/cuối. Toàn bộ văn bản của đoạn không được gửi về process cha.
+    """
+    parse_ts = make_syslog_time_parser(pytz.timezone(timezone_str), datetime.fromisoformat(end_time_iso))
+    part, filterlog_samples = _new_window_part(), 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for raw_line in _iter_range_lines(mm, range_start, range_end):
+            log_ts = parse_ts(raw_line[:15].decode('ascii', errors='ignore'))
+            if log_ts is None or log_ts <= start_ts:
+                continue
+            if part["latest_ts"] is None or log_ts > part["latest_ts"]:
+                part["latest_ts"] = log_ts
+            filterlog_samples = _add_to_part(part, raw_line.decode('utf-8', errors='ignore'), sample_limit,
+                                             filterlog_samples)
+    return part
+
+
+def _run_ranges(path, ranges, start_ts, timezone_str, end_time, workers, sample_limit):
+    args = [(path, range_start, range_end, start_ts, timezone_str, end_time.isoformat(), sample_limit)
+            for range_start, range_end in ranges]
+    if workers <= 1 or len(ranges) <= 1:
+        return [scan_byte_range(*arg) for arg in args]
+    futures = [submit_to_pool(workers, scan_byte_range, *arg) for arg in args]
+    # Kết quả lấy theo thứ tự các đoạn, tức thứ tự thời gian của log
+    return [future.result() for future in futures]
+
+
+def last_complete_line_offset(path, size):
+    """Offset ngay sau ký tự xuống dòng cuối cùng (bỏ phần dòng đang ghi dở)."""
+    if size <= 0:
+        return 0
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return mm.rfind(b'\n', 0, size) + 1
+
+
+def merge_window_parts(parts, sample_limit):
+    """Gộp các phần cửa sổ (theo thứ tự thời gian) thành (aggregator, prompt_lines).
+
+    Mỗi phần đã giữ tối đa sample_limit dòng filterlog; giới hạn chung được cắt lại ở đây nên kết quả giống hệt
+    aggregate_log_lines chạy tuần tự trên cả cửa sổ.
+    """
+    aggregator, prompt_lines, filterlog_samples = LogAggregator(), [], 0
+    for part in parts:
+        aggregator.merge(part["aggregator"])
+        for line in part["samples"]:
+            if _is_filterlog(line):
+                if filterlog_samples >= sample_limit:
+                    continue
+                filterlog_samples += 1
+            prompt_lines.append(line)
+    return aggregator, prompt_lines
+
+
+def _is_filterlog(line):
+    parsed = split_syslog_line(line)
+    return parsed is not None and parsed[2] == 'filterlog'
+
+
+def window_part_chunks(parts, chunk_count, sample_limit):
+    """Chia các phần cửa sổ thành tối đa chunk_count đoạn thời gian liên tiếp có số dòng gần bằng nhau (cho map-reduce).
+
+    Trả về danh sách (aggregator, prompt_lines, "đầu -> cuối") của từng đoạn.
+    """
+    parts = [part for part in parts if part["aggregator"].total_lines]
+    chunk_count = max(1, chunk_count)
+    chunk_lines = sum(part["aggregator"].total_lines for part in parts) / chunk_count
+    groups, seen_lines = {}, 0
+    for part in parts:
+        # Mỗi phần thuộc đoạn chứa điểm giữa của nó (theo số dòng tích lũy)
+        middle = seen_lines + part["aggregator"].total_lines / 2
+        groups.setdefault(min(chunk_count - 1, int(middle // chunk_lines)), []).append(part)
+        seen_lines += part["aggregator"].total_lines
+    groups = [groups[index] for index in sorted(groups)]
+    return [(*merge_window_parts(group, sample_limit), f"{group[0]['first']} -> {group[-1]['last']}")
+            for group in groups]
+
+
+def parallel_aggregate_file(path, start_offset, start_ts, timezone_str, end_time, workers, sample_limit=50):
+    """Tổng hợp song song các dòng mới hơn start_ts từ start_offset đến dòng hoàn chỉnh cuối cùng.
+
+    Process con chỉ gửi về LogAggregator và dòng mẫu của từng đoạn (không gửi văn bản log).
+    Trả về (các phần cửa sổ theo thứ tự thời gian, offset kết thúc).
+    """
+    end_offset = last_complete_line_offset(path, os.path.getsize(path))
+    ranges = split_byte_ranges(path, start_offset, end_offset, workers * RANGES_PER_WORKER)
+    return _run_ranges(path, ranges, start_ts, timezone_str, end_time, workers, sample_limit), max(end_offset, start_offset)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Process pool dùng chung cho các bước đọc log nặng CPU (giải nén segment, quét song song), tạo một lần theo số worker."""
+
+import atexit
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def _process_context():
+    """forkserver (hoặc spawn nếu nền tảng không hỗ trợ): pool được tạo từ luồng của scheduler,
+    fork một process đa luồng có thể sao chép lock đang bị giữ (logging, SQLite) và làm process con treo."""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def get_process_pool(workers):
+    """Lấy (hoặc tạo) process pool dùng chung có `workers` process."""
+    with _process_pools_lock:
+        pool = _process_pools.get(workers)
+        if pool is None:
+            pool = _process_pools[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=_process_context())
+        return pool
+
+
+def submit_to_pool(workers, fn, *args):
+    """Gửi một việc vào pool dùng chung; pool hỏng (một process con chết đột ngột) được thay bằng pool mới."""
+    pool = get_process_pool(workers)
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        logging.warning(f"Process pool {workers} worker bị hỏng, tạo pool mới.")
+        with _process_pools_lock:
+            if _process_pools.get(workers) is pool:
+                del _process_pools[workers]
+        pool.shutdown(wait=False)
+        return get_process_pool(workers).submit(fn, *args)
+
+
+def shutdown_process_pools():
+    """Đóng mọi process pool dùng chung (khi thoát chương trình)."""
+    with _process_pools_lock:
+        pools = list(_process_pools.values())
+        _process_pools.clear()
+    for pool in pools:
+        pool.shutdown(wait=True)
+
+
+atexit.register(shutdown_process_pools)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Chỉ mục báo cáo và trạng thái theo firewall trên SQLite (chế độ WAL)."""
+
+import glob
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+DEFAULT_INDEX_FILE = "report_index.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    id INTEGER PRIMARY KEY,
+    firewall_id TEXT NOT NULL,
+    is_summary INTEGER NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    generated_time REAL NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    stats TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_reports_firewall_generated ON reports (firewall_id, is_summary, generated_time);
+CREATE INDEX IF NOT EXISTS idx_reports_firewall_start ON reports (firewall_id, is_summary, start_time);
+CREATE TABLE IF NOT EXISTS state (
+    firewall_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT,
+    PRIMARY KEY (firewall_id, key)
+);
+"""
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _to_epoch(value):
+    """Chuyển chuỗi ISO 8601 thành epoch giây, trả về None nếu không hợp lệ (vd: "N/A")."""
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class ReportIndex:
+    """Chỉ mục báo cáo: truy vấn "N báo cáo gần nhất" và theo khoảng thời gian bằng B-tree index, không cần quét thư mục."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connection(self):
+        """Mỗi thread dùng một kết nối riêng tới cùng file SQLite."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def add_report(self, firewall_id, report_path, report_data, is_summary=False):
+        """Ghi (hoặc cập nhật) một báo cáo vào chỉ mục."""
+        generated_time = _to_epoch(report_data.get("report_generated_time")) or os.path.getmtime(report_path)
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO reports (firewall_id, is_summary, start_time, end_time, generated_time, path, stats) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (firewall_id, int(is_summary), _to_epoch(report_data.get("analysis_start_time")),
+                 _to_epoch(report_data.get("analysis_end_time")), generated_time, report_path,
+                 json.dumps(report_data.get("summary_stats", {}), ensure_ascii=False)))
+
+    def last_reports(self, firewall_id, limit, is_summary=False):
+        """N báo cáo mới nhất của một firewall (mới nhất trước)."""
+        rows = self._connection().execute(
+            "SELECT * FROM reports WHERE firewall_id = ? AND is_summary = ? ORDER BY generated_time DESC LIMIT ?",
+            (firewall_id, int(is_summary), limit)).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    @staticmethod
+    def _row_to_dict(row):
+        report = dict(row)
+        report["stats"] = json.loads(report["stats"]) if report["stats"] else {}
+        return report
+
+    def get_state(self, firewall_id, key):
+        """Đọc một giá trị trạng thái của firewall, None nếu chưa có."""
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE firewall_id = ? AND key = ?", (firewall_id, key)).fetchone()
+        return row["value"] if row else None
+
+    def set_state(self, firewall_id, key, value):
+        """Ghi một giá trị trạng thái trong một transaction (nguyên tử)."""
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO state (firewall_id, key, value) VALUES (?, ?, ?)",
+                         (firewall_id, key, value))
+
+    def import_report_directory(self, firewall_id, report_dir):
+        """Nhập một lần các báo cáo JSON đã có trên đĩa (từ trước khi dùng chỉ mục).
+
+        Đánh dấu bằng khóa 'legacy_reports_imported' trong bảng state; các lần gọi sau không làm gì và trả về 0.
+        """
+        if self.get_state(firewall_id, 'legacy_reports_imported'):
+            return 0
+        imported = 0
+        for pattern, is_summary in ((os.path.join(report_dir, "*", "*.json"), False),
+                                    (os.path.join(report_dir, "summary", "*", "*.json"), True)):
+            for report_path in glob.glob(pattern):
+                if not is_summary and os.path.basename(os.path.dirname(report_path)) == "summary":
+                    continue
+                try:
+                    with open(report_path, 'r', encoding='utf-8') as f:
+                        report_data = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if not isinstance(report_data, dict) or "analysis_start_time" not in report_data:
+                    continue
+                self.add_report(firewall_id, report_path, report_data, is_summary)
+                imported += 1
+        self.set_state(firewall_id, 'legacy_reports_imported', datetime.now().isoformat())
+        logging.info(f"[{firewall_id}] Đã nhập {imported} báo cáo có sẵn từ '{report_dir}' vào chỉ mục.")
+        return imported
+
+
+def configure_report_index(db_path):
+    """Thiết lập file chỉ mục dùng chung (gọi khi khởi động)."""
+    global _index
+    with _index_lock:
+        _index = ReportIndex(db_path)
+
+
+def get_report_index():
+    """Lấy chỉ mục dùng chung, tự tạo với file mặc định nếu chưa được thiết lập."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ReportIndex(DEFAULT_INDEX_FILE)
+        return _index
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""Cache phản hồi LLM trên đĩa, địa chỉ hóa theo nội dung (hash của model + prompt), có TTL và loại bỏ LRU."""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# Timestamp syslog (Mmm dd HH:MM:SS) và ISO 8601 được che khi tính khóa để các cửa sổ yên tĩnh giống nhau dùng chung phản hồi
+TIMESTAMP_PATTERN = re.compile(r'\b[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d\b|\b\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?(?:[+-]\d\d:\d\d|Z)?')
+
+# Chu kỳ quét thư mục để xóa mục hết hạn TTL khi bộ đếm chưa vượt giới hạn
+EVICT_INTERVAL_SECONDS = 3600
+# Khi vượt giới hạn, dọn xuống dưới tỉ lệ này để các lần put tiếp theo không phải quét thư mục ngay
+EVICT_LOW_WATERMARK = 0.9
+
+
+class ResponseCache:
+    """Lưu phản hồi của Gemini theo hash(model + prompt) để chạy lại/backfill không phải trả phí lần nữa."""
+
+    def __init__(self, cache_dir, ttl_seconds=7 * 24 * 3600, max_entries=2000, max_bytes=200 * 1024 * 1024,
+                 ignore_timestamps=True):
+        self.cache_dir = cache_dir
+        self.ignore_timestamps = ignore_timestamps
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # Số mục/dung lượng ước lượng từ lần quét thư mục gần nhất cộng các lần put sau đó (None: chưa quét)
+        self._entry_count = None
+        self._total_bytes = 0
+        self._last_evict = 0.0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, model_name, prompt):
+        """Khóa cache: SHA-256 của tên model và toàn bộ prompt (timestamp được che nếu bật ignore_timestamps)."""
+        if self.ignore_timestamps:
+            prompt = TIMESTAMP_PATTERN.sub('<TS>', prompt)
+        digest = hashlib.sha256()
+        digest.update(model_name.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(prompt.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """Trả về phản hồi đã cache hoặc None (hết hạn cũng tính là miss)."""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entry = None
+        # Entry JSON hợp lệ nhưng sai cấu trúc (vd: thiếu "response") cũng tính là miss
+        response = entry.get("response") if isinstance(entry, dict) else None
+        if response is None:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        if time.time() - entry.get("created", 0) > self.ttl_seconds:
+            self._remove(path)
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # Cập nhật mtime để đánh dấu lần dùng gần nhất (phục vụ LRU)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return response
+
+    def put(self, key, model_name, response):
+        """Ghi phản hồi vào cache (ghi nguyên tử); chỉ quét thư mục để dọn khi bộ đếm vượt giới hạn hoặc đến kỳ dọn TTL."""
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"model": model_name, "created": time.time(), "response": response}, f, ensure_ascii=False)
+        size = os.path.getsize(temp_path)
+        try:
+            replaced_size = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced_size = None
+        os.replace(temp_path, path)
+
+        with self.lock:
+            if self._entry_count is not None:
+                if replaced_size is None:
+                    self._entry_count += 1
+                self._total_bytes += size - (replaced_size or 0)
+            needs_evict = (self._entry_count is None or self._entry_count > self.max_entries
+                           or self._total_bytes > self.max_bytes
+                           or time.time() - self._last_evict > min(self.ttl_seconds, EVICT_INTERVAL_SECONDS))
+        if needs_evict:
+            self.evict()
+
+    def evict(self):
+        """Xóa mục hết hạn, sau đó xóa mục ít được dùng gần đây nhất cho đến khi nằm trong giới hạn số lượng/dung lượng."""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        if len(entries) > self.max_entries or total_bytes > self.max_bytes:
+            max_entries, max_bytes = int(self.max_entries * EVICT_LOW_WATERMARK), int(self.max_bytes * EVICT_LOW_WATERMARK)
+        else:
+            max_entries, max_bytes = self.max_entries, self.max_bytes
+        while entries and (len(entries) > max_entries or total_bytes > max_bytes):
+            _, size, path = entries.pop(0)
+            total_bytes -= size
+            self._remove(path)
+
+        with self.lock:
+            self._entry_count = len(entries)
+            self._total_bytes = total_bytes
+            self._last_evict = now
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            with self.lock:
+                self.evictions += 1
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        """Số liệu hit/miss/eviction kể từ khi khởi động."""
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "hit_ratio": round(self.hits / total, 3) if total else 0.0}
+
+
+def log_cache_stats(cache):
+    """Ghi log thống kê cache."""
+    stats = cache.stats()
+    logging.info(f"Cache phản hồi LLM: {stats['hits']} hit, {stats['misses']} miss, "
+                 f"{stats['evictions']} mục bị loại bỏ (tỉ lệ hit {stats['hit_ratio']:.0%}).")
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""Sketch có thể gộp cho từng báo cáo: bộ đếm chính xác, HyperLogLog (số IP nguồn khác nhau) và Space-Saving (top-k)."""
+
+import base64
+import hashlib
+import json
+import math
+import os
+from collections import Counter
+
+HLL_PRECISION = 12
+TOP_K = 100
+SKETCH_FILE_SUFFIX = ".sketch.json"
+
+
+class HyperLogLog:
+    """Ước lượng số phần tử khác nhau với bộ nhớ cố định (2^p thanh ghi), gộp được bằng max từng thanh ghi."""
+
+    def __init__(self, precision=HLL_PRECISION, registers=None):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = registers if registers is not None else bytearray(self.size)
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        raw = alpha * self.size * self.size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * self.size and zeros:
+            return round(self.size * math.log(self.size / zeros))
+        return round(raw)
+
+    def to_dict(self):
+        return {"p": self.precision, "registers": base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["p"], bytearray(base64.b64decode(data["registers"])))
+
+
+class SpaceSaving:
+    """Top-k heavy hitters dạng Space-Saving; gộp bằng cách cộng dồn rồi cắt về k phần tử, theo dõi sai số tối đa."""
+
+    def __init__(self, k=TOP_K, counts=None, error=0):
+        self.k = k
+        self.counts = dict(counts or {})
+        self.error = error
+
+    def add(self, item, count=1):
+        if item in self.counts or len(self.counts) < self.k:
+            self.counts[item] = self.counts.get(item, 0) + count
+            return
+        # Thay phần tử nhỏ nhất, kế thừa số đếm của nó (đặc trưng của Space-Saving)
+        smallest = min(self.counts, key=self.counts.get)
+        smallest_count = self.counts.pop(smallest)
+        self.counts[item] = smallest_count + count
+        self.error = max(self.error, smallest_count)
+
+    @classmethod
+    def from_counter(cls, counter, k=TOP_K):
+        """Tạo từ số đếm chính xác của một cửa sổ: giữ k phần tử lớn nhất."""
+        top = counter.most_common(k + 1)
+        error = top[k][1] if len(top) > k else 0
+        return cls(k, dict(top[:k]), error)
+
+    def merge(self, other):
+        combined = Counter(self.counts)
+        combined.update(other.counts)
+        top = combined.most_common(self.k + 1)
+        dropped = top[self.k][1] if len(top) > self.k else 0
+        self.counts = dict(top[:self.k])
+        self.error = self.error + other.error + dropped
+        return self
+
+    def top(self, n=10):
+        return Counter(self.counts).most_common(n)
+
+    def to_dict(self):
+        return {"k": self.k, "counts": self.counts, "error": self.error}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["k"], data["counts"], data.get("error", 0))
+
+
+class ReportSketch:
+    """Tập sketch của một báo cáo; gộp N báo cáo có độ phức tạp O(N) mà không cần đọc lại log."""
+
+    EXACT_FIELDS = ('actions', 'interfaces', 'protocols', 'programs', 'dhcp_messages', 'openvpn_events', 'unbound_levels')
+    TOP_FIELDS = ('blocked_src_ips', 'blocked_dst_ips', 'blocked_dst_ports', 'passed_dst_ports')
+    DISTINCT_FIELDS = ('blocked_src_ips', 'src_ips')
+
+    def __init__(self):
+        self.reports = 0
+        self.total_lines = 0
+        self.exact = {field: Counter() for field in self.EXACT_FIELDS}
+        self.top = {field: SpaceSaving() for field in self.TOP_FIELDS}
+        self.distinct = {field: HyperLogLog() for field in self.DISTINCT_FIELDS}
+
+    @classmethod
+    def from_aggregator(cls, aggregator):
+        """Tạo sketch từ LogAggregator của một chu kỳ phân tích."""
+        sketch = cls()
+        sketch.reports = 1
+        sketch.total_lines = aggregator.total_lines
+        sketch.exact['actions'].update(aggregator.actions)
+        for (action, value), count in aggregator.filterlog['interface'].items():
+            sketch.exact['interfaces'][f"{action}|{value}"] += count
+        for (action, value), count in aggregator.filterlog['protocol'].items():
+            sketch.exact['protocols'][f"{action}|{value}"] += count
+        sketch.exact['programs'].update(aggregator.programs)
+        sketch.exact['dhcp_messages'].update(aggregator.dhcp_messages)
+        sketch.exact['openvpn_events'].update(aggregator.openvpn_events)
+        sketch.exact['unbound_levels'].update(aggregator.unbound_levels)
+
+        for field, dimension, action in (('blocked_src_ips', 'src_ip', 'block'), ('blocked_dst_ips', 'dst_ip', 'block'),
+                                         ('blocked_dst_ports', 'dst_port', 'block'), ('passed_dst_ports', 'dst_port', 'pass')):
+            sketch.top[field] = SpaceSaving.from_counter(Counter(dict(aggregator.top(dimension, action, n=None))))
+        for action, ip in aggregator.filterlog['src_ip']:
+            sketch.distinct['src_ips'].add(ip)
+            if action == 'block':
+                sketch.distinct['blocked_src_ips'].add(ip)
+        return sketch
+
+    def merge(self, other):
+        self.reports += other.reports
+        self.total_lines += other.total_lines
+        for field in self.EXACT_FIELDS:
+            self.exact[field].update(other.exact[field])
+        for field in self.TOP_FIELDS:
+            self.top[field].merge(other.top[field])
+        for field in self.DISTINCT_FIELDS:
+            self.distinct[field].merge(other.distinct[field])
+        return self
+
+    def summary_stats(self):
+        """Các chỉ số chính xác (hoặc ước lượng có cận sai số) cho cả giai đoạn."""
+        top_src = self.top['blocked_src_ips'].top(1)
+        top_port = self.top['blocked_dst_ports'].top(1)
+        return {
+            "reports_merged": self.reports,
+            "total_log_lines_period": self.total_lines,
+            "total_blocked_events_period": self.exact['actions'].get('block', 0),
+            "total_passed_events_period": self.exact['actions'].get('pass', 0),
+            "top_blocked_source_ip_period": top_src[0][0] if top_src else "N/A",
+            "top_blocked_destination_port_period": top_port[0][0] if top_port else "N/A",
+            "distinct_blocked_source_ips_estimate": self.distinct['blocked_src_ips'].estimate(),
+            "distinct_source_ips_estimate": self.distinct['src_ips'].estimate(),
+            "openvpn_auth_failures_period": self.exact['openvpn_events'].get('auth_failed', 0),
+        }
+
+    def to_prompt_text(self, top_n=10):
+        """Trình bày số liệu đã gộp dạng văn bản gọn cho prompt tổng hợp."""
+        def fmt(items):
+            return ", ".join(f"{value} ({count})" for value, count in items) if items else "không có"
+
+        stats = self.summary_stats()
+        lines = ["--- SỐ LIỆU GỘP CHÍNH XÁC CHO CẢ GIAI ĐOẠN ---",
+                 f"Số báo cáo đã gộp: {self.reports}, tổng số dòng log: {self.total_lines}",
+                 f"Filterlog theo action: {fmt(self.exact['actions'].most_common())}",
+                 f"Theo interface (action|interface): {fmt(self.exact['interfaces'].most_common(top_n))}",
+                 f"Theo giao thức (action|giao thức): {fmt(self.exact['protocols'].most_common(top_n))}",
+                 f"IP nguồn bị chặn nhiều nhất: {fmt(self.top['blocked_src_ips'].top(top_n))}",
+                 f"IP đích bị chặn nhiều nhất: {fmt(self.top['blocked_dst_ips'].top(top_n))}",
+                 f"Cổng đích bị chặn nhiều nhất: {fmt(self.top['blocked_dst_ports'].top(top_n))}",
+                 f"Cổng đích được cho phép nhiều nhất: {fmt(self.top['passed_dst_ports'].top(top_n))}",
+                 f"Số IP nguồn bị chặn khác nhau (ước lượng HyperLogLog): ~{stats['distinct_blocked_source_ips_estimate']}",
+                 f"Số IP nguồn khác nhau (ước lượng HyperLogLog): ~{stats['distinct_source_ips_estimate']}",
+                 f"DHCP: {fmt(self.exact['dhcp_messages'].most_common(top_n))}",
+                 f"OpenVPN: {fmt(self.exact['openvpn_events'].most_common(top_n))}",
+                 f"Unbound: {fmt(self.exact['unbound_levels'].most_common(top_n))}",
+                 "--- KẾT THÚC SỐ LIỆU GỘP ---"]
+        return "\n".join(lines)
+
+    def to_dict(self):
+        return {"reports": self.reports, "total_lines": self.total_lines,
+                "exact": {field: dict(counter) for field, counter in self.exact.items()},
+                "top": {field: sketch.to_dict() for field, sketch in self.top.items()},
+                "distinct": {field: sketch.to_dict() for field, sketch in self.distinct.items()}}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.reports = data["reports"]
+        sketch.total_lines = data["total_lines"]
+        for field in cls.EXACT_FIELDS:
+            sketch.exact[field] = Counter(data["exact"].get(field, {}))
+        for field in cls.TOP_FIELDS:
+            sketch.top[field] = SpaceSaving.from_dict(data["top"][field])
+        for field in cls.DISTINCT_FIELDS:
+            sketch.distinct[field] = HyperLogLog.from_dict(data["distinct"][field])
+        return sketch
+
+
+def sketch_path_for_report(report_path):
+    """Đường dẫn file sketch nằm cạnh file báo cáo JSON."""
+    return os.path.splitext(report_path)[0] + SKETCH_FILE_SUFFIX
+
+
+def save_report_sketch(report_path, sketch):
+    """Ghi sketch cạnh báo cáo (ghi nguyên tử)."""
+    sketch_path = sketch_path_for_report(report_path)
+    temp_path = f"{sketch_path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(sketch.to_dict(), f, ensure_ascii=False)
+    os.replace(temp_path, sketch_path)
+    return sketch_path
+
+
+def load_report_sketch(report_path):
+    """Đọc sketch của một báo cáo, trả về None nếu báo cáo chưa có sketch."""
+    try:
+        with open(sketch_path_for_report(report_path), 'r', encoding='utf-8') as f:
+            return ReportSketch.from_dict(json.load(f))
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
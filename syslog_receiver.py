@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Bộ nhận syslog (UDP/TCP, RFC 3164/5424) bằng asyncio, gom log vào ring buffer theo thời gian cho từng firewall."""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import pytz
+
+DEFAULT_SYSLOG_PORT = 5514
+RFC3164_TIMESTAMP = re.compile(r'[A-Z][a-z]{2} [ \d]\d \d\d:\d\d:\d\d')
+PRI_PATTERN = re.compile(rb'^<(\d{1,3})>')
+
+
+class TimeBucketRing:
+    """Ring buffer chia theo bucket thời gian: giới hạn số dòng và tuổi tối đa, khi đầy thì bỏ dòng cũ nhất."""
+
+    def __init__(self, bucket_seconds=60, max_lines=500000, max_age_seconds=24 * 3600):
+        self.bucket_seconds = bucket_seconds
+        self.max_lines = max_lines
+        self.max_age_seconds = max_age_seconds
+        self.buckets = deque()
+        self.total = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, line):
+        bucket_start = int(timestamp // self.bucket_seconds) * self.bucket_seconds
+        with self.lock:
+            # Đồng hồ lùi nhẹ thì vẫn ghi vào bucket mới nhất để giữ thứ tự
+            if not self.buckets or bucket_start > self.buckets[-1][0]:
+                self.buckets.append((bucket_start, deque()))
+            self.buckets[-1][1].append(line)
+            self.total += 1
+
+            while self.buckets and self.buckets[0][0] < bucket_start - self.max_age_seconds:
+                self._drop_oldest_bucket()
+            while self.total > self.max_lines:
+                oldest = self.buckets[0][1]
+                oldest.popleft()
+                self.total -= 1
+                self.dropped += 1
+                if not oldest:
+                    self.buckets.popleft()
+
+    def _drop_oldest_bucket(self):
+        _, lines = self.buckets.popleft()
+        self.total -= len(lines)
+        self.dropped += len(lines)
+
+    def drain(self, since_ts=None):
+        """Lấy ra (và xóa) toàn bộ dòng đang giữ; bỏ các bucket kết thúc trước since_ts. Trả về (lines, first_ts, last_ts)."""
+        with self.lock:
+            buckets, self.buckets, self.total = self.buckets, deque(), 0
+        lines, first_ts, last_ts = [], None, None
+        for bucket_start, bucket_lines in buckets:
+            if since_ts is not None and bucket_start + self.bucket_seconds <= since_ts:
+                continue
+            if first_ts is None:
+                first_ts = bucket_start
+            last_ts = bucket_start + self.bucket_seconds
+            lines.extend(bucket_lines)
+        return lines, first_ts, last_ts
+
+
+def _format_bsd_timestamp(dt):
+    return f"{dt:%b} {dt.day:2d} {dt:%H:%M:%S}"
+
+
+def parse_syslog_message(data, default_hostname, tz):
+    """Chuẩn hóa một bản tin syslog (RFC 3164 hoặc 5424) thành dòng BSD 'Mmm dd HH:MM:SS host tag: msg'.
+
+    Trả về (line, hostname) hoặc None nếu không parse được.
+    """
+    text = data.decode('utf-8', errors='ignore').rstrip('\r\n\0')
+    match = PRI_PATTERN.match(data)
+    if match:
+        text = text[match.end():]
+
+    if text.startswith('1 '):
+        # RFC 5424: VERSION TIMESTAMP HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA MSG
+        parts = text.split(' ', 6)
+        if len(parts) < 6:
+            return None
+        _, timestamp, hostname, app_name, proc_id, _msg_id = parts[:6]
+        rest = parts[6] if len(parts) > 6 else ''
+        if rest.startswith('['):
+            end = rest.find('] ')
+            rest = '' if end < 0 else rest[end + 2:]
+        elif rest.startswith('- ') or rest == '-':
+            rest = rest[2:]
+        rest = rest.lstrip('\ufeff')
+        try:
+            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00')).astimezone(tz)
+        except ValueError:
+            dt = datetime.now(tz)
+        hostname = default_hostname if hostname == '-' else hostname
+        tag = app_name if proc_id == '-' else f"{app_name}[{proc_id}]"
+        return f"{_format_bsd_timestamp(dt)} {hostname} {tag}: {rest}\n", hostname
+
+    # RFC 3164: TIMESTAMP [HOSTNAME] TAG: MSG (pfSense thường bỏ HOSTNAME)
+    if RFC3164_TIMESTAMP.match(text):
+        timestamp, rest = text[:15], text[16:]
+    else:
+        timestamp, rest = _format_bsd_timestamp(datetime.now(tz)), text
+    first, _, remainder = rest.partition(' ')
+    if not first:
+        return None
+    if first.endswith(':') or '[' in first:
+        hostname = default_hostname
+    else:
+        hostname, rest = first, remainder
+    if ': ' not in rest:
+        return None
+    return f"{timestamp} {hostname} {rest}\n", hostname
+
+
+class SyslogReceiver:
+    """Nghe syslog qua UDP/TCP trong một event loop riêng; chuyển bản tin qua hàng đợi có giới hạn rồi định tuyến vào buffer."""
+
+    def __init__(self, host='0.0.0.0', udp_port=DEFAULT_SYSLOG_PORT, tcp_port=DEFAULT_SYSLOG_PORT, queue_size=10000,
+                 bucket_seconds=60, max_lines=500000, max_age_seconds=24 * 3600, max_message_bytes=8192):
+        self.host = host
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.queue_size = queue_size
+        self.bucket_seconds = bucket_seconds
+        self.max_lines = max_lines
+        self.max_age_seconds = max_age_seconds
+        self.max_message_bytes = max_message_bytes
+        self.routes = {"by_address": {}, "by_hostname": {}, "sections": {}}
+        self.buffers = {}
+        self.buffers_lock = threading.Lock()
+        self.counters = {"received_udp": 0, "received_tcp": 0, "dropped_queue_full": 0, "dropped_oversize": 0,
+                         "parse_errors": 0, "unrouted": 0}
+        self.loop = None
+        self.queue = None
+        self.ready = threading.Event()
+        self.thread = None
+        # Lỗi làm event loop dừng (vd: không mở được cổng); khác None thì bộ nhận không còn nhận log
+        self.error = None
+
+    # --- Định tuyến ---
+
+    def update_routes(self, config):
+        """Dựng bảng định tuyến từ các section Firewall_* có LogSource = syslog (theo địa chỉ nguồn hoặc hostname)."""
+        by_address, by_hostname, sections = {}, {}, {}
+        for section in config.sections():
+            if not section.startswith('Firewall_'):
+                continue
+            if config.get(section, 'LogSource', fallback='file').strip().lower() != 'syslog':
+                continue
+            hostname = config.get(section, 'PFSenseHostname', fallback=section)
+            sections[section] = {"hostname": hostname,
+                                 "tz": pytz.timezone(config.get(section, 'TimeZone', fallback='UTC'))}
+            by_hostname[hostname.lower()] = section
+            for source in config.get(section, 'SyslogSources', fallback='').split(','):
+                source = source.strip()
+                if source:
+                    by_address[source] = section
+                    by_hostname[source.lower()] = section
+        self.routes = {"by_address": by_address, "by_hostname": by_hostname, "sections": sections}
+        logging.info(f"Bộ nhận syslog: định tuyến cho {len(sections)} firewall ({', '.join(sections) or 'không có'}).")
+
+    def _buffer(self, section):
+        with self.buffers_lock:
+            ring = self.buffers.get(section)
+            if ring is None:
+                ring = self.buffers[section] = TimeBucketRing(self.bucket_seconds, self.max_lines, self.max_age_seconds)
+            return ring
+
+    def _route(self, received_ts, peer_address, data):
+        """Ưu tiên hostname trong bản tin (đi qua relay vẫn đúng), nếu không khớp thì theo địa chỉ nguồn."""
+        routes = self.routes
+        address_section = routes["by_address"].get(peer_address)
+        info = routes["sections"].get(address_section) or {"hostname": peer_address, "tz": pytz.utc}
+        parsed = parse_syslog_message(data, info["hostname"], info["tz"])
+        if parsed is None:
+            self.counters["parse_errors"] += 1
+            return
+        line, hostname = parsed
+        section = routes["by_hostname"].get(hostname.lower(), address_section)
+        if section is None:
+            self.counters["unrouted"] += 1
+            return
+        if section != address_section:
+            # Parse lại theo múi giờ của firewall đích (timestamp RFC 5424 được đổi sang giờ địa phương)
+            info = routes["sections"][section]
+            line, _ = parse_syslog_message(data, info["hostname"], info["tz"])
+        self._buffer(section).append(received_ts, line)
+
+    # --- Event loop ---
+
+    def start(self):
+        """Chạy event loop trong một thread nền; chờ tới khi socket đã mở xong, ném lỗi nếu không mở được."""
+        self.thread = threading.Thread(target=self._run, name='syslog-receiver', daemon=True)
+        self.thread.start()
+        self.ready.wait(timeout=10)
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def _run(self):
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            logging.error(f"Bộ nhận syslog dừng do lỗi: {e}")
+            self.error = e
+            self.ready.set()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.stopping = asyncio.Event()
+        transport, server = None, None
+        try:
+            if self.udp_port:
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda: _SyslogDatagramProtocol(self), local_addr=(self.host, self.udp_port))
+            if self.tcp_port:
+                server = await asyncio.start_server(self._handle_tcp, self.host, self.tcp_port,
+                                                    limit=self.max_message_bytes + 64)
+        except Exception:
+            # Không để rò socket UDP đã mở khi cổng TCP lỗi
+            if transport:
+                transport.close()
+            raise
+        consumer = asyncio.create_task(self._consume())
+        logging.info(f"Bộ nhận syslog đang nghe trên {self.host} (UDP {self.udp_port or 'tắt'}, TCP {self.tcp_port or 'tắt'}).")
+        self.ready.set()
+        await self.stopping.wait()
+        if transport:
+            transport.close()
+        if server:
+            server.close()
+            await server.wait_closed()
+        consumer.cancel()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+
+    def _enqueue_nowait(self, peer_address, data):
+        """UDP không thể chặn người gửi: khi hàng đợi đầy thì bỏ bản tin và tăng bộ đếm."""
+        self.counters["received_udp"] += 1
+        if len(data) > self.max_message_bytes:
+            self.counters["dropped_oversize"] += 1
+            return
+        try:
+            self.queue.put_nowait((time.time(), peer_address, data))
+        except asyncio.QueueFull:
+            self.counters["dropped_queue_full"] += 1
+
+    async def _handle_tcp(self, reader, writer):
+        """Đọc bản tin TCP theo octet-counting (RFC 6587) hoặc xuống dòng; chờ khi hàng đợi đầy để tạo backpressure."""
+        peer_address = writer.get_extra_info('peername')[0]
+        try:
+            while True:
+                header = await reader.readuntil(b' ')
+                if header[:-1].isdigit():
+                    length = int(header[:-1])
+                    if length > self.max_message_bytes:
+                        self.counters["dropped_oversize"] += 1
+                        break
+                    data = await reader.readexactly(length)
+                else:
+                    data = header + await reader.readuntil(b'\n')
+                self.counters["received_tcp"] += 1
+                await self.queue.put((time.time(), peer_address, data))
+        except asyncio.IncompleteReadError:
+            pass
+        except asyncio.LimitOverrunError:
+            self.counters["dropped_oversize"] += 1
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _consume(self):
+        while True:
+            received_ts, peer_address, data = await self.queue.get()
+            try:
+                self._route(received_ts, peer_address, data)
+            except Exception as e:
+                self.counters["parse_errors"] += 1
+                logging.debug(f"Bộ nhận syslog: lỗi khi xử lý bản tin từ {peer_address}: {e}")
+
+    # --- Truy xuất ---
+
+    def drain(self, section, since_ts=None):
+        """Lấy các dòng log đã gom cho một firewall. Trả về (lines, first_ts, last_ts)."""
+        return self._buffer(section).drain(since_ts)
+
+    def stats(self, section=None):
+        """Bộ đếm toàn cục, kèm số dòng đang giữ và số dòng bị bỏ do tràn buffer của một firewall nếu có."""
+        stats = dict(self.counters)
+        stats["queue_depth"] = self.queue.qsize() if self.queue else 0
+        if section is not None:
+            ring = self._buffer(section)
+            stats["buffered_lines"] = ring.total
+            stats["dropped_buffer_overflow"] = ring.dropped
+        return stats
+
+
+class _SyslogDatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, receiver):
+        self.receiver = receiver
+
+    def datagram_received(self, data, addr):
+        self.receiver._enqueue_nowait(addr[0], data)
+
+
+_receiver = None
+_receiver_lock = threading.Lock()
+
+
+def start_syslog_receiver(config):
+    """Khởi động bộ nhận syslog dùng chung từ section [Syslog] của config (chỉ khởi động một lần).
+
+    Trả về None nếu không mở được cổng; lần gọi sau (vd: khi nạp lại config) sẽ thử lại.
+    """
+    global _receiver
+    with _receiver_lock:
+        if _receiver is None:
+            receiver = SyslogReceiver(
+                host=config.get('Syslog', 'ListenAddress', fallback='0.0.0.0'),
+                udp_port=config.getint('Syslog', 'UDPPort', fallback=DEFAULT_SYSLOG_PORT),
+                tcp_port=config.getint('Syslog', 'TCPPort', fallback=DEFAULT_SYSLOG_PORT),
+                queue_size=config.getint('Syslog', 'QueueSize', fallback=10000),
+                bucket_seconds=config.getint('Syslog', 'BucketSeconds', fallback=60),
+                max_lines=config.getint('Syslog', 'MaxLinesPerFirewall', fallback=500000),
+                max_age_seconds=config.getint('Syslog', 'RetentionHours', fallback=24) * 3600,
+                max_message_bytes=config.getint('Syslog', 'MaxMessageBytes', fallback=8192))
+            receiver.update_routes(config)
+            try:
+                _receiver = receiver.start()
+            except Exception as e:
+                logging.error(f"Không thể khởi động bộ nhận syslog: {e}")
+        return _receiver
+
+
+def get_syslog_receiver():
+    """Lấy bộ nhận syslog đang chạy, None nếu chưa được khởi động."""
+    return _receiver
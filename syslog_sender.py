@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Gửi syslog giả lập (filterlog/dhcpd/openvpn) tới bộ nhận syslog để thử nghiệm tại máy.
+
+Chạy: python syslog_sender.py --protocol tcp --format 5424 --count 10000 --rate 2000
+"""
+
+import argparse
+import random
+import socket
+import time
+from datetime import datetime, timezone
+
+MESSAGES = [
+    ("filterlog", "5,,,1000000103,igb1,match,block,in,4,0x0,,64,0,0,DF,6,tcp,60,{src},192.168.1.10,{sport},445,0,S,1,,64240,,mss"),
+    ("filterlog", "7,,,1000000105,igb0,match,pass,out,4,0x0,,64,0,0,DF,17,udp,76,192.168.1.20,8.8.8.8,{sport},53,56"),
+    ("dhcpd", "DHCPACK on 192.168.1.{host} to 00:11:22:33:44:{host:02x} via igb0"),
+    ("openvpn", "user 'guest' AUTH_FAILED from {src}:{sport}"),
+]
+
+
+def build_message(message_format, hostname, omit_hostname):
+    program, template = random.choice(MESSAGES)
+    text = template.format(src=f"203.0.113.{random.randint(1, 254)}", sport=random.randint(1024, 65535),
+                           host=random.randint(2, 250))
+    pid = random.randint(100, 9999)
+    if message_format == '5424':
+        timestamp = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        return f"<134>1 {timestamp} {hostname} {program} {pid} - - {text}"
+    now = datetime.now()
+    host_part = "" if omit_hostname else f"{hostname} "
+    return f"<134>{now:%b} {now.day:2d} {now:%H:%M:%S} {host_part}{program}[{pid}]: {text}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5514)
+    parser.add_argument("--protocol", choices=["udp", "tcp"], default="udp")
+    parser.add_argument("--format", choices=["3164", "5424"], default="3164")
+    parser.add_argument("--hostname", default="pfsense.local", help="Hostname ghi trong bản tin (dùng để định tuyến).")
+    parser.add_argument("--omit-hostname", action="store_true", help="Bỏ HOSTNAME như pfSense mặc định (RFC 3164).")
+    parser.add_argument("--count", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=0, help="Số bản tin mỗi giây, 0 = gửi nhanh nhất có thể.")
+    args = parser.parse_args()
+
+    if args.protocol == 'udp':
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    else:
+        sock = socket.create_connection((args.host, args.port))
+
+    started = time.perf_counter()
+    for i in range(args.count):
+        payload = build_message(args.format, args.hostname, args.omit_hostname).encode('utf-8')
+        if args.protocol == 'udp':
+            sock.sendto(payload, (args.host, args.port))
+        else:
+            # Octet-counting framing (RFC 6587)
+            sock.sendall(f"{len(payload)} ".encode('ascii') + payload)
+        if args.rate:
+            delay = started + (i + 1) / args.rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    sock.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Đã gửi {args.count} bản tin qua {args.protocol.upper()} trong {elapsed:.2f} giây "
+          f"({args.count / elapsed:,.0f} bản tin/giây).")
+
+
+if __name__ == "__main__":
+    main()
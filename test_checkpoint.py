@@ -0,0 +1,118 @@
+"""Kiểm thử đọc log theo checkpoint của read_new_log_entries: ghi thêm, xoay vòng (rename), copytruncate, dòng ghi dở.
+
+Chạy: python -m pytest -q test_checkpoint.py
+"""
+
+import os
+import shutil
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import ai
+from report_index import configure_report_index
+
+TIMEZONE = "Asia/Ho_Chi_Minh"
+FIREWALL_ID = "test_fw"
+
+
+@pytest.fixture
+def log_path(tmp_path, monkeypatch):
+    """File log trống trong thư mục tạm, chỉ mục trạng thái (checkpoint, timestamp) riêng cho mỗi test."""
+    monkeypatch.chdir(tmp_path)
+    configure_report_index(str(tmp_path / "report_index.sqlite3"))
+    path = tmp_path / "filter.log"
+    path.write_bytes(b"")
+    return str(path)
+
+
+def make_lines(count, start_index=0):
+    """Các dòng syslog có timestamp trong vài phút gần đây (nằm trong cửa sổ đọc lần đầu)."""
+    start = datetime.now(pytz.timezone(TIMEZONE)) - timedelta(minutes=30)
+    return [f"{(start + timedelta(seconds=i)).strftime('%b %d %H:%M:%S')} pfSense test[1]: line {i}\n"
+            for i in range(start_index, start_index + count)]
+
+
+def append(path, lines):
+    with open(path, "a", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def read_new(path):
+    content, _, _, _ = ai.read_new_log_entries(path, 1, TIMEZONE, FIREWALL_ID)
+    assert content is not None
+    return content.splitlines(keepends=True)
+
+
+def test_append_reads_only_new_lines(log_path):
+    first, second = make_lines(5), make_lines(3, start_index=5)
+    append(log_path, first)
+    assert read_new(log_path) == first
+    assert read_new(log_path) == []
+
+    append(log_path, second)
+    assert read_new(log_path) == second
+    checkpoint = ai.get_log_checkpoint(FIREWALL_ID)
+    assert checkpoint["offset"] == os.path.getsize(log_path)
+    assert checkpoint["inode"] == os.stat(log_path).st_ino
+
+
+def test_rename_rotation_reads_rest_of_rotated_file(log_path):
+    append(log_path, make_lines(5))
+    read_new(log_path)
+
+    # Dòng ghi sau checkpoint nhưng trước khi xoay vòng vẫn phải được đọc từ file cũ
+    tail = make_lines(2, start_index=5)
+    append(log_path, tail)
+    os.rename(log_path, log_path + ".0")
+    fresh = make_lines(3, start_index=7)
+    append(log_path, fresh)
+
+    assert read_new(log_path) == tail + fresh
+    assert ai.get_log_checkpoint(FIREWALL_ID)["inode"] == os.stat(log_path).st_ino
+    assert read_new(log_path) == []
+
+
+def test_copytruncate_reads_rest_of_copy(log_path):
+    append(log_path, make_lines(5))
+    read_new(log_path)
+
+    tail = make_lines(2, start_index=5)
+    append(log_path, tail)
+    inode = os.stat(log_path).st_ino
+    shutil.copyfile(log_path, log_path + ".0")
+    with open(log_path, "r+b") as f:
+        f.truncate(0)
+    fresh = make_lines(3, start_index=7)
+    append(log_path, fresh)
+
+    assert os.stat(log_path).st_ino == inode
+    assert read_new(log_path) == tail + fresh
+    assert read_new(log_path) == []
+
+
+def test_truncate_without_copy_rereads_from_start(log_path):
+    append(log_path, make_lines(5))
+    read_new(log_path)
+
+    with open(log_path, "r+b") as f:
+        f.truncate(0)
+    # Nội dung mới dài hơn checkpoint nhưng khác dòng cuối đã ghi: phải đọc lại từ đầu file
+    fresh = make_lines(8, start_index=100)
+    append(log_path, fresh)
+
+    assert read_new(log_path) == fresh
+
+
+def test_partial_line_is_carried_to_next_read(log_path):
+    complete = make_lines(3)
+    partial = make_lines(1, start_index=3)[0]
+    append(log_path, complete + [partial[:20]])
+
+    assert read_new(log_path) == complete
+    assert ai.get_log_checkpoint(FIREWALL_ID)["offset"] == len("".join(complete).encode())
+
+    append(log_path, [partial[20:]])
+    assert read_new(log_path) == [partial]
+    assert read_new(log_path) == []